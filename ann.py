@@ -0,0 +1,212 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from similarity import CourseIndex, get_centroid, top_k_from_scores
+
+# The number of dimensions the tf-idf matrix is reduced to.
+DIMENSIONS = 128
+
+# The number of inverted lists scanned per query, and the number of best candidates re-scored with
+# the exact tf-idf rows, see ANNIndex.
+NPROBE = 16
+RERANK = 100
+
+KMEANS_ITERATIONS = 10
+
+
+class ANNIndex(CourseIndex):
+    '''
+    Approximate nearest neighbors over dense, low-dimensional course vectors.
+
+    The vectors are the tf-idf rows reduced with truncated SVD and L2-normalized, so the dot product
+    of two rows is their cosine similarity in the reduced space. They are clustered around a set of
+    centroids, and the rows of each cluster are stored together as an inverted list. A query only
+    scores the rows of the nprobe lists whose centroids are closest to it, plus its own list; more
+    lists mean higher recall and slower queries. With nprobe at least the number of lists every
+    row is scored, which is exact in the reduced space.
+
+    The reduced space loses part of the ranking of the tf-idf rows. If the tf-idf matrix is given,
+    the rerank best candidates are scored again with their exact cosine similarity, which recovers
+    most of it for the cost of rerank sparse dot products.
+    '''
+
+    def __init__(self, vectors, centroids, list_rows, list_offsets, courseids=None, nprobe=NPROBE, tfidf_matrix=None, rerank=RERANK):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_rows = list_rows
+        self.list_offsets = list_offsets
+        self.nprobe = nprobe
+        self.tfidf_matrix = tfidf_matrix
+        self.rerank = rerank
+
+        sizes = np.diff(list_offsets)
+        self.row_lists = np.empty(len(vectors), dtype=np.int32)
+        self.row_lists[list_rows] = np.repeat(np.arange(len(sizes), dtype=np.int32), sizes)
+
+        self.set_courseids(np.arange(len(vectors)) if courseids is None else courseids)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def top_k(self, row, k):
+        '''
+        Returns approximately the k highest scoring courses for one course, including the course itself.
+
+        Ties are broken by the lower row number, as in SimilarityIndex.top_k().
+
+            Parameters:
+                row: The row of the course in the index.
+                k: The number of courses to return.
+
+            Returns:
+                top_rows: Array of row numbers, most similar first.
+                top_scores: Array of the matching cosine similarities, exact if the candidates were
+                            re-scored and in the reduced space otherwise.
+        '''
+        exact_query = self.tfidf_matrix[row].toarray().ravel() if self.tfidf_matrix is not None else None
+        return self.search(self.vectors[row], k, [self.row_lists[row]], exact_query)
+
+    def centroid_top_k(self, rows, k, excluded=None):
+        '''
+        Returns approximately the k highest scoring courses for the centroid of several courses, as
+        SimilarityIndex.centroid_top_k() does. The lists of the seed courses are always scanned.
+        '''
+        query = normalize_rows(self.vectors[rows].mean(axis=0, keepdims=True))[0].astype(np.float32)
+        exact_query = get_centroid(self.tfidf_matrix, rows) if self.tfidf_matrix is not None else None
+        return self.search(query, k, self.row_lists[rows], exact_query, excluded)
+
+    def search(self, query, k, own_lists, exact_query=None, excluded=None):
+        '''
+        Returns approximately the k rows with the highest cosine similarity to a query vector.
+
+            Parameters:
+                query: Unit vector in the reduced space.
+                k: The number of courses to return.
+                own_lists: The lists that are scanned whether or not their centroids are among the closest.
+                exact_query: The query in the tf-idf space to re-score the candidates with, or None.
+                excluded: Boolean array marking the rows that must never be returned, or None.
+
+            Returns:
+                top_rows: Array of at most k row numbers, most similar first.
+                top_scores: Array of the matching cosine similarities.
+        '''
+        lists = len(self.centroids)
+        reranked = exact_query is not None and self.rerank > 0
+
+        if self.nprobe < lists:
+            probed = np.argpartition(-(self.centroids @ query), self.nprobe - 1)[:self.nprobe]
+            probed = np.union1d(probed, own_lists)
+            candidates = np.sort(np.concatenate([self.list_rows[self.list_offsets[cell]:self.list_offsets[cell + 1]] for cell in probed]))
+            scores = self.vectors[candidates] @ query
+        else:
+            candidates = None
+            scores = self.vectors @ query
+
+        if excluded is not None:
+            scores[excluded if candidates is None else excluded[candidates]] = -np.inf
+
+        positions, top_scores = top_k_from_scores(scores, max(k, self.rerank) if reranked else k)
+        top_rows = positions if candidates is None else candidates[positions]
+        kept = top_scores > -np.inf
+        top_rows, top_scores = top_rows[kept], top_scores[kept]
+        if not reranked:
+            return top_rows, top_scores
+
+        top_rows = np.sort(top_rows)
+        positions, top_scores = top_k_from_scores(self.tfidf_matrix[top_rows].dot(exact_query), k)
+        return top_rows[positions], top_scores
+
+
+def normalize_rows(vectors):
+    '''
+    Returns the rows of a dense array scaled to unit length, leaving all-zero rows as they are.
+    '''
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1
+    return vectors / norms[:, None]
+
+
+def reduce_tfidf(tfidf_matrix, dimensions=DIMENSIONS, seed=0):
+    '''
+    Reduces the tf-idf matrix to dense vectors with truncated SVD (latent semantic analysis).
+
+        Parameters:
+            tfidf_matrix: The formatted matrix returned by create_tfidf(course_descriptions)
+            dimensions: The number of dimensions to keep, at most one less than the number of courses and terms.
+            seed: Seed for the randomized SVD.
+
+        Returns:
+            vectors: float32 array of shape (N, dimensions) with L2-normalized rows.
+    '''
+    # Imported here so web workers that only load a prebuilt index never import scikit-learn.
+    from sklearn.decomposition import TruncatedSVD
+
+    dimensions = max(1, min(dimensions, tfidf_matrix.shape[0] - 1, tfidf_matrix.shape[1] - 1))
+    vectors = TruncatedSVD(n_components=dimensions, random_state=seed).fit_transform(tfidf_matrix)
+    return normalize_rows(vectors).astype(np.float32)
+
+
+def assign_lists(vectors, centroids, block_size=4096):
+    '''
+    Returns the closest centroid of every vector, scoring blocks of block_size vectors at a time.
+    '''
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        assignments[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, lists, iterations=KMEANS_ITERATIONS, seed=0):
+    '''
+    Clusters unit vectors with spherical k-means.
+
+        Parameters:
+            vectors: float32 array with L2-normalized rows.
+            lists: The number of clusters.
+            iterations: The number of assignment and update rounds.
+            seed: Seed for the initial centroids.
+
+        Returns:
+            centroids: float32 array of shape (lists, dimensions) with L2-normalized rows.
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    centroids = vectors[rng.choice(n, lists, replace=False)]
+
+    for _ in range(iterations):
+        assignments = assign_lists(vectors, centroids)
+        members = csr_matrix((np.ones(n, dtype=np.float32), (assignments, np.arange(n))), shape=(lists, n))
+        sums = np.asarray(members @ vectors)
+
+        # A centroid that lost all of its vectors starts over from a random vector.
+        empty = np.flatnonzero(np.bincount(assignments, minlength=lists) == 0)
+        sums[empty] = vectors[rng.choice(n, len(empty), replace=False)]
+        centroids = normalize_rows(sums).astype(np.float32)
+
+    return centroids
+
+
+def create_ann_index(tfidf_matrix, courseids=None, dimensions=DIMENSIONS, lists=None, seed=0):
+    '''
+    Reduces the tf-idf matrix and builds the inverted lists of an ANNIndex.
+
+        Parameters:
+            tfidf_matrix: The formatted matrix returned by create_tfidf(course_descriptions)
+            courseids: The courseid of every row, or None to number the rows from 0.
+            dimensions: The number of dimensions to reduce the tf-idf rows to.
+            lists: The number of inverted lists, the square root of the number of courses by default.
+            seed: Seed for the SVD and the initial centroids.
+
+        Returns:
+            ann_index: An ANNIndex over every row of the matrix, re-scoring its candidates with the matrix.
+    '''
+    vectors = reduce_tfidf(tfidf_matrix, dimensions, seed)
+    n = len(vectors)
+    lists = max(1, min(n, lists or int(np.sqrt(n))))
+
+    centroids = train_centroids(vectors, lists, seed=seed)
+    assignments = assign_lists(vectors, centroids)
+    list_rows = np.argsort(assignments, kind='stable').astype(np.int32)
+    list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=lists)))).astype(np.int64)
+
+    return ANNIndex(vectors, centroids, list_rows, list_offsets, courseids, tfidf_matrix=tfidf_matrix.tocsr())
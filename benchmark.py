@@ -0,0 +1,1012 @@
+#! /usr/bin/env python
+
+"""Benchmarks for the recommendation engine. Run `python benchmark.py --help` for the list."""
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import closing
+from sqlite3 import connect
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+import connections
+import get_recommendations
+from catalog import load_catalog
+from get_recommendations import create_tfidf, create_cosine_matrix, get_rec_rows, summarize_recs
+from similarity import NEIGHBORS, SimilarityIndex, UpdatableIndex, create_neighbor_table, top_k_from_scores
+from suggest import PrefixIndex
+from table import Base
+
+# The above/below average queries before they were joined correctly: the subquery is a cross join of
+# courserecs with all of demand.
+OLD_SPLIT_QUERIES = [
+    "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity FROM courserecs c LEFT JOIN courses s ON c.courseid = s.courseid LEFT JOIN demand d ON s.courseid = d.courseid WHERE d.coursedemand > (SELECT AVG(d.coursedemand) FROM courserecs c LEFT JOIN demand d)",
+    "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity FROM courserecs c LEFT JOIN courses s ON c.courseid = s.courseid LEFT JOIN demand d ON s.courseid = d.courseid WHERE d.coursedemand < (SELECT AVG(d.coursedemand) FROM courserecs c LEFT JOIN demand d)",
+]
+
+# The term of the synthetic databases.
+TERM = "202301"
+
+# The pickled Spring 2023 pull that ships with the repo.
+COURSES = "spring_courses"
+
+def linear_courseid(course_list, subject_code, course_number):
+    '''
+    The course lookup of databasebuilder.py before it was indexed: a scan of the whole course list.
+    '''
+    for course in course_list:
+        if subject_code == course["subjectCode"] and course_number == course["courseNumber"]:
+            return course["courseId"]
+
+def synthetic_descriptions(n, vocab_size=20000, words_per_course=80, seed=0):
+    '''
+    Returns a list of fake course descriptions with a Zipf-like word distribution.
+
+        Parameters:
+            n: The number of descriptions to generate.
+            vocab_size: The number of distinct words to draw from.
+            words_per_course: The length of each description.
+            seed: Seed for the random generator.
+
+        Returns:
+            descriptions: List of strings.
+    '''
+    rng = random.Random(seed)
+    # Fixed-width words, so no word is a prefix of another.
+    vocab = [f"w{i:05d}" for i in range(vocab_size)]
+    cum_weights = list(np.cumsum([1 / (rank + 1) for rank in range(vocab_size)]))
+    return [' '.join(rng.choices(vocab, cum_weights=cum_weights, k=words_per_course)) for _ in range(n)]
+
+def synthetic_topic_descriptions(n, topics=100, topic_words=200, topic_share=0.5, vocab_size=20000, words_per_course=60, seed=0):
+    '''
+    Returns a list of fake course descriptions that each belong to one of several topics.
+
+    Part of every description is drawn from the words of its topic and the rest from the Zipf-like
+    background of synthetic_descriptions(), so courses of the same topic are similar.
+
+        Parameters:
+            n: The number of descriptions to generate.
+            topics: The number of topics.
+            topic_words: The number of words of each topic.
+            topic_share: The share of each description drawn from its topic.
+            vocab_size: The number of distinct words to draw from.
+            words_per_course: The length of each description.
+            seed: Seed for the random generator.
+
+        Returns:
+            descriptions: List of strings.
+    '''
+    rng = random.Random(seed)
+    vocab = [f"w{i:05d}" for i in range(vocab_size)]
+    cum_weights = list(np.cumsum([1 / (rank + 1) for rank in range(vocab_size)]))
+    topic_vocab = [rng.sample(vocab, topic_words) for _ in range(topics)]
+
+    descriptions = []
+    for _ in range(n):
+        own = int(words_per_course * topic_share)
+        words = rng.choices(rng.choice(topic_vocab), k=own) + rng.choices(vocab, cum_weights=cum_weights, k=words_per_course - own)
+        descriptions.append(' '.join(words))
+    return descriptions
+
+def synthetic_database(path, n_courses, seed=0, demand_share=1.0):
+    '''
+    Creates a database with the tables from table.py filled with n_courses fake courses of TERM, and the
+    indexes of databasebuilder.SECONDARY_INDEXES, as a build creates them.
+
+        Parameters:
+            path: The file to create the database in.
+            n_courses: The number of courses.
+            seed: Seed for the random generator.
+            demand_share: The share of the courses that get a demand row.
+
+        Returns:
+            none
+    '''
+    from databasebuilder import SECONDARY_INDEXES
+
+    rng = random.Random(seed)
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    depts = [f"Department {i}" for i in range(40)]
+    titles = synthetic_descriptions(n_courses, vocab_size=2000, words_per_course=4, seed=seed)
+    descriptions = synthetic_descriptions(n_courses, words_per_course=60, seed=seed + 1)
+    codes = [f"S{i % 200:03d} {i}" for i in range(n_courses)]
+    with connect(path) as connection:
+        connection.executemany(
+            "INSERT INTO courses (term, courseid, fullcode, deptname, title, description, groupid) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(TERM, i, codes[i], rng.choice(depts), titles[i], descriptions[i], i) for i in range(n_courses)])
+        connection.executemany(
+            "INSERT INTO demand (term, courseid, coursecode, coursetitle, coursedemand) VALUES (?, ?, ?, ?, ?)",
+            [(TERM, i, codes[i], titles[i], rng.randint(0, 300)) for i in range(n_courses) if rng.random() < demand_share])
+        for index in SECONDARY_INDEXES:
+            connection.execute(index)
+
+def measure(func, *args):
+    '''
+    Calls a function and returns its result, wall time in seconds and peak traced memory in bytes.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def query_latency(func, rows):
+    '''
+    Returns the mean latency in milliseconds of calling func on each row.
+    '''
+    start = time.perf_counter()
+    for row in rows:
+        func(row)
+    return (time.perf_counter() - start) * 1000 / len(rows)
+
+def bench_similarity(args):
+    '''
+    Compares the dense N x N cosine matrix with the sparse SimilarityIndex as N grows.
+    '''
+    print(f"{'N':>7} | {'dense MB':>9} {'build s':>8} {'query ms':>9} | {'sparse MB':>9} {'build s':>8} {'query ms':>9}")
+    for n in args.sizes:
+        tfidf_matrix = create_tfidf(synthetic_descriptions(n))
+        rows = np.random.default_rng(0).integers(0, n, size=args.queries)
+
+        index, sparse_build, sparse_peak = measure(SimilarityIndex, tfidf_matrix)
+        sparse_bytes = sum(a.nbytes for a in (index.tfidf_matrix.data, index.tfidf_matrix.indices, index.tfidf_matrix.indptr))
+        sparse_query = query_latency(lambda row: index.top_k(row, 50), rows)
+
+        if n <= args.max_dense:
+            cosine_sim, dense_build, dense_peak = measure(create_cosine_matrix, tfidf_matrix)
+            dense_query = query_latency(lambda row: sorted(enumerate(cosine_sim[row]), key=lambda x: x[1], reverse=True)[:50], rows)
+            dense = f"{max(cosine_sim.nbytes, dense_peak) / 2**20:>9.1f} {dense_build:>8.3f} {dense_query:>9.3f}"
+            del cosine_sim
+        else:
+            dense = f"{n * n * 8 / 2**20:>9.1f} {'skipped':>8} {'':>9}"
+
+        sparse = f"{max(sparse_bytes, sparse_peak) / 2**20:>9.1f} {sparse_build:>8.3f} {sparse_query:>9.3f}"
+        print(f"{n:>7} | {dense} | {sparse}")
+
+def bench_ann(args):
+    '''
+    Compares recall@10 and query latency of the approximate nearest neighbor index with the exact
+    tf-idf engine scoring every course, as nprobe grows, with and without re-scoring the best
+    candidates exactly. The last nprobe of each size scans every list, which isolates the recall
+    lost to the SVD from the recall lost to the inverted lists.
+    '''
+    from ann import create_ann_index
+
+    def top_ten(index, row):
+        top_rows, _ = index.top_k(row, 11)
+        return [r for r in top_rows.tolist() if r != row][:10]
+
+    datasets = [(f"synthetic {n}", synthetic_topic_descriptions(n)) for n in args.sizes]
+    if args.database:
+        with connect(args.database) as connection:
+            rows = connection.execute("SELECT cleansentence FROM nlpformat WHERE term = ? ORDER BY courseid", [TERM]).fetchall()
+        datasets.insert(0, (f"database {TERM}", [row[0] for row in rows]))
+
+    print(f"{args.dimensions} dimensions, recall@10 against the exact top ten")
+    print(f"{'courses':>16} | {'engine':>6} | {'lists':>5} | {'nprobe':>6} | {'rerank':>6} | {'MB':>6} | {'build s':>7} | {'recall':>6} | {'query ms':>8}")
+    for name, descriptions in datasets:
+        tfidf_matrix = create_tfidf(descriptions).tocsr()
+        n = tfidf_matrix.shape[0]
+        queries = np.random.default_rng(0).integers(0, n, size=args.queries).tolist()
+
+        exact = SimilarityIndex(tfidf_matrix)
+        exact_mb = sum(a.nbytes for a in (tfidf_matrix.data, tfidf_matrix.indices, tfidf_matrix.indptr)) / 2**20
+        truth = {row: set(top_ten(exact, row)) for row in queries}
+        exact_ms = query_latency(lambda row: exact.top_k(row, 50), queries)
+        print(f"{name:>16} | {'exact':>6} | {'':>5} | {'':>6} | {'':>6} | {exact_mb:>6.1f} | {'':>7} | {1:>6.3f} | {exact_ms:>8.3f}")
+
+        start = time.perf_counter()
+        ann_index = create_ann_index(tfidf_matrix, dimensions=args.dimensions, lists=args.lists)
+        build_s = time.perf_counter() - start
+        lists = len(ann_index.centroids)
+        ann_mb = sum(a.nbytes for a in (ann_index.vectors, ann_index.centroids, ann_index.list_rows, ann_index.list_offsets)) / 2**20
+
+        for rerank in args.rerank:
+            for nprobe in sorted({min(p, lists) for p in args.nprobe} | {lists}):
+                ann_index.nprobe, ann_index.rerank = nprobe, rerank
+                recall = np.mean([len(truth[row] & set(top_ten(ann_index, row))) / max(1, len(truth[row])) for row in queries])
+                ann_ms = query_latency(lambda row: ann_index.top_k(row, 50), queries)
+                print(f"{name:>16} | {'ann':>6} | {lists:>5} | {nprobe:>6} | {rerank:>6} | {ann_mb:>6.1f} | {build_s:>7.2f} | {recall:>6.3f} | {ann_ms:>8.3f}")
+
+def bench_neighbors(args):
+    '''
+    Times precomputing the neighbor lists of every course with create_neighbor_table() for several
+    block sizes and worker counts. Each process holds one block_size x N slice of the similarity matrix.
+    '''
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'courses':>8} | {'block':>6} | {'block MB':>8} | {'workers':>7} | {'seconds':>8}")
+    for n in args.sizes:
+        tfidf_matrix = create_tfidf(synthetic_descriptions(n)).tocsr()
+        expected = None
+        for block_size in args.block_sizes:
+            for workers in args.workers:
+                start = time.perf_counter()
+                result = create_neighbor_table(tfidf_matrix, NEIGHBORS, block_size, workers)
+                seconds = time.perf_counter() - start
+                if expected is None:
+                    expected = result
+                assert (result[0] == expected[0]).all()
+                print(f"{n:>8} | {block_size:>6} | {block_size * n * 8 / 2**20:>8.1f} | {workers:>7} | {seconds:>8.2f}")
+
+def bench_multi_seed(args):
+    '''
+    Times recommendations seeded from several courses: the seeds averaged into one centroid and
+    scored with one sparse matrix-vector product, against scoring every seed on its own and
+    averaging the similarity rows, which ranks the courses the same way up to rounding.
+    '''
+    from catalog import CourseCatalog
+    from get_recommendations import get_multi_recommendations
+
+    print(f"{'courses':>8} | {'seeds':>5} | {'per-seed ms':>11} | {'centroid ms':>11} | {'recommend ms':>12}")
+    for n in args.sizes:
+        index = SimilarityIndex(create_tfidf(synthetic_descriptions(n)))
+        catalog = CourseCatalog(list(range(n)), [f"Course {i}" for i in range(n)], [f"S{i % 200:03d} {i}" for i in range(n)], ["Department"] * n, list(range(n)))
+        rng = np.random.default_rng(n)
+
+        for seeds in args.seeds:
+            samples = [rng.choice(n, seeds, replace=False) for _ in range(args.repeat)]
+
+            def per_seed(rows):
+                scores = sum(index.similarity_row(row) for row in rows) / len(rows)
+                excluded = np.zeros(n, dtype=bool)
+                excluded[rows] = True
+                scores[excluded] = -np.inf
+                return top_k_from_scores(scores, 50)[0]
+
+            def centroid(rows):
+                excluded = np.zeros(n, dtype=bool)
+                excluded[rows] = True
+                return index.centroid_top_k(rows, 50, excluded)[0]
+
+            per_seed_ms = query_latency(per_seed, samples)
+            centroid_ms = query_latency(centroid, samples)
+            recommend_ms = query_latency(lambda rows: get_multi_recommendations(rows.tolist(), index, catalog), samples)
+            print(f"{n:>8} | {seeds:>5} | {per_seed_ms:>11.3f} | {centroid_ms:>11.3f} | {recommend_ms:>12.3f}")
+
+def bench_crosslist(args):
+    '''
+    Compares a similarity index with one row per course, where the cross-listed copies of a course are
+    deduplicated by title after every query, with an index of one row per cross-listing group.
+    '''
+    print(f"{'courses':>8} | {'groups':>7} | {'index':>6} | {'rows':>7} | {'MB':>6} | {'build s':>7} | {'query ms':>8}")
+    for n in args.sizes:
+        rng = np.random.default_rng(n)
+        # Most courses stand alone; the rest are listed under two to four codes with the same description.
+        sizes = rng.choice([1, 2, 3, 4], size=n, p=[0.7, 0.2, 0.07, 0.03])
+        group_descriptions = synthetic_topic_descriptions(n)
+        groups = np.repeat(np.arange(n), sizes)
+        queries = rng.integers(0, len(groups), size=args.queries)
+
+        def per_course(index, row):
+            top_rows, _ = index.top_k(row, 50)
+            labels = groups[top_rows]
+            _, first_positions = np.unique(labels, return_index=True)
+            first_positions.sort()
+            return top_rows[first_positions[labels[first_positions] != groups[row]][:10]]
+
+        def per_group(index, row):
+            top_rows, _ = index.top_k(groups[row], 11)
+            return top_rows[top_rows != groups[row]][:10]
+
+        for name, descriptions, recommend in (("course", [group_descriptions[group] for group in groups], per_course), ("group", group_descriptions, per_group)):
+            start = time.perf_counter()
+            tfidf_matrix = create_tfidf(descriptions).tocsr()
+            index = SimilarityIndex(tfidf_matrix, *create_neighbor_table(tfidf_matrix, NEIGHBORS))
+            build_s = time.perf_counter() - start
+            index_mb = sum(a.nbytes for a in (index.tfidf_matrix.data, index.tfidf_matrix.indices, index.tfidf_matrix.indptr, index.neighbor_ids, index.neighbor_scores)) / 2**20
+            query_ms = query_latency(lambda row: recommend(index, row), queries)
+            print(f"{len(groups):>8} | {n:>7} | {name:>6} | {len(index):>7} | {index_mb:>6.1f} | {build_s:>7.2f} | {query_ms:>8.3f}")
+
+def bench_demand_split(args):
+    '''
+    Times the above/below average split of ten recommendations as the demand table grows.
+    '''
+    print(f"{'demand rows':>12} | {'cross join ms':>14} | {'one fetch ms':>13}")
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'bench.sqlite')
+            synthetic_database(path, n)
+            connections.configure('file:' + path)
+
+            catalog = load_catalog(TERM)
+            recs = [{"courseid": i, "similarity_score": 0.5} for i in random.Random(n).sample(range(n), 10)]
+            with connect(path) as connection:
+                connection.execute("CREATE TABLE courserecs (courseid INTEGER PRIMARY KEY, similarity NUMERIC(3, 5))")
+                connection.executemany("INSERT INTO courserecs VALUES (?, ?)", [(c["courseid"], c["similarity_score"]) for c in recs])
+
+            def old_split():
+                with connect(path) as connection:
+                    with closing(connection.cursor()) as cursor:
+                        for query in OLD_SPLIT_QUERIES:
+                            cursor.execute(query)
+                            cursor.fetchall()
+
+            old_ms = query_latency(lambda _: old_split(), range(args.repeat))
+            new_ms = query_latency(lambda _: summarize_recs(get_rec_rows(recs, TERM, catalog)), range(args.repeat))
+            print(f"{n:>12} | {old_ms:>14.3f} | {new_ms:>13.3f}")
+
+def bench_demand_series(args):
+    '''
+    Times loading the daily demand samples and the demand columns of a results page computed from
+    the raw samples against reading the precomputed rollups of the demand table.
+    '''
+    from sqlalchemy.orm import sessionmaker
+    from databasebuilder import BUILD_PRAGMAS, bulk_insert, get_demand_rows
+    from table import DemandSeries
+
+    # Final, peak and growth of ten courses from their samples, as the page would need without rollups.
+    raw_query = (
+        "SELECT courseid, MAX(count), "
+        "(SELECT count FROM demandseries l WHERE l.term = s.term AND l.courseid = s.courseid ORDER BY date DESC LIMIT 1), "
+        "(SELECT count FROM demandseries f WHERE f.term = s.term AND f.courseid = s.courseid ORDER BY date LIMIT 1) "
+        "FROM demandseries s WHERE term = ? AND courseid IN ({}) GROUP BY courseid")
+    rollup_query = "SELECT courseid, peakdemand, coursedemand, coursedemand - demandgrowth FROM demand WHERE term = ? AND courseid IN ({})"
+
+    print(f"{args.days} samples per course")
+    print(f"{'courses':>8} | {'samples':>8} | {'load s':>7} | {'rollup s':>8} | {'table MB':>8} | {'raw ms':>7} | {'rollup ms':>9}")
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'bench.sqlite')
+            synthetic_database(path, n)
+            rng = random.Random(n)
+            series_rows = []
+            for i in range(n):
+                count = rng.randint(0, 300)
+                for day in range(args.days):
+                    series_rows.append(dict(term=TERM, courseid=i, date=f"2022-11-{day + 1:02d}", count=count))
+                    count = max(0, count + rng.randint(-5, 10))
+
+            engine = create_engine('sqlite:///' + path)
+            session = sessionmaker(bind=engine)()
+            for pragma in BUILD_PRAGMAS:
+                session.execute(text(pragma))
+            session.execute(text("DELETE FROM demand"))
+            start = time.perf_counter()
+            bulk_insert(session, DemandSeries, series_rows)
+            load_s = time.perf_counter() - start
+            start = time.perf_counter()
+            demand_rows = get_demand_rows(series_rows, {i: (f"S{i % 200:03d} {i}", f"Course {i}") for i in range(n)})
+            session.execute(text("INSERT INTO demand (term, courseid, coursecode, coursetitle, coursedemand, peakdemand, demandgrowth) VALUES (:term, :courseid, :coursecode, :coursetitle, :coursedemand, :peakdemand, :demandgrowth)"), demand_rows)
+            rollup_s = time.perf_counter() - start
+            session.commit()
+            session.close()
+            engine.dispose()
+
+            with connect(path) as connection:
+                table_bytes = connection.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'demandseries'").fetchone()[0] or 0
+
+                samples = [random.Random(n + k).sample(range(n), 10) for k in range(args.repeat)]
+                raw_results, rollup_results = [], []
+                raw_ms = query_latency(lambda ids: raw_results.append(sorted(connection.execute(raw_query.format(','.join('?' * len(ids))), [TERM] + ids).fetchall())), samples)
+                rollup_ms = query_latency(lambda ids: rollup_results.append(sorted(connection.execute(rollup_query.format(','.join('?' * len(ids))), [TERM] + ids).fetchall())), samples)
+                assert raw_results == rollup_results
+
+            print(f"{n:>8} | {len(series_rows):>8} | {load_s:>7.3f} | {rollup_s:>8.3f} | {table_bytes / 2**20:>8.1f} | {raw_ms:>7.3f} | {rollup_ms:>9.3f}")
+
+def bench_search(args):
+    '''
+    Times title searches with LIKE '%snippet%' and with the coursesearch full-text index as the catalog grows.
+    '''
+    from sqlalchemy.orm import sessionmaker
+    from databasebuilder import populate_search_index
+
+    snippets = ["w00400", "w00150 w00020", "w01500", "w0150", "S034 1234", "nomatch"]
+    print(f"{'courses':>8} | {'LIKE ms':>8} | {'FTS ms':>7}")
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'bench.sqlite')
+            synthetic_database(path, n)
+            connections.configure('file:' + path)
+
+            engine = create_engine('sqlite:///' + path)
+            session = sessionmaker(bind=engine)()
+            populate_search_index(session)
+            session.commit()
+            session.close()
+            engine.dispose()
+
+            def like_search(snippet):
+                with connect(path) as connection:
+                    connection.execute("SELECT courseid, coursecode, coursetitle from demand WHERE term = ? AND coursetitle LIKE ? ORDER BY coursecode", [TERM, '%' + snippet + '%']).fetchall()
+
+            like_ms = query_latency(like_search, snippets * args.repeat)
+            fts_ms = query_latency(lambda snippet: get_recommendations.get_matching(snippet, TERM), snippets * args.repeat)
+            print(f"{n:>8} | {like_ms:>8.3f} | {fts_ms:>7.3f}")
+
+def bench_suggest(args):
+    '''
+    Reports build time and p50/p99 latency of typeahead lookups in the prefix index as the catalog grows.
+
+    Only half of the fake courses have demand rows. Every suggestion, submitted as the search page
+    submits it, must find its course through get_matching(), so typeahead and search cover the same courses.
+    '''
+    from sqlalchemy.orm import sessionmaker
+    from databasebuilder import populate_search_index
+
+    rng = random.Random(0)
+    print(f"{'courses':>8} | {'build s':>8} | {'p50 us':>7} | {'p99 us':>7} | {'checked':>7}")
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'bench.sqlite')
+            synthetic_database(path, n, demand_share=0.5)
+            connections.configure('file:' + path)
+
+            engine = create_engine('sqlite:///' + path)
+            session = sessionmaker(bind=engine)()
+            populate_search_index(session)
+            session.commit()
+            session.close()
+            engine.dispose()
+
+            catalog = load_catalog(TERM)
+            index, build_s, _ = measure(PrefixIndex.from_catalog, catalog)
+            codes = [code for code in catalog.codes if code is not None]
+            titles = [title for title in catalog.titles if title is not None]
+
+            queries = []
+            for _ in range(args.queries):
+                text = rng.choice(codes) if rng.random() < 0.5 else rng.choice(titles)
+                queries.append(text[:rng.randint(1, len(text))])
+
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                index.suggest(query, 10)
+                latencies.append((time.perf_counter() - start) * 1e6)
+            p50, p99 = np.percentile(latencies, [50, 99])
+
+            checked = 0
+            for query in queries[:args.checks]:
+                for suggestion in index.suggest(query, 10):
+                    matches = get_recommendations.get_matching(suggestion['code'] + ' ' + suggestion['title'], TERM)
+                    assert any(suggestion['courseid'] in courseids for courseids, _, _ in matches), suggestion
+                    checked += 1
+
+            print(f"{n:>8} | {build_s:>8.3f} | {p50:>7.1f} | {p99:>7.1f} | {checked:>7}")
+
+def bench_cache(args):
+    '''
+    Reports the hit rate and latency of /recommendations pages for course ids drawn with Zipf-like
+    popularity, as the response cache grows, and of revalidating a cached page with its ETag.
+    '''
+    from response_cache import ResponseCache
+
+    connections.configure('file:' + args.database)
+    import rec_app
+
+    client = rec_app.app.test_client()
+    _, catalog, _ = rec_app.get_term_data(TERM)
+    courseids = np.random.default_rng(0).permutation(np.flatnonzero(catalog.groupids >= 0))
+    weights = 1 / np.arange(1, len(courseids) + 1)
+    paths = [f"/recommendations?courseid={courseid}&term={TERM}" for courseid in np.random.default_rng(1).choice(courseids, args.requests, p=weights / weights.sum())]
+
+    print(f"{args.requests} requests over {len(courseids)} courses of {TERM}")
+    print(f"{'capacity':>8} | {'hit rate':>8} | {'mean ms':>7} | {'p50 ms':>7} | {'p99 ms':>7}")
+    for capacity in args.capacities:
+        rec_app.page_cache = ResponseCache(capacity, rec_app.CACHE_TTL)
+        latencies = []
+        for path in paths:
+            start = time.perf_counter()
+            client.get(path)
+            latencies.append((time.perf_counter() - start) * 1000)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        hit_rate = rec_app.page_cache.get_stats()['hit_rate']
+        print(f"{capacity:>8} | {hit_rate:>8.3f} | {np.mean(latencies):>7.3f} | {p50:>7.3f} | {p99:>7.3f}")
+
+    etag = client.get(paths[0]).headers['ETag']
+    revalidate_ms = query_latency(lambda path: client.get(path, headers={'If-None-Match': etag}), [paths[0]] * 200)
+    print(f"revalidation with If-None-Match (304): {revalidate_ms:.3f} ms")
+
+def bench_build(args):
+    '''
+    Times loading the courses table one ORM object at a time against the bulk loader of databasebuilder.py.
+    '''
+    from sqlalchemy.orm import sessionmaker
+    from databasebuilder import BUILD_PRAGMAS, bulk_insert
+    from table import Courses
+
+    print(f"{'courses':>8} | {'session.add s':>13} | {'bulk s':>7}")
+    for n in args.sizes:
+        descriptions = synthetic_descriptions(n, words_per_course=60)
+        rows = [dict(term='202301', courseid=i, fullcode=f"S{i % 200:03d} {i}", deptcode='DEPT', subcode=f"S{i % 200:03d}", deptname='Department', coursenum=i, title=f"Course {i}", description=descriptions[i], school='School') for i in range(n)]
+
+        timings = []
+        for bulk in (False, True):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                engine = create_engine('sqlite:///' + os.path.join(tmp_dir, 'bench.sqlite'))
+                Base.metadata.create_all(engine)
+                session = sessionmaker(bind=engine)()
+
+                start = time.perf_counter()
+                if bulk:
+                    for pragma in BUILD_PRAGMAS:
+                        session.execute(text(pragma))
+                    bulk_insert(session, Courses, rows)
+                else:
+                    for row in rows:
+                        session.add(Courses(**row))
+                session.commit()
+                timings.append(time.perf_counter() - start)
+
+                session.close()
+                engine.dispose()
+
+        print(f"{n:>8} | {timings[0]:>13.3f} | {timings[1]:>7.3f}")
+
+def bench_demand_resolve(args):
+    '''
+    Times looking up course ids with a scan of the course list and with index_courses(), first for every
+    course code of the course list, then while resolving the demand samples of course_csv/demand_spring23.csv.
+
+    The demand CSV is not a list of queries: it holds one sample per CourseTable id and day, and each sample
+    looks up the section codes of its id, so the same codes are looked up again for every day.
+    '''
+    import csv
+    from databasebuilder import DEMAND, get_sample_date, index_courses, load_courses, read_course_codes, resolve_demand, tag_courseid
+
+    COURSE_LIST = tag_courseid(load_courses(COURSES))
+    courses_path, demand_path = DEMAND[TERM]
+
+    codes = read_course_codes(courses_path)
+    with open(demand_path, newline='') as fp:
+        demand_rows = list(csv.DictReader(fp))
+
+    lookups = [(course["subjectCode"], course["courseNumber"]) for course in COURSE_LIST]
+    start = time.perf_counter()
+    linear_ids = [linear_courseid(COURSE_LIST, subject, number) for subject, number in lookups]
+    lookup_linear_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    course_index = index_courses(COURSE_LIST)
+    indexed_ids = [course_index.get((TERM, subject, number)) for subject, number in lookups]
+    lookup_indexed_s = time.perf_counter() - start
+
+    assert linear_ids == indexed_ids
+    print(f"{len(lookups)} course codes, {len(COURSE_LIST)} courses")
+    print(f"list scan: {lookup_linear_s:.3f} s | dict index: {lookup_indexed_s:.3f} s | speedup: {lookup_linear_s / lookup_indexed_s:.0f}x")
+
+    start = time.perf_counter()
+    linear = {}
+    for row in demand_rows:
+        courseids = []
+        for subject, number, _ in codes.get(row["id"], []):
+            courseid = linear_courseid(COURSE_LIST, subject, number)
+            if courseid is not None and courseid not in courseids:
+                courseids.append(courseid)
+        date = get_sample_date(TERM, row["date"])
+        for courseid in courseids:
+            linear[(courseid, date)] = linear.get((courseid, date), 0) + int(row["count"])
+    linear_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed, _ = resolve_demand(demand_rows, codes, index_courses(COURSE_LIST), TERM)
+    indexed_s = time.perf_counter() - start
+
+    assert linear == indexed
+    print(f"{len(demand_rows)} daily demand samples of {len({row['id'] for row in demand_rows})} CourseTable ids")
+    print(f"list scan: {linear_s:.3f} s | dict index: {indexed_s:.3f} s | speedup: {linear_s / indexed_s:.0f}x")
+
+def bench_normalize(args):
+    '''
+    Times cleaning and tokenizing the course descriptions the old way (three re.sub calls and a new
+    WordNetLemmatizer per sentence) against clean_data() and tokenize_data() with a cold lemma cache,
+    with worker processes, and with the tokens of the last build when a few descriptions changed.
+    '''
+    import re
+    from nltk.stem import WordNetLemmatizer
+    from nltk.tokenize import word_tokenize
+    import databasebuilder as builder
+
+    courses = builder.strip_all_tags(builder.tag_courseid(builder.load_courses(COURSES)))
+    stopwords = builder.get_stopwords()
+
+    def old_normalize(course_list):
+        for course in course_list:
+            if course["description"] != None:
+                text = course["description"].lower()
+                for pattern in (builder.PATTERN_S, builder.PATTERN_RN, builder.PATTERN_PUNC):
+                    text = re.sub(pattern, ' ', text)
+                stemmer = WordNetLemmatizer()
+                tokens = [stemmer.lemmatize(w) for w in word_tokenize(text)]
+                course["toklemsentence"] = [w for w in tokens if len(w) > builder.MIN_WORDS and len(w) < builder.MAX_WORDS and w not in stopwords]
+
+    def new_normalize(course_list, workers, memo=None):
+        builder.lemmatize_token.cache_clear()
+        return builder.tokenize_data(builder.clean_data(course_list), workers=workers, memo=memo)
+
+    def seconds(func, *func_args):
+        start = time.perf_counter()
+        func(*func_args)
+        return time.perf_counter() - start
+
+    old_normalize([dict(course) for course in courses[:50]])
+    old_s = seconds(old_normalize, [dict(course) for course in courses])
+    print(f"{len(courses)} courses")
+    print(f"{'serial, re.sub x3, no lemma cache':<44} {old_s:>7.3f} s")
+
+    for workers in sorted({1, args.workers}):
+        new_s = seconds(new_normalize, courses, workers)
+        print(f"{f'combined regex, lemma cache, {workers} worker(s)':<44} {new_s:>7.3f} s")
+
+    memo = {}
+    new_normalize(courses, 1, memo)
+    rng = random.Random(0)
+    changed = [dict(course) for course in courses]
+    for course in rng.sample([course for course in changed if course["description"]], len(changed) * args.changed // 100):
+        course["description"] += " revised"
+    memo_s = seconds(new_normalize, changed, 1, memo)
+    print(f"{f'rebuild with {args.changed}% changed, tokens memoized':<44} {memo_s:>7.3f} s")
+
+def bench_index_update(args):
+    '''
+    Times a full rebuild of the tf-idf matrix and neighbor table against UpdatableIndex.apply_changes()
+    for a handful of changed, added and removed courses, and reports how many top-10 lists still match
+    a full rebuild while the idf weights are stale.
+    '''
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    def full_build(descriptions):
+        tfidf, tfidf_matrix = get_recommendations.fit_tfidf(descriptions)
+        tfidf_matrix = tfidf_matrix.tocsr()
+        neighbor_ids, neighbor_scores = create_neighbor_table(tfidf_matrix, NEIGHBORS)
+        counts = CountVectorizer(stop_words='english', vocabulary=tfidf.vocabulary_).transform(descriptions)
+        return UpdatableIndex(tfidf_matrix, counts, tfidf.vocabulary_, tfidf.idf_, range(len(descriptions)), neighbor_ids, neighbor_scores)
+
+    rng = random.Random(0)
+    print(f"{'courses':>8} | {'changes':>7} | {'full s':>7} | {'update s':>8} | {'lists':>6} | {'top-10 match':>12}")
+    for n in args.sizes:
+        descriptions = synthetic_descriptions(n, words_per_course=60)
+        start = time.perf_counter()
+        index = full_build(descriptions)
+        full_s = time.perf_counter() - start
+
+        new_texts = synthetic_descriptions(args.changes, words_per_course=60, seed=1)
+        changed = rng.sample(range(n), args.changes)
+        changes = {courseid: text for courseid, text in zip(changed[:-2], new_texts)}
+        changes[changed[-2]] = None
+        changes[n] = new_texts[-1]
+
+        start = time.perf_counter()
+        affected = index.apply_changes(changes)
+        update_s = time.perf_counter() - start
+
+        updated = [changes.get(i, text) for i, text in enumerate(descriptions)] + [changes[n]]
+        keep = [i for i, text in enumerate(updated) if text is not None]
+        rebuilt = full_build([updated[i] for i in keep])
+        index.compact()
+        match = np.mean([set(index.neighbor_ids[row, :11]) == set(rebuilt.neighbor_ids[row, :11]) for row in range(len(keep))])
+        print(f"{n:>8} | {len(changes):>7} | {full_s:>7.2f} | {update_s:>8.3f} | {len(affected):>6} | {match:>12.4f}")
+
+def start_stub_api(subjects, courses_per_subject, latency, failure_rate, seed=0, description=None):
+    '''
+    Starts a local HTTP/1.1 server in a background thread that answers like the Yale Courses API.
+
+    Course responses carry an ETag, and a request whose If-None-Match matches gets 304 Not Modified.
+    Adding a (school, subject) pair to the server's edited set changes the title of its courses.
+
+        Parameters:
+            subjects: The number of subject codes it lists.
+            courses_per_subject: The number of courses returned for each (school, subject) request.
+            latency: Seconds to wait before answering each request.
+            failure_rate: The fraction of requests answered with 503 Service Unavailable.
+            seed: Seed for choosing the failed requests.
+            description: The description of every course, or None to leave it out.
+
+        Returns:
+            server: The running ThreadingHTTPServer. Its requests attribute counts the requests it answered,
+                    and not_modified the 304 responses among them.
+    '''
+    import hashlib, json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    rng = random.Random(seed)
+    codes = [f"S{i:03d}" for i in range(subjects)]
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately; without this, delayed ACKs stall kept-alive connections.
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            server.requests += 1
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            time.sleep(latency)
+
+            if rng.random() < failure_rate:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if url.path.endswith("/subjects"):
+                body = [{"code": code} for code in codes]
+            else:
+                title = "Edited course" if (params["school"], params["subjectCode"]) in server.edited else "Course"
+                body = [{"subjectCode": params["subjectCode"], "courseNumber": str(100 + i), "schoolCode": params["school"], "termCode": params.get("termCode"), "courseTitle": f"{title} {i}"} for i in range(courses_per_subject)]
+                if description is not None:
+                    for course in body:
+                        course.update(description=description, subjectNumber=f"{course['subjectCode']} {course['courseNumber']}")
+
+            data = json.dumps(body).encode("utf-8")
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.not_modified = 0
+    server.edited = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_scrape(args):
+    '''
+    Pulls a term from a local stub of the Yale Courses API with the old sequential loop (one
+    requests.get per school and subject) and with the thread pool of pull_courses.py, checks that
+    retries and resuming from the cache work, and times a nightly refresh that revalidates every
+    cached subject with its ETag.
+    '''
+    import io, json, requests
+    from contextlib import redirect_stdout
+    import pull_courses
+    from codes import SCHOOLS
+
+    def sequential_pull(base_url, subj_codes):
+        dict_list = []
+        for school in SCHOOLS:
+            all_courses = []
+            for subj_code in subj_codes:
+                response = requests.get(base_url + pull_courses.COURSES_PATH, params={"subjectCode": subj_code, "termCode": "202301", "mode": "json", "school": school}, timeout=30)
+                all_courses.extend(json.loads(response.text))
+            dict_list.append(all_courses)
+        return dict_list
+
+    def pool_pull(server, workers, cache_dir=None, schools=SCHOOLS, ttl=pull_courses.CACHE_TTL):
+        pull_courses.configure(f"http://127.0.0.1:{server.server_address[1]}", rate=0)
+        with redirect_stdout(io.StringIO()):
+            return pull_courses.pull_term("202301", schools, workers=workers, cache_dir=cache_dir, ttl=ttl)[0]
+
+    def timed(server, func, *func_args):
+        server.requests = 0
+        start = time.perf_counter()
+        result = func(*func_args)
+        return result, time.perf_counter() - start, server.requests
+
+    server = start_stub_api(args.subjects, 20, args.latency, 0)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    subj_codes = [f"S{i:03d}" for i in range(args.subjects)]
+    pairs = len(SCHOOLS) * args.subjects
+    print(f"{len(SCHOOLS)} schools x {args.subjects} subjects, {args.latency * 1000:.0f} ms per request")
+    print(f"{'run':<36} | {'requests':>8} | {'seconds':>7} | {'pairs/s':>7}")
+
+    expected, seconds, requests_made = timed(server, sequential_pull, base_url, subj_codes)
+    print(f"{'sequential requests.get':<36} | {requests_made:>8} | {seconds:>7.2f} | {pairs / seconds:>7.1f}")
+
+    for workers in args.workers:
+        result, seconds, requests_made = timed(server, pool_pull, server, workers)
+        assert result == expected
+        print(f"{f'pool, {workers} workers':<36} | {requests_made:>8} | {seconds:>7.2f} | {pairs / seconds:>7.1f}")
+    server.shutdown()
+    server.server_close()
+
+    workers = max(args.workers)
+    failing = start_stub_api(args.subjects, 20, args.latency, args.failure_rate)
+    backoff, pull_courses.BACKOFF = pull_courses.BACKOFF, 0.05
+    result, seconds, requests_made = timed(failing, pool_pull, failing, workers)
+    pull_courses.BACKOFF = backoff
+    assert result == expected
+    print(f"{f'pool, {args.failure_rate:.0%} 503s, retried':<36} | {requests_made:>8} | {seconds:>7.2f} | {pairs / seconds:>7.1f}")
+    failing.shutdown()
+    failing.server_close()
+
+    server = start_stub_api(args.subjects, 20, args.latency, 0)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # An interrupted run that got through the first half of the schools.
+        pool_pull(server, workers, cache_dir, list(SCHOOLS)[:len(SCHOOLS) // 2])
+        result, seconds, requests_made = timed(server, pool_pull, server, workers, cache_dir)
+        assert result == expected
+        print(f"{'pool, resumed from the cache':<36} | {requests_made:>8} | {seconds:>7.2f} | {pairs / seconds:>7.1f}")
+
+        # The next night: every cached subject is revalidated, and a few have changed.
+        pull_courses.write_manifest(cache_dir, "202301", {pair: pull_courses.pull_subject("202301", *pair, cache_dir)[1] for pair in ((school, code) for school in SCHOOLS for code in subj_codes)})
+        server.edited = set(random.Random(0).sample([(school, code) for school in SCHOOLS for code in subj_codes], max(1, pairs * args.edited // 100)))
+        server.not_modified = 0
+        pull_courses.configure(f"http://127.0.0.1:{server.server_address[1]}", rate=0)
+        start = time.perf_counter()
+        server.requests = 0
+        with redirect_stdout(io.StringIO()):
+            result, changed, _ = pull_courses.pull_term("202301", SCHOOLS, workers=workers, cache_dir=cache_dir, ttl=0)
+        seconds = time.perf_counter() - start
+        assert sorted(changed) == sorted(server.edited)
+        print(f"{f'pool, revalidated, {len(changed)} changed':<36} | {server.requests:>8} | {seconds:>7.2f} | {pairs / seconds:>7.1f}   ({server.not_modified} were 304)")
+    server.shutdown()
+    server.server_close()
+
+def bench_ingest(args):
+    '''
+    Measures the peak Python memory of pulling a term from a local stub API and saving it the old
+    way, as one pickle of every course, and the streaming way, as a JSON Lines staging file written
+    while the subjects arrive. Also checks that the dedupe stage of databasebuilder.py reads the
+    same courses from both, and its peak memory on each.
+    '''
+    import io, pickle
+    from contextlib import redirect_stdout
+    import pull_courses
+    from codes import SCHOOLS
+    from databasebuilder import load_courses, tag_courseid
+
+    def peak(func, *func_args):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*func_args)
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, seconds, peak_bytes / 2 ** 20
+
+    def pickle_pull(path):
+        dict_list = pull_courses.pull_term("202301", SCHOOLS, workers=args.workers, cache_dir=None)[0]
+        with open(path, 'wb') as fp:
+            pickle.dump(dict_list, fp)
+
+    def staged_pull(path):
+        return pull_courses.stage_term("202301", path, SCHOOLS, workers=args.workers, cache_dir=None)[2]
+
+    description = " ".join(["seminar"] * (args.description_bytes // 8))
+    print(f"{len(SCHOOLS)} schools, {args.courses} courses per subject, {args.description_bytes} byte descriptions; peak traced memory")
+    print(f"{'subjects':>8} | {'courses':>7} | {'pickle MB':>9} | {'staged MB':>9} | {'pickle s':>8} | {'staged s':>8} | {'dedupe pickle MB':>16} | {'dedupe staged MB':>16}")
+
+    for subjects in args.subjects:
+        server = start_stub_api(subjects, args.courses, 0, 0, description=description)
+        pull_courses.configure(f"http://127.0.0.1:{server.server_address[1]}", rate=0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pickle_path, staged_path = os.path.join(tmp_dir, "courses"), os.path.join(tmp_dir, "courses.jsonl")
+            with redirect_stdout(io.StringIO()):
+                _, pickle_s, pickle_mb = peak(pickle_pull, pickle_path)
+                count, staged_s, staged_mb = peak(staged_pull, staged_path)
+            from_pickle, _, dedupe_pickle_mb = peak(lambda: tag_courseid(load_courses(pickle_path)))
+            from_staged, _, dedupe_staged_mb = peak(lambda: tag_courseid(load_courses(staged_path)))
+            assert from_pickle == from_staged
+        server.shutdown()
+        server.server_close()
+        print(f"{subjects:>8} | {count:>7} | {pickle_mb:>9.1f} | {staged_mb:>9.1f} | {pickle_s:>8.2f} | {staged_s:>8.2f} | {dedupe_pickle_mb:>16.1f} | {dedupe_staged_mb:>16.1f}")
+
+def get_arguments():
+    '''
+    Sets up the command line flags for each benchmark.
+    '''
+    parser = argparse.ArgumentParser(description="Benchmarks for the recommendation engine")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    similarity = subparsers.add_parser("similarity", help="dense cosine matrix vs sparse top-k engine")
+    similarity.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000, 16000])
+    similarity.add_argument("--queries", type=int, default=50)
+    similarity.add_argument("--max-dense", type=int, default=16000, help="largest N for which the dense matrix is built")
+    similarity.set_defaults(func=bench_similarity)
+
+    ann = subparsers.add_parser("ann", help="recall and latency of the approximate nearest neighbor index vs the exact engine")
+    ann.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000])
+    ann.add_argument("--database", help="also measure the nlpformat rows of the Spring 2023 term in this database file")
+    ann.add_argument("--dimensions", type=int, default=128)
+    ann.add_argument("--lists", type=int, help="inverted lists (default: square root of the number of courses)")
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 32])
+    ann.add_argument("--rerank", type=int, nargs="+", default=[0, 100], help="candidates re-scored with the exact tf-idf rows; 0 ranks in the reduced space only")
+    ann.add_argument("--queries", type=int, default=200)
+    ann.set_defaults(func=bench_ann)
+
+    neighbors = subparsers.add_parser("neighbors", help="precomputing every neighbor list: block size and worker processes")
+    neighbors.add_argument("--sizes", type=int, nargs="+", default=[10000, 40000])
+    neighbors.add_argument("--block-sizes", type=int, nargs="+", default=[256, 1024])
+    neighbors.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    neighbors.set_defaults(func=bench_neighbors)
+
+    multi_seed = subparsers.add_parser("multi-seed", help="recommendations seeded from 1-20 courses: per-seed scoring vs one centroid product")
+    multi_seed.add_argument("--sizes", type=int, nargs="+", default=[5000, 40000])
+    multi_seed.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 5, 10, 20])
+    multi_seed.add_argument("--repeat", type=int, default=50)
+    multi_seed.set_defaults(func=bench_multi_seed)
+
+    crosslist = subparsers.add_parser("crosslist", help="one similarity index row per course vs one per cross-listing group")
+    crosslist.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000])
+    crosslist.add_argument("--queries", type=int, default=500)
+    crosslist.set_defaults(func=bench_crosslist)
+
+    demand_split = subparsers.add_parser("demand-split", help="most/least demanded split as the demand table grows")
+    demand_split.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    demand_split.add_argument("--repeat", type=int, default=5)
+    demand_split.set_defaults(func=bench_demand_split)
+
+    demand_series = subparsers.add_parser("demand-series", help="bulk loading daily demand samples; page demand from raw samples vs precomputed rollups")
+    demand_series.add_argument("--sizes", type=int, nargs="+", default=[2000, 20000, 100000])
+    demand_series.add_argument("--days", type=int, default=8, help="daily samples per course")
+    demand_series.add_argument("--repeat", type=int, default=200)
+    demand_series.set_defaults(func=bench_demand_series)
+
+    search = subparsers.add_parser("search", help="LIKE scan vs full-text index as the catalog grows")
+    search.add_argument("--sizes", type=int, nargs="+", default=[2000, 20000, 100000])
+    search.add_argument("--repeat", type=int, default=5)
+    search.set_defaults(func=bench_search)
+
+    suggest = subparsers.add_parser("suggest", help="typeahead prefix index latency")
+    suggest.add_argument("--sizes", type=int, nargs="+", default=[4000, 40000, 200000])
+    suggest.add_argument("--queries", type=int, default=5000)
+    suggest.add_argument("--checks", type=int, default=200, help="queries whose suggestions are submitted to the search")
+    suggest.set_defaults(func=bench_suggest)
+
+    cache = subparsers.add_parser("cache", help="response cache hit rate and page latency for popular courses")
+    cache.add_argument("--database", default="database.sqlite", help="database with the Spring 2023 term; its similarity index is built if needed")
+    cache.add_argument("--requests", type=int, default=2000)
+    cache.add_argument("--capacities", type=int, nargs="+", default=[0, 64, 256, 1024])
+    cache.set_defaults(func=bench_cache)
+
+    build = subparsers.add_parser("build", help="per-row ORM inserts vs bulk loading")
+    build.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000, 50000])
+    build.set_defaults(func=bench_build)
+
+    demand_resolve = subparsers.add_parser("demand-resolve", help="course id lookup by course code and for the daily demand samples: list scan vs dict index")
+    demand_resolve.set_defaults(func=bench_demand_resolve)
+
+    normalize = subparsers.add_parser("normalize", help="description cleaning and tokenizing: serial vs cached, parallel and memoized")
+    normalize.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    normalize.add_argument("--changed", type=int, default=5, help="percent of descriptions changed for the memoized rebuild")
+    normalize.set_defaults(func=bench_normalize)
+
+    index_update = subparsers.add_parser("index-update", help="full tf-idf and neighbor rebuild vs incremental update")
+    index_update.add_argument("--sizes", type=int, nargs="+", default=[2000, 4000, 8000, 16000])
+    index_update.add_argument("--changes", type=int, default=10, help="number of changed courses, one removed and one added among them")
+    index_update.set_defaults(func=bench_index_update)
+
+    scrape = subparsers.add_parser("scrape", help="pull_courses.py against a local stub API: sequential vs thread pool")
+    scrape.add_argument("--subjects", type=int, default=30)
+    scrape.add_argument("--latency", type=float, default=0.02, help="seconds the stub waits before each answer")
+    scrape.add_argument("--workers", type=int, nargs="+", default=[4, 8, 16])
+    scrape.add_argument("--failure-rate", type=float, default=0.05)
+    scrape.add_argument("--edited", type=int, default=2, help="percent of subjects changed before the revalidating pull")
+    scrape.set_defaults(func=bench_scrape)
+
+    ingest = subparsers.add_parser("ingest", help="peak memory of pulling a term: one pickle vs a streamed JSON Lines staging file")
+    ingest.add_argument("--subjects", type=int, nargs="+", default=[25, 100, 200])
+    ingest.add_argument("--courses", type=int, default=10, help="courses per (school, subject)")
+    ingest.add_argument("--description-bytes", type=int, default=1000)
+    ingest.add_argument("--workers", type=int, default=8)
+    ingest.set_defaults(func=bench_ingest)
+
+    return parser.parse_args()
+
+def main():
+    '''Runs the selected benchmark.
+    '''
+    args = get_arguments()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
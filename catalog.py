@@ -0,0 +1,103 @@
+import numpy as np
+
+from connections import query_all
+
+
+class CourseCatalog:
+    '''
+    In-memory lookup tables for course titles, codes, departments and cross-listing groups, indexed by courseid.
+
+    The similarity index holds one row per group, under its group id, so a course is looked up in it
+    through groupids, and the group codes are what a recommendation of the group is shown as. Every
+    title is also given a number, in title_ids, so recommendations can be deduplicated by title.
+    '''
+
+    def __init__(self, courseids, titles, codes, deptnames, groupids):
+        size = max(courseids) + 1 if courseids else 0
+
+        self.titles = np.full(size, None, dtype=object)
+        self.codes = np.full(size, None, dtype=object)
+        self.deptnames = np.full(size, None, dtype=object)
+        self.groupids = np.full(size, -1, dtype=np.int64)
+        self.group_codes = np.full(size, None, dtype=object)
+        self.title_ids = np.full(size, -1, dtype=np.int32)
+
+        self.titles[courseids] = titles
+        self.codes[courseids] = codes
+        self.deptnames[courseids] = deptnames
+        self.groupids[courseids] = groupids
+
+        # The first courseid with each title, as returned by get_courseid().
+        self.courseid_by_title = {}
+        title_numbers = {}
+        member_codes = {}
+        member_titles = {}
+        for courseid, title, code, groupid in zip(courseids, titles, codes, groupids):
+            self.courseid_by_title.setdefault(title, courseid)
+            self.title_ids[courseid] = title_numbers.setdefault(title, len(title_numbers))
+            member_codes.setdefault(groupid, []).append(code)
+            member_titles.setdefault(groupid, set()).add(int(self.title_ids[courseid]))
+
+        # The codes of every member of a group, in courseid order, e.g. "AFST 629/GLBL 619".
+        for groupid, group in member_codes.items():
+            self.group_codes[groupid] = '/'.join(group)
+
+        # The title numbers of every member of a group, which its recommendations never repeat.
+        self.group_title_ids = {groupid: sorted(group) for groupid, group in member_titles.items()}
+
+    def __len__(self):
+        return len(self.courseid_by_title)
+
+    def get_courseid(self, coursetitle):
+        '''
+        Returns the lowest course id with the given title, or None if there is none.
+        '''
+        return self.courseid_by_title.get(coursetitle)
+
+    def get_coursetitle(self, courseid):
+        '''
+        Returns the title of the course with the given id, or None if the term has no course with that id.
+        '''
+        if not 0 <= courseid < len(self.titles):
+            return None
+        return self.titles[courseid]
+
+    def get_group_title_ids(self, groupid):
+        '''
+        Returns the title numbers of the courses of a group, or an empty list if there is no such group.
+        '''
+        return self.group_title_ids.get(groupid, [])
+
+    def get_groupid(self, courseid):
+        '''
+        Returns the group id of the course with the given id, or None if the term has no course with that id.
+        '''
+        if not 0 <= courseid < len(self.groupids) or self.groupids[courseid] < 0:
+            return None
+        return int(self.groupids[courseid])
+
+
+def load_terms():
+    '''
+    Returns the term codes of all courses in the courses table, oldest first.
+    '''
+
+    query_string = "SELECT DISTINCT term FROM courses ORDER BY term"
+    return [row[0] for row in query_all(query_string)]
+
+def load_catalog(term):
+    '''
+    Loads the title, code, department and cross-listing group of every course of a term from the courses table.
+
+        Parameters:
+            term: The term code.
+
+        Returns:
+            catalog: A CourseCatalog for all courses of the term.
+    '''
+
+    query_string = "SELECT courseid, title, fullcode, deptname, groupid FROM courses WHERE term = ? ORDER BY courseid"
+    rows = query_all(query_string, [term])
+
+    courseids = [row[0] for row in rows]
+    return CourseCatalog(courseids, [row[1] for row in rows], [row[2] for row in rows], [row[3] for row in rows], [row[4] for row in rows])
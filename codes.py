@@ -141,4 +141,15 @@ SCHOOLS = {
     "FS": "School of the Environment",
     "SU": "Summer Session",
     "YC": "Yale College"
-}
\ No newline at end of file
+}
+
+# The last two digits of a six-digit term code, e.g. 202301 for Spring 2023.
+SEASONS = {
+    "01": "Spring",
+    "02": "Summer",
+    "03": "Fall"
+}
+
+def get_term_name(term):
+    """Returns the name of a term code, e.g. "Spring 2023" for 202301."""
+    return f"{SEASONS.get(term[4:], term[4:])} {term[:4]}"
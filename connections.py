@@ -0,0 +1,160 @@
+import os, threading, time
+from contextlib import closing
+from sqlite3 import connect
+
+DB_PATH = 'file:database.sqlite'
+
+# Set DB_IMMUTABLE=1 only when the database file is never rewritten while the web app runs;
+# SQLite then skips all locking, but it will not notice a rebuild.
+IMMUTABLE = os.environ.get('DB_IMMUTABLE') == '1'
+
+CACHED_STATEMENTS = 256
+READ_PRAGMAS = [
+    "PRAGMA query_only = ON",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -32768",
+]
+
+_local = threading.local()
+_generation = 0
+
+
+class QueryStats:
+    '''
+    Counts the connections opened and the queries run, with their total time, for one request.
+    '''
+
+    def __init__(self):
+        self.opens = 0
+        self.queries = 0
+        self.seconds = 0.0
+
+    def server_timing(self):
+        '''
+        Returns the stats formatted as a Server-Timing header value.
+        '''
+        return f'db;dur={self.seconds * 1000:.3f};desc="{self.queries} queries, {self.opens} opens"'
+
+
+def configure(db_path):
+    '''
+    Points every later connection at a different database and makes each thread reopen its connection.
+
+        Parameters:
+            db_path: A sqlite URI such as 'file:database.sqlite'.
+
+        Returns:
+            none
+    '''
+    global DB_PATH, _generation
+    DB_PATH = db_path
+    _generation += 1
+
+def get_data_version():
+    '''
+    Returns a value that changes whenever the database is written to, for caches of data read from it.
+
+    It is the modification time and size of the database file and of its write-ahead log, which
+    every commit of a build or incremental update changes, and changes as well after configure().
+
+        Parameters:
+            none
+
+        Returns:
+            version: A tuple that compares equal as long as the database is unchanged.
+    '''
+    path = DB_PATH[len('file:'):] if DB_PATH.startswith('file:') else DB_PATH
+    path = path.split('?', 1)[0]
+
+    version = [_generation]
+    for name in (path, path + '-wal'):
+        try:
+            stat = os.stat(name)
+            version += [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            version += [None, None]
+    return tuple(version)
+
+def get_stats():
+    '''
+    Returns the QueryStats of the current thread, creating them if needed.
+    '''
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        stats = _local.stats = QueryStats()
+    return stats
+
+def reset_stats():
+    '''
+    Starts a new QueryStats for the current thread, e.g. at the start of a request, and returns it.
+    '''
+    _local.stats = QueryStats()
+    return _local.stats
+
+def get_connection():
+    '''
+    Returns the read-only connection of the current thread, opening it on first use.
+
+    Connections stay open for the life of the thread, so the page cache, memory map and
+    prepared statement cache are reused across requests. A connection is reopened after
+    configure() is called or when the process has forked.
+
+        Parameters:
+            none
+
+        Returns:
+            connection: An sqlite3 connection opened with mode=ro.
+    '''
+    key = (os.getpid(), _generation)
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.key == key:
+        return connection
+
+    uri = DB_PATH + ('&' if '?' in DB_PATH else '?') + 'mode=ro'
+    if IMMUTABLE:
+        uri += '&immutable=1'
+
+    connection = connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    for pragma in READ_PRAGMAS:
+        connection.execute(pragma)
+
+    _local.connection, _local.key = connection, key
+    get_stats().opens += 1
+    return connection
+
+def query_all(query, params=()):
+    '''
+    Executes a query on the thread's connection and returns all rows.
+
+        Parameters:
+            query: The query to execute.
+            params: The values to bind to the placeholders in the query.
+
+        Returns:
+            results: list of tuples fetched from executing the query.
+    '''
+    connection = get_connection()
+    start = time.perf_counter()
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(query, params)
+        results = cursor.fetchall()
+
+    stats = get_stats()
+    stats.queries += 1
+    stats.seconds += time.perf_counter() - start
+    return results
+
+def query_one(query, params=()):
+    '''
+    Executes a query on the thread's connection and returns the first row, or None if there is none.
+    '''
+    connection = get_connection()
+    start = time.perf_counter()
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+
+    stats = get_stats()
+    stats.queries += 1
+    stats.seconds += time.perf_counter() - start
+    return row
@@ -1,20 +1,22 @@
-import csv, pickle
+import argparse, csv, hashlib, inspect, itertools, json, os, pickle, time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from dotenv import load_dotenv
-from table import Base, SpringDemand, SpringCourses, NLPFormat
+from table import Base, Courses, Demand, DemandSeries, Neighbors, NLPFormat
 from sqlite3 import connect as sqlite_connect
-from sqlalchemy import create_engine
+from sqlalchemy import Integer, bindparam, create_engine, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 from codes import DEPARTMENTS
 from io import StringIO 
 from html.parser import HTMLParser
+from functools import lru_cache
 
 from nltk.stem import WordNetLemmatizer
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 import re 
 
-STOPWORDS = set(stopwords.words('english'))
 MIN_WORDS = 1
 MAX_WORDS = 1500
 
@@ -22,88 +24,363 @@ PATTERN_S = re.compile("\'s")  # matches `'s` from text
 PATTERN_RN = re.compile("\\r\\n") # matches `\r` and `\n`
 PATTERN_PUNC = re.compile(r"[^\w\s]") # matches all non 0-9 A-z whitespace 
 
-load_dotenv()
+# The three patterns above in one pass. `'s` is listed first so it wins over the punctuation
+# class at the same position, as when the patterns were applied one after another.
+PATTERN_CLEAN = re.compile("|".join([PATTERN_S.pattern, PATTERN_RN.pattern, PATTERN_PUNC.pattern]))
 
-S23_DEMAND = "/Users/zhaoamyx/Desktop/CPSC437/Final/db_final/course_csv/full_spring_demand.csv"
+PATTERN_INTEGER = re.compile(r"\s*[+-]?\d+\s*") # text that SQLite stores as an integer in an INTEGER column
 
-def tag_courseid():
+LEMMA_CACHE_SIZE = 1 << 16
+TOKENIZE_CHUNK = 256
 
-    with open('spring_courses', 'rb') as fp:
-        all_schools = pickle.load(fp)
+# The staging file written by pull_courses.py if it has been run, else the pickle shipped with the repository.
+S23_STAGING = "spring_courses.jsonl"
+S23_COURSES = S23_STAGING if os.path.exists(S23_STAGING) else "spring_courses"
+DATABASE = "database.sqlite"
 
-    counter = 0
-    flat_list = [course for school in all_schools for course in school]
+# The CourseTable export of each term: a courses CSV that maps its ids to section codes such as
+# "HPM 500 01", and a demand CSV with the daily (id, date, count) samples of the shopping period.
+# Terms without one get no demand rows.
+DEMAND = {
+    "202203": ("course_csv/courses_fall22.csv", "course_csv/demand_fall22.csv"),
+    "202301": ("course_csv/courses_spring23.csv", "course_csv/demand_spring23.csv"),
+}
 
-    seen = []
-    final_list = []
+# Written by an incremental build, see update_database().
+CHANGESET = "changeset.json"
+
+# Outputs of the pipeline stages are cached here, see run_pipeline().
+CACHE_DIR = "build_cache"
+
+# The database is rebuilt from scratch if a build fails, so the build skips the rollback journal and fsyncs.
+BUILD_PRAGMAS = ["PRAGMA journal_mode=OFF", "PRAGMA synchronous=OFF"]
+
+# Created after the tables are loaded, which is cheaper than updating them on every insert.
+SECONDARY_INDEXES = [
+    "CREATE INDEX ix_courses_title ON courses (term, title)",
+    "CREATE INDEX ix_courses_groupid ON courses (term, groupid)",
+    "CREATE INDEX ix_demand_coursecode ON demand (term, coursecode)",
+]
+
+@lru_cache(maxsize=None)
+def get_stopwords():
+    '''
+    Returns the English stopwords of NLTK, reading the corpus on first use.
+    '''
+    return frozenset(stopwords.words('english'))
+
+def read_staging(path):
+    '''
+    Yields the courses of a JSON Lines staging file written by pull_courses.py, one line at a time.
+    '''
+
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+def load_courses(path=S23_COURSES):
+    '''
+    Reads the courses pulled by pull_courses.py.
+
+    A JSON Lines staging file is not read into memory: its courses are streamed into the dedupe
+    stage, which keeps only the first course with each subjectNumber. Any other file is unpickled.
 
-    for course in flat_list:
-        if course["subjectNumber"] not in seen:
-            final_list.append(course)
-            seen.append(course["subjectNumber"])
+        Parameters:
+            path: The staging file, or the pickle written by pull_courses.py --pickle.
+
+        Returns:
+            all_schools: List with one iterable of course dictionaries per school.
+    '''
 
-    for c in final_list:
-        c["courseId"] = counter
-        counter += 1
+    if path.endswith('.jsonl'):
+        return [read_staging(path)]
+
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
+
+def tag_courseid(all_schools):
+    '''
+    Flattens the courses of all schools, keeps the first course with each subjectNumber in each term and numbers
+    them. Each term is numbered from 0, so a course is identified by its termCode and courseId.
+
+        Parameters:
+            all_schools: List with one iterable of course dictionaries per school, as returned by load_courses().
+
+        Returns:
+            final_list: List of course dictionaries with a courseId.
+    '''
+
+    seen = set()
+    counters = {}
+    final_list = []
+
+    for school in all_schools:
+        for course in school:
+            if (course["termCode"], course["subjectNumber"]) not in seen:
+                course = dict(course)
+                course["courseId"] = counters.get(course["termCode"], 0)
+                counters[course["termCode"]] = course["courseId"] + 1
+                final_list.append(course)
+                seen.add((course["termCode"], course["subjectNumber"]))
 
     return final_list
 
-COURSE_LIST = tag_courseid()
+def bulk_insert(sql_session, table, rows):
+    '''
+    Inserts rows into a table with a single executemany instead of one ORM object per row.
+
+        Parameters:
+            sql_session: The session that is responsible for creating the database.
+            table: The mapped class of the table, e.g. Courses.
+            rows: List of dictionaries that map column names to values.
+
+        Returns:
+            none
+    '''
+
+    if rows:
+        sql_session.execute(table.__table__.insert(), rows)
+
+def upsert(sql_session, table, rows):
+    '''
+    Inserts rows into a table, replacing the rows that have the same primary key.
+
+        Parameters:
+            sql_session: The session that is responsible for updating the database.
+            table: The mapped class of the table, e.g. Courses.
+            rows: List of dictionaries that map column names to values.
+
+        Returns:
+            none
+    '''
 
-def populate_courses(sql_session):
+    if rows:
+        statement = sqlite_insert(table.__table__)
+        key = [column.name for column in table.__table__.primary_key]
+        columns = {column.name: statement.excluded[column.name] for column in table.__table__.columns if column.name not in key}
+        sql_session.execute(statement.on_conflict_do_update(index_elements=key, set_=columns), rows)
 
+def get_group_ids(course_list):
     '''
-    Adds all courses from all schools to the springcourses table in the database.
+    Finds the cross-listing groups of the courses. Two courses of a term are in the same group if one lists
+    the subjectNumber of the other in its primXLst or scndXLst, and groups that share a course are merged.
+    Titles are not compared: courses such as "Senior Essay" or "Directed Reading" are offered by many
+    departments, often with the same boilerplate description, without being cross-listed.
 
         Parameters:
+            course_list: List of course dictionaries with their final courseId.
+
+        Returns:
+            group_ids: Dictionary from the (termCode, courseId) of each course to the lowest courseId in its group.
+    '''
+
+    parents = {}
+    by_number = {}
+    for course in course_list:
+        key = (course["termCode"], course["courseId"])
+        parents[key] = key
+        by_number.setdefault((course["termCode"], course["subjectNumber"]), key)
+
+    def find(key):
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    for course in course_list:
+        key = (course["termCode"], course["courseId"])
+        for other in [by_number.get((course["termCode"], number)) for number in [course.get("primXLst")] + list(course.get("scndXLst") or [])]:
+            if other is not None:
+                root, other_root = find(key), find(other)
+                parents[max(root, other_root)] = min(root, other_root)
+
+    return {key: find(key)[1] for key in parents}
+
+def get_course_rows(course_list):
+    '''
+    Returns the courses rows of the courses as dictionaries.
+    '''
+    group_ids = get_group_ids(course_list)
+    rows = []
+    for course in course_list:
+        rows.append(dict(term=course['termCode'], courseid=course["courseId"], fullcode=course["subjectCode"] + ' ' + course["courseNumber"], deptcode=course['department'], subcode=course["subjectCode"], deptname=DEPARTMENTS.get(course['department']), coursenum=course['courseNumber'], title=course['courseTitle'], description=course['description'], school=course['schoolDescription'], groupid=group_ids[(course['termCode'], course["courseId"])]))
+
+    return rows
+
+def populate_courses(course_list, sql_session):
+
+    '''
+    Adds all courses from all schools and terms to the courses table in the database.
+
+        Parameters:
+            course_list: List of course dictionaries returned by the pipeline stages.
             sql_session: The session that is responsible for creating the database.
 
         Returns:
             none
     '''
 
-    for course in COURSE_LIST:
-        new_course = SpringCourses(term=course['termCode'], courseid=course["courseId"], fullcode=course["subjectCode"] + ' ' + course["courseNumber"], deptcode=course['department'], subcode=course["subjectCode"], deptname=DEPARTMENTS[course['department']], coursenum=course['courseNumber'], title=course['courseTitle'], description=course['description'], school=course['schoolDescription'])
-        sql_session.add(new_course)
+    bulk_insert(sql_session, Courses, get_course_rows(course_list))
+
+def index_courses(course_list):
+    '''
+    Returns a dictionary from (termCode, subjectCode, courseNumber) to courseId. If two courses share a key,
+    the first one in course_list is kept.
+
+        Parameters:
+            course_list: List of course dictionaries tagged by tag_courseid().
+
+        Returns:
+            course_index: Dictionary from (term, subject code, course number) tuples to course ids.
+    '''
+
+    course_index = {}
+    for course in course_list:
+        course_index.setdefault((course["termCode"], course["subjectCode"], course["courseNumber"]), course["courseId"])
+
+    return course_index
+
+def get_sample_date(term, month_day):
+    '''
+    Returns the ISO date of a demand sample dated "MM/DD". Samples from July on for a spring term were taken
+    the year before, e.g. 11/20 for Spring 2023 is 2022-11-20.
+    '''
+    month, day = (int(part) for part in month_day.split('/'))
+    year = int(term[:4]) - (1 if term.endswith("01") and month >= 7 else 0)
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+def read_course_codes(path):
+    '''
+    Reads a CourseTable courses CSV, whose rows map an id to the code of one section, e.g. "HPM 500 01".
+
+        Parameters:
+            path: The courses CSV of a term.
+
+        Returns:
+            codes: Dictionary from CourseTable ids to lists of (subject code, course number, name) tuples,
+                   one per cross-listing.
+    '''
+
+    codes = {}
+    with open(path, newline='') as fp:
+        for row in csv.DictReader(fp):
+            subject, number = row["code"].split()[:2]
+            codes.setdefault(row["id"], []).append((subject, number, row["name"]))
+
+    return codes
+
+def resolve_demand(demand_rows, codes, course_index, term):
+    '''
+    Matches each daily sample of a CourseTable demand CSV to the course ids of its sections in a single pass over the rows.
+
+    A cross-listed CourseTable id counts toward every course it is listed under. Samples of different
+    ids of the same course on the same day, e.g. of its sections, are added up.
+
+        Parameters:
+            demand_rows: Iterable of dictionaries with the id, date and count of each sample.
+            codes: Dictionary returned by read_course_codes().
+            course_index: Dictionary returned by index_courses().
+            term: The term code of the demand CSV.
+
+        Returns:
+            series: Dictionary from (courseid, ISO date) to the demand of the course on that day.
+            names: Dictionary from courseid to the (coursecode, coursetitle) it was first matched with.
+    '''
+
+    series = {}
+    names = {}
+    matched = {}
 
-    sql_session.commit()
+    for row in demand_rows:
+        if row["id"] not in matched:
+            courseids = matched[row["id"]] = []
+            for subject, number, name in codes.get(row["id"], []):
+                courseid = course_index.get((term, subject, number))
+                if courseid is not None and courseid not in courseids:
+                    courseids.append(courseid)
+                    names.setdefault(courseid, (subject + ' ' + number, name))
 
-def get_courseid(subject_code, course_number):
+        date = get_sample_date(term, row["date"])
+        for courseid in matched[row["id"]]:
+            series[(courseid, date)] = series.get((courseid, date), 0) + int(row["count"])
 
-    for course in COURSE_LIST:
-        if subject_code == course["subjectCode"] and course_number == course["courseNumber"]:
-            return course["courseId"]
+    return series, names
+
+def get_series_rows(course_list, term, courses_path, demand_path):
+    '''
+    Returns the demandseries rows of one term as dictionaries, in (courseid, date) order.
+
+        Parameters:
+            course_list: List of course dictionaries returned by the pipeline stages.
+            term: The term code.
+            courses_path: The CourseTable courses CSV of the term.
+            demand_path: The CourseTable demand CSV of the term, with one (id, date, count) row per course and day.
+
+        Returns:
+            series_rows: List of dictionaries.
+            names: Dictionary from courseid to (coursecode, coursetitle), as returned by resolve_demand().
+    '''
+
+    with open(demand_path, newline='') as fp:
+        series, names = resolve_demand(csv.DictReader(fp), read_course_codes(courses_path), index_courses(course_list), term)
+
+    series_rows = [dict(term=term, courseid=courseid, date=date, count=count) for (courseid, date), count in sorted(series.items())]
+    return series_rows, names
+
+def get_demand_rows(series_rows, names):
+    '''
+    Returns the demand rows of one term as dictionaries: the rollups of the daily samples of each course.
+
+    coursedemand is the last sample, peakdemand the highest one and demandgrowth the change from the
+    first sample to the last, over the shopping period.
+
+        Parameters:
+            series_rows: List of demandseries rows in (courseid, date) order, as returned by get_series_rows().
+            names: Dictionary from courseid to (coursecode, coursetitle).
+
+        Returns:
+            rows: List of dictionaries.
+    '''
 
-def create_demand_dict():
+    rows = []
+    for (term, courseid), samples in itertools.groupby(series_rows, key=lambda row: (row["term"], row["courseid"])):
+        counts = [sample["count"] for sample in samples]
+        coursecode, coursetitle = names[courseid]
+        rows.append(dict(term=term, courseid=courseid, coursecode=coursecode, coursetitle=coursetitle, coursedemand=counts[-1], peakdemand=max(counts), demandgrowth=counts[-1] - counts[0]))
 
-    with open(S23_DEMAND, 'r') as spring_demand:
-        all_course_demand = csv.reader(spring_demand)
-        all_course_demand = list(all_course_demand)
-        del all_course_demand[0]
-        all_course_copy = all_course_demand
+    return rows
 
-    full_dict = []
+def get_all_demand_rows(course_list, demand_paths):
+    '''
+    Returns the demandseries and demand rows of every term that has demand CSVs, as dictionaries.
 
-    for course in all_course_copy:
-        courseid = get_courseid(course[3], course[4])
-        full_dict.append({ "courseid": courseid, "coursecode": course[3] + ' ' + course[4], "coursetitle": course[8], "coursedemand": course[11]})
+        Parameters:
+            course_list: List of course dictionaries returned by the pipeline stages.
+            demand_paths: Dictionary from term codes to the (courses CSV, demand CSV) of the term.
 
-    return full_dict
+        Returns:
+            series_rows: List of demandseries dictionaries, term by term.
+            demand_rows: List of demand dictionaries, term by term.
+    '''
 
-def populate_demand(demand_dict, sql_session):
+    series_rows = []
+    demand_rows = []
+    for term, (courses_path, demand_path) in sorted(demand_paths.items()):
+        term_series, names = get_series_rows(course_list, term, courses_path, demand_path)
+        series_rows.extend(term_series)
+        demand_rows.extend(get_demand_rows(term_series, names))
 
-    seen_ids = []
+    return series_rows, demand_rows
 
-    for count, course in enumerate(demand_dict):
-        if (count + 1 < len(demand_dict)) and (course["courseid"] != None) and course["courseid"] not in seen_ids:
-            next = demand_dict[count + 1]
-            if course["coursecode"] != next["coursecode"]:
-                # print("Course ID: ", course["courseid"], "Course Title: ", course["coursetitle"])
-                new_demand = SpringDemand(courseid=course["courseid"], coursecode=course["coursecode"], coursetitle=course["coursetitle"], coursedemand=course["coursedemand"])
-                seen_ids.append(course["courseid"])
-                sql_session.add(new_demand)
+def populate_demand(course_list, demand_paths, sql_session):
+    '''
+    Loads the daily demand samples into demandseries and their rollups into demand, each with one executemany.
+    '''
 
-    sql_session.commit()
+    series_rows, demand_rows = get_all_demand_rows(course_list, demand_paths)
+    bulk_insert(sql_session, DemandSeries, series_rows)
+    bulk_insert(sql_session, Demand, demand_rows)
 
 class MLStripper(HTMLParser):
     def __init__(self):
@@ -122,73 +399,606 @@ def strip_tags(html):
     s.feed(html)
     return s.get_data()
 
-def strip_all_tags():
-    for course in COURSE_LIST:
+def strip_all_tags(course_list):
+    '''
+    Returns copies of the courses with the HTML tags removed from each description.
+    '''
+    stripped = []
+    for course in course_list:
+        course = dict(course)
         if course["description"] != None:
             course["description"] = strip_tags(course["description"])
+        stripped.append(course)
 
-    return COURSE_LIST
-
-COURSE_LIST = strip_all_tags()
+    return stripped
 
 def clean_text(text):
-    text = text.lower()
-    text = re.sub(PATTERN_S, ' ', text)
-    text = re.sub(PATTERN_RN, ' ', text)
-    text = re.sub(PATTERN_PUNC, ' ', text)
-    return text
+    return PATTERN_CLEAN.sub(' ', text.lower())
 
-def tokenizer(sentence, min_words=MIN_WORDS, max_words=MAX_WORDS, stopwords=STOPWORDS, lemmatize=True):
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    '''
+    Returns the WordNetLemmatizer of this process, created on first use.
+    '''
+    return WordNetLemmatizer()
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize_token(token):
+    '''
+    Returns the lemma of a token. Course descriptions repeat most of their vocabulary, so the
+    lemmas are cached for every sentence tokenized by this process.
+    '''
+    return get_lemmatizer().lemmatize(token)
+
+def tokenizer(sentence, min_words=MIN_WORDS, max_words=MAX_WORDS, stopwords=None, lemmatize=True):
+    if stopwords is None:
+        stopwords = get_stopwords()
     if lemmatize:
-        stemmer = WordNetLemmatizer()
-        tokens = [stemmer.lemmatize(w) for w in word_tokenize(sentence)]
+        tokens = [lemmatize_token(w) for w in word_tokenize(sentence)]
     else:
         tokens = [w for w in word_tokenize(sentence)]
 
     tokens = [w for w in tokens if (len(w) > min_words and len(w) < max_words and w not in stopwords)]
     return tokens 
 
-def clean_data():
-    for course in COURSE_LIST:
+def clean_data(course_list):
+    '''
+    Returns copies of the courses with the lowercased, punctuation-free description in cleansentence.
+    '''
+    cleaned = []
+    for course in course_list:
+        course = dict(course)
         if course["description"] != None:
             course["cleansentence"] = clean_text(course["description"])
-            course["toklemsentence"] = tokenizer(course["cleansentence"], min_words=MIN_WORDS, max_words=MAX_WORDS, stopwords=STOPWORDS, lemmatize=True)
         else:
             course["cleansentence"] = ''
-            course["toklemsentence"] = ''
+        cleaned.append(course)
+
+    return cleaned
 
-    return COURSE_LIST
+def get_text_hash(text):
+    '''
+    Returns the sha256 hex digest of a string.
+    '''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def tokenize_sentences(sentences):
+    '''
+    Tokenizes a chunk of cleaned sentences. Runs in the worker processes of tokenize_data().
+    '''
+    return [tokenizer(sentence, min_words=MIN_WORDS, max_words=MAX_WORDS, lemmatize=True) for sentence in sentences]
+
+def tokenize_data(course_list, workers=1, memo=None):
+    '''
+    Returns copies of the courses with the lemmatized tokens of cleansentence in toklemsentence.
+
+    Each distinct sentence is tokenized once, in chunks of TOKENIZE_CHUNK spread over a pool of
+    worker processes. Sentences whose hash is already in memo are not tokenized again.
+
+        Parameters:
+            course_list: List of course dictionaries returned by clean_data().
+            workers: The number of worker processes; 1 tokenizes in this process.
+            memo: Dictionary from hashes of cleaned sentences to their tokens, e.g. from the last build, or None.
+                  It is updated in place to hold the sentences of this course list only.
+
+        Returns:
+            tokenized: List of course dictionaries.
+    '''
+
+    memo = {} if memo is None else memo
+    hashes = [get_text_hash(course["cleansentence"]) if course["description"] != None else None for course in course_list]
+
+    pending = {}
+    for text_hash, course in zip(hashes, course_list):
+        if text_hash is not None and text_hash not in memo:
+            pending[text_hash] = course["cleansentence"]
+
+    sentences = list(pending.values())
+    chunks = [sentences[i:i + TOKENIZE_CHUNK] for i in range(0, len(sentences), TOKENIZE_CHUNK)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(tokenize_sentences, chunks))
+    else:
+        results = [tokenize_sentences(chunk) for chunk in chunks]
 
-COURSE_LIST = clean_data()
+    tokens = {text_hash: memo[text_hash] for text_hash in hashes if text_hash in memo}
+    tokens.update(zip(pending, (sentence_tokens for chunk in results for sentence_tokens in chunk)))
+    memo.clear()
+    memo.update(tokens)
 
-def populate_nlp_data(sql_session):
-    for course in COURSE_LIST:
+    tokenized = []
+    for text_hash, course in zip(hashes, course_list):
+        course = dict(course)
+        course["toklemsentence"] = list(tokens[text_hash]) if text_hash is not None else ''
+        tokenized.append(course)
+
+    return tokenized
+
+def get_nlp_format_rows(course_list):
+    '''
+    Returns the nlpformat rows of the courses as dictionaries.
+    '''
+    rows = []
+    for course in course_list:
         if course["toklemsentence"] != '':
             converted_tl = '|'.join(course["toklemsentence"])
         else:
             converted_tl = ''
-        new_nlp_data = NLPFormat(courseid=course["courseId"], cleansentence=course["cleansentence"], tokenlemmasentence=converted_tl)
-        sql_session.add(new_nlp_data)
+        rows.append(dict(term=course["termCode"], courseid=course["courseId"], cleansentence=course["cleansentence"], tokenlemmasentence=converted_tl))
 
-    sql_session.commit()
+    return rows
 
-if __name__ == "__main__":
+def populate_nlp_data(course_list, sql_session):
+
+    bulk_insert(sql_session, NLPFormat, get_nlp_format_rows(course_list))
+
+def populate_search_index(sql_session):
+    '''
+    Builds the coursesearch full-text index over the code, title and description of every course, with or without demand.
+
+        Parameters:
+            sql_session: The session that is responsible for creating the database.
+
+        Returns:
+            none
+    '''
+
+    sql_session.execute(text("DROP TABLE IF EXISTS coursesearch"))
+    sql_session.execute(text("CREATE VIRTUAL TABLE coursesearch USING fts5(term UNINDEXED, courseid UNINDEXED, coursecode, coursetitle, description, prefix='1 2 3')"))
+    sql_session.execute(text("INSERT INTO coursesearch (term, courseid, coursecode, coursetitle, description) SELECT s.term, s.courseid, s.fullcode, s.title, s.description FROM courses s"))
+    sql_session.execute(text("INSERT INTO coursesearch (coursesearch) VALUES ('optimize')"))
+
+def update_search_index(sql_session, keys):
+    '''
+    Replaces the coursesearch rows of the given courses with their current code, title and description.
 
+        Parameters:
+            sql_session: The session that is responsible for updating the database.
+            keys: The (term, courseid) pairs of the courses that were added, changed or removed in courses.
+
+        Returns:
+            none
+    '''
+
+    courseids = {}
+    for term, courseid in keys:
+        courseids.setdefault(term, []).append(courseid)
+
+    ids = bindparam('ids', expanding=True)
+    for term, term_ids in courseids.items():
+        sql_session.execute(text("DELETE FROM coursesearch WHERE term = :term AND courseid IN :ids").bindparams(ids), {'term': term, 'ids': term_ids})
+        sql_session.execute(text("INSERT INTO coursesearch (term, courseid, coursecode, coursetitle, description) SELECT s.term, s.courseid, s.fullcode, s.title, s.description FROM courses s WHERE s.term = :term AND s.courseid IN :ids").bindparams(ids), {'term': term, 'ids': term_ids})
+
+def create_secondary_indexes(sql_session):
+    '''
+    Creates the indexes in SECONDARY_INDEXES once the tables are loaded.
+    '''
+
+    for index in SECONDARY_INDEXES:
+        sql_session.execute(text(index))
+
+def create_session(database):
+    '''
+    Returns an engine for the SQLite database file, creating the file if needed, and a session bound to it.
+    '''
     engine = create_engine(
         'sqlite://',
         creator=lambda: sqlite_connect(
-            'file:' + 'database.sqlite' + '?mode=rwc', uri=True
+            'file:' + database + '?mode=rwc', uri=True
         )
     )
 
     Session = sessionmaker(bind=engine)
-    session = Session()
+    return engine, Session()
+
+def persist(course_list, database=DATABASE, demand_paths=DEMAND):
+    '''
+    Creates the database from the output of the pipeline stages, replacing any existing tables.
+
+    Every table is loaded in one transaction, then the database is switched to WAL so that
+    readers, which open it read-only, can keep reading while a later build writes.
+
+        Parameters:
+            course_list: List of course dictionaries returned by the last stage in STAGES.
+            database: The path of the SQLite database file.
+            demand_paths: Dictionary from term codes to the (courses CSV, demand CSV) of the term.
+
+        Returns:
+            none
+    '''
+
+    engine, session = create_session(database)
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
 
-    populate_courses(session)
-    demand_dict = create_demand_dict()
-    populate_demand(demand_dict, session)
-    populate_nlp_data(session)
+    for pragma in BUILD_PRAGMAS:
+        session.execute(text(pragma))
+
+    populate_courses(course_list, session)
+    populate_demand(course_list, demand_paths, session)
+    populate_nlp_data(course_list, session)
+    populate_search_index(session)
+    create_secondary_indexes(session)
+    session.commit()
+
+    session.execute(text("PRAGMA journal_mode=WAL"))
+    session.execute(text("PRAGMA synchronous=NORMAL"))
+    session.commit()
+    session.close()
+    engine.dispose()
+
+def assign_courseids(course_list, known_ids):
+    '''
+    Returns copies of the courses numbered with the ids they already have in the database, so a course
+    keeps its id across builds. New courses are numbered after the highest id that was ever in use in their term.
+
+        Parameters:
+            course_list: List of course dictionaries returned by the pipeline stages.
+            known_ids: Dictionary from the (term, fullcode) of each course in courses to its courseid.
+
+        Returns:
+            numbered: List of course dictionaries.
+    '''
+
+    next_ids = {}
+    for (term, _), courseid in known_ids.items():
+        next_ids[term] = max(next_ids.get(term, 0), courseid + 1)
+
+    numbered = []
+    for course in course_list:
+        course = dict(course)
+        key = (course["termCode"], course["subjectCode"] + ' ' + course["courseNumber"])
+        if key in known_ids:
+            course["courseId"] = known_ids[key]
+        else:
+            course["courseId"] = next_ids.get(key[0], 0)
+            next_ids[key[0]] = course["courseId"] + 1
+        numbered.append(course)
+
+    return numbered
+
+def get_row_hash(row, columns):
+    '''
+    Returns a hash of the values of a row in the given table columns.
+
+    Integer-looking text in an INTEGER column is hashed as the number SQLite stores (coursenum
+    "060" is read back as 60), so a row hashes the same before it is inserted and after.
+    '''
+    digest = hashlib.sha256()
+    for column in columns:
+        value = row[column.name]
+        if isinstance(column.type, Integer) and isinstance(value, str) and PATTERN_INTEGER.fullmatch(value):
+            value = int(value)
+        digest.update(b'\x00' if value is None else str(value).encode('utf-8') + b'\x1f')
+
+    return digest.hexdigest()
+
+def diff_table(sql_session, table, rows):
+    '''
+    Compares the content hash of each row of a table with the hash of its new row.
+
+        Parameters:
+            sql_session: The session that is responsible for updating the database.
+            table: The mapped class of the table.
+            rows: List of dictionaries with the new rows of the table.
+
+        Returns:
+            added: Sorted list of the primary keys, e.g. (term, courseid) pairs, that are only in rows.
+            updated: Sorted list of the primary keys whose row changed.
+            removed: Sorted list of the primary keys that are only in the table.
+    '''
+
+    columns = list(table.__table__.columns)
+    key = [column.name for column in table.__table__.primary_key]
+    old_hashes = {tuple(row[name] for name in key): get_row_hash(row, columns) for row in sql_session.execute(table.__table__.select()).mappings()}
+    new_hashes = {tuple(row[name] for name in key): get_row_hash(row, columns) for row in rows}
+
+    added = sorted(new_hashes.keys() - old_hashes.keys())
+    removed = sorted(old_hashes.keys() - new_hashes.keys())
+    updated = sorted(key for key in new_hashes.keys() & old_hashes.keys() if new_hashes[key] != old_hashes[key])
+
+    return added, updated, removed
+
+def get_group_rows(sql_session, term):
+    '''
+    Returns the (groupid, cleansentence) rows of a term that its similarity index is built from, see indexbuilder.GROUP_ROWS_QUERY.
+    '''
+    from indexbuilder import GROUP_ROWS_QUERY
+
+    return sql_session.execute(text(GROUP_ROWS_QUERY), {'term': term}).all()
+
+def get_group_changes(from_rows, to_rows):
+    '''
+    Compares the group rows of a term before and after an update.
+
+        Parameters:
+            from_rows: List of (groupid, cleansentence) rows returned by get_group_rows() before the update.
+            to_rows: The rows after the update.
+
+        Returns:
+            term_changes: Dictionary with the sorted added, updated and removed lists of groupids, and the
+                          from_hash and to_hash content hashes of the rows, which name the similarity index artifacts.
+    '''
+    from indexbuilder import get_content_hash
+
+    before, after = dict(from_rows), dict(to_rows)
+    return dict(
+        added=sorted(after.keys() - before.keys()),
+        updated=sorted(groupid for groupid in after.keys() & before.keys() if after[groupid] != before[groupid]),
+        removed=sorted(before.keys() - after.keys()),
+        from_hash=get_content_hash(from_rows),
+        to_hash=get_content_hash(to_rows),
+    )
+
+def update_database(course_list, database=DATABASE, demand_paths=DEMAND, changeset_path=CHANGESET):
+    '''
+    Brings an existing database up to date with the output of the pipeline stages, writing only the rows that changed.
+
+    Courses keep their ids, matched on the term and course code. Each table is diffed by the content
+    hash of its rows; new and changed rows are upserted, rows of courses that are gone are deleted,
+    and only the coursesearch rows of those courses are replaced. Everything runs in one transaction.
+
+    The change set is written to changeset_path as JSON. For every term, "terms" holds the added,
+    updated and removed lists of the cross-listing groups whose row in the similarity index changed,
+    and from_hash and to_hash, the content hashes of the term's group rows before and after, so the
+    similarity index of each term can refresh only those groups, see get_group_changes().
+
+        Parameters:
+            course_list: List of course dictionaries returned by the last stage in STAGES.
+            database: The path of the SQLite database file.
+            demand_paths: Dictionary from term codes to the (courses CSV, demand CSV) of the term.
+            changeset_path: The file to write the change set to.
+
+        Returns:
+            changeset: The change set as a dictionary, with the (term, courseid) pairs changed in every table under "tables".
+    '''
+
+    engine, session = create_session(database)
+
+    known_ids = {(term, fullcode): courseid for term, fullcode, courseid in session.execute(text("SELECT term, fullcode, courseid FROM courses")).all()}
+    course_list = assign_courseids(course_list, known_ids)
+    terms = sorted({term for term, _ in known_ids} | {course["termCode"] for course in course_list})
+    from_rows = {term: get_group_rows(session, term) for term in terms}
+
+    series_rows, demand_rows = get_all_demand_rows(course_list, demand_paths)
+    tables = [
+        (Courses, get_course_rows(course_list)),
+        (Demand, demand_rows),
+        (DemandSeries, series_rows),
+        (NLPFormat, get_nlp_format_rows(course_list)),
+    ]
+
+    changes = {}
+    for table, rows in tables:
+        key = [column.name for column in table.__table__.primary_key]
+        added, updated, removed = diff_table(session, table, rows)
+        changed = set(added) | set(updated)
+        upsert(session, table, [row for row in rows if tuple(row[name] for name in key) in changed])
+        if removed:
+            session.execute(table.__table__.delete().where(tuple_(*table.__table__.primary_key).in_(removed)))
+        changes[table.__tablename__] = {"added": added, "updated": updated, "removed": removed}
+
+    searched = set()
+    for keys in changes["courses"].values():
+        searched.update(tuple(key) for key in keys)
+    update_search_index(session, sorted(searched))
+
+    # The recommendations of a term whose courses changed are out of date until indexbuilder.py --neighbors writes them again.
+    stale_terms = sorted({key[0] for name in ("courses", "nlpformat") for keys in changes[name].values() for key in keys})
+    Neighbors.__table__.create(session.connection(), checkfirst=True)
+    session.execute(Neighbors.__table__.delete().where(Neighbors.term.in_(stale_terms)))
+
+    term_changes = {term: get_group_changes(from_rows[term], get_group_rows(session, term)) for term in terms}
+
+    changeset = dict(terms=term_changes, tables=changes)
+    session.commit()
+    session.close()
+    engine.dispose()
+
+    with open(changeset_path, 'w') as fp:
+        json.dump(changeset, fp)
+
+    return changeset
+
+# The stages between loading the staged courses and persisting them, in order. Each entry is the
+# stage name, the function that computes its output from the previous output, the helpers whose
+# source code also determines the output, the settings it depends on, and whether the function
+# takes the workers and memo arguments of tokenize_data().
+STAGES = [
+    ("dedupe", tag_courseid, [], (), False),
+    ("strip", strip_all_tags, [MLStripper, strip_tags], (), False),
+    ("clean", clean_data, [clean_text, PATTERN_CLEAN], (), False),
+    ("tokenize", tokenize_data, [tokenize_sentences, tokenizer, lemmatize_token], (MIN_WORDS, MAX_WORDS), True),
+]
+
+def get_file_hash(path):
+    '''
+    Returns the sha256 hex digest of the contents of a file.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def get_stage_key(upstream_key, stage):
+    '''
+    Returns the cache key of a stage's output: a hash of the key of its input, its source code and its settings.
+
+        Parameters:
+            upstream_key: The key of the previous stage, or the hashes of the staged courses for the first stage.
+            stage: An entry of STAGES.
+
+        Returns:
+            key: Hex digest of a sha256 hash.
+    '''
+
+    name, function, helpers, settings, _ = stage
+    digest = hashlib.sha256(upstream_key.encode('utf-8'))
+    for part in [function] + helpers:
+        digest.update(part.pattern.encode('utf-8') if isinstance(part, re.Pattern) else inspect.getsource(part).encode('utf-8'))
+    digest.update(repr(settings).encode('utf-8'))
+
+    return digest.hexdigest()
+
+def get_cache_path(cache_dir, name, key):
+    '''
+    Returns the file that caches the output of the named stage for the given key.
+    '''
+    return os.path.join(cache_dir, f"{name}-{key[:16]}.pkl")
+
+def write_cache(cache_dir, name, key, output):
+    '''
+    Pickles a stage output to the cache and removes the older outputs of the same stage.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_cache_path(cache_dir, name, key)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        pickle.dump(output, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(name + '-') and file_name.endswith('.pkl') and os.path.join(cache_dir, file_name) != path:
+            os.remove(os.path.join(cache_dir, file_name))
+
+def get_memo_path(cache_dir, stage):
+    '''
+    Returns the file that holds the per-sentence results of a stage from the last build.
+
+    The key covers the source code and settings of the stage but not its input, so the results
+    of sentences that did not change are reused when other courses did.
+    '''
+    return os.path.join(cache_dir, f"memo-{stage[0]}-{get_stage_key('', stage)[:16]}.pkl")
+
+def read_memo(cache_dir, stage):
+    '''
+    Returns the per-sentence results of a stage from the last build, or an empty dictionary.
+    '''
+    if cache_dir is None or not os.path.exists(get_memo_path(cache_dir, stage)):
+        return {}
+    with open(get_memo_path(cache_dir, stage), 'rb') as fp:
+        return pickle.load(fp)
+
+def write_memo(cache_dir, stage, memo):
+    '''
+    Saves the per-sentence results of a stage for the next build and removes those of older versions of the stage.
+    '''
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_memo_path(cache_dir, stage)
+    with open(path + '.tmp', 'wb') as fp:
+        pickle.dump(memo, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+    prefix = f"memo-{stage[0]}-"
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(prefix) and file_name.endswith('.pkl') and os.path.join(cache_dir, file_name) != path:
+            os.remove(os.path.join(cache_dir, file_name))
+
+def run_pipeline(courses_paths=(S23_COURSES,), cache_dir=CACHE_DIR, from_stage=None, stop_after=None, workers=1):
+    '''
+    Runs the stages in STAGES on the staged courses and returns the output of the last one that ran.
+
+    The output of every stage is cached under a key derived from the staged courses and the
+    source code of that stage and all stages before it. Only the stages after the last cached
+    output are run, so after editing one stage only it and the stages after it are recomputed.
+    The tokenize stage also keeps the tokens of every sentence, so when it reruns on new input
+    only the descriptions that changed since the last build are tokenized.
+
+        Parameters:
+            courses_paths: The staging files or pickles written by pull_courses.py, e.g. one per term.
+            cache_dir: The directory of the cached stage outputs, or None to disable the cache.
+            from_stage: The name of the first stage to recompute even if its output is cached.
+            stop_after: The name of the last stage to run.
+            workers: The number of worker processes of the tokenize stage.
+
+        Returns:
+            course_list: List of course dictionaries.
+    '''
+
+    names = [stage[0] for stage in STAGES]
+    stages = STAGES[:names.index(stop_after) + 1] if stop_after else STAGES
+    first = names.index(from_stage) if from_stage else len(stages)
+
+    keys = []
+    key = "".join(get_file_hash(path) for path in courses_paths)
+    for stage in stages:
+        key = get_stage_key(key, stage)
+        keys.append(key)
+
+    # The last stage whose output can be read from the cache.
+    cached = -1
+    if cache_dir is not None:
+        for position in range(min(first, len(stages)) - 1, -1, -1):
+            if os.path.exists(get_cache_path(cache_dir, stages[position][0], keys[position])):
+                cached = position
+                break
+
+    if cached >= 0:
+        with open(get_cache_path(cache_dir, stages[cached][0], keys[cached]), 'rb') as fp:
+            output = pickle.load(fp)
+        print(f"{'load':>8}: skipped")
+        for name, _, _, _, _ in stages[:cached + 1]:
+            print(f"{name:>8}: cached")
+    else:
+        start = time.perf_counter()
+        output = [school for path in courses_paths for school in load_courses(path)]
+        print(f"{'load':>8}: {time.perf_counter() - start:.2f}s")
+
+    for position in range(cached + 1, len(stages)):
+        name, function, _, _, parallel = stages[position]
+        start = time.perf_counter()
+        if parallel:
+            memo = read_memo(cache_dir, stages[position])
+            output = function(output, workers=workers, memo=memo)
+            write_memo(cache_dir, stages[position], memo)
+        else:
+            output = function(output)
+        if cache_dir is not None:
+            write_cache(cache_dir, name, keys[position], output)
+        print(f"{name:>8}: {time.perf_counter() - start:.2f}s")
+
+    return output
+
+def get_arguments():
+    '''
+    Sets up the command line flags of the database build.
+    '''
+    names = [stage[0] for stage in STAGES]
+
+    parser = argparse.ArgumentParser(description="Builds the course database: load -> " + " -> ".join(names) + " -> persist")
+    parser.add_argument("--courses", nargs="+", default=[S23_COURSES], help="courses staged by pull_courses.py, as JSON Lines or pickles, e.g. one file per term")
+    parser.add_argument("--demand", nargs=3, action="append", metavar=("TERM", "COURSES_CSV", "DEMAND_CSV"), help="CourseTable courses and daily demand CSVs of a term; repeat for every term (default: the files in course_csv/)")
+    parser.add_argument("--database", default=DATABASE, help="SQLite database to create")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="directory of cached stage outputs")
+    parser.add_argument("--no-cache", action="store_true", help="run every stage without reading or writing the cache")
+    parser.add_argument("--from-stage", choices=names, help="recompute this stage and every stage after it")
+    parser.add_argument("--stop-after", choices=names, help="run the stages up to this one and do not persist")
+    parser.add_argument("--incremental", action="store_true", help="update only the changed rows of an existing database")
+    parser.add_argument("--changeset", default=CHANGESET, help="where an incremental build writes the changed courseids")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes for tokenizing")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    load_dotenv()
+    args = get_arguments()
+
+    start = time.perf_counter()
+    demand_paths = {term: (courses_path, demand_path) for term, courses_path, demand_path in args.demand} if args.demand else DEMAND
+    course_list = run_pipeline(args.courses, None if args.no_cache else args.cache_dir, args.from_stage, args.stop_after, args.workers)
+
+    if args.stop_after is None:
+        persist_start = time.perf_counter()
+        if args.incremental and os.path.exists(args.database):
+            changeset = update_database(course_list, args.database, demand_paths, args.changeset)
+            for name, table_changes in changeset["tables"].items():
+                print(f"{name:>14}: " + ", ".join(f"{len(courseids)} {kind}" for kind, courseids in table_changes.items()))
+        else:
+            persist(course_list, args.database, demand_paths)
+        print(f"{'persist':>8}: {time.perf_counter() - persist_start:.2f}s")
 
-    print("Done")
\ No newline at end of file
+    print(f"Done in {time.perf_counter() - start:.2f}s")
@@ -1,106 +1,126 @@
-from contextlib import closing
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
-from sqlite3 import connect
+import json, re
+import numpy as np
 
+from connections import query_all, query_one
 
-DB_PATH = 'file:database.sqlite'
+MAX_MATCHES = 100
 
-def get_matching(title_snip):
+def search_query(title_snip):
     '''
-        Returns a list of courses that are related to the inputted course.
+        Converts user input into a full-text query that matches every word of the input as a prefix.
 
         Parameters:
             title_snip: Inputted text that user seeks to find related courses for.
 
         Returns:
-            matching_courses: list of courses.
+            query: An FTS5 query string, or None if the input has no words.
     '''
-    courses = []
-    with connect(DB_PATH, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
-            v = '%' + title_snip + '%'
-            query_string = "SELECT courseid, coursecode, coursetitle from springdemand WHERE coursetitle LIKE ? ORDER BY coursecode"
-            cursor.execute(query_string, [v])
-            courses = cursor.fetchall()
-    matching_set = {}
-    matching_courses = []
-    for course in courses:
-        if course[2] not in matching_set:
-            modified_course = ([course[0]], course[1], course[2])
-            matching_courses.append(modified_course)
-            matching_set[course[2]] = len(matching_courses) - 1
-        else:
-            modified_ids = matching_courses[matching_set[course[2]]][0]
-            modified_ids.append(course[0])
-            modified_course_code = matching_courses[matching_set[course[2]]][1] + f"/{course[1]}"
-            matching_courses[matching_set[course[2]]] = (modified_ids, modified_course_code, matching_courses[matching_set[course[2]]][2])
-    return matching_courses
-
-def get_course_descriptions():
-    '''
-    Returns a list of course descriptions for all courses in the database.
+    words = re.findall(r"\w+", title_snip or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+# Collapses the courses in a matches table of (courseid, coursecode, coursetitle, groupid, position) into one row
+# per cross-listing group, in the position of its best match: the ids and codes of its matched courses in match
+# order, and the title of the best one.
+GROUP_MATCHES = "SELECT ids, codes, coursetitle FROM (SELECT group_concat(courseid) OVER members AS ids, group_concat(coursecode, '/') OVER members AS codes, coursetitle, position, ROW_NUMBER() OVER members AS member FROM matches WINDOW members AS (PARTITION BY groupid ORDER BY position ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)) WHERE member = 1 ORDER BY position"
+
+def get_matching(title_snip, term):
+    '''
+        Returns a list of courses of a term that are related to the inputted course.
+
+        Courses are matched on their code, title and description through the coursesearch full-text index,
+        best match first, up to MAX_MATCHES courses. The courses of a cross-listing group are merged into one entry
+        by the query, see GROUP_MATCHES.
 
         Parameters:
-            none
+            title_snip: Inputted text that user seeks to find related courses for.
+            term: The term code of the courses to search.
 
         Returns:
-            all_descriptions: List of strings, each of which is a course description.
+            matching_courses: list of (course ids, course codes joined by "/", title) tuples.
     '''
-    
-    all_descriptions = []
+    match_query = search_query(title_snip)
+    if match_query is None:
+        query_string = "WITH matches AS (SELECT courseid, fullcode AS coursecode, title AS coursetitle, groupid, ROW_NUMBER() OVER (ORDER BY fullcode, courseid) AS position FROM courses WHERE term = ?) " + GROUP_MATCHES
+        courses = query_all(query_string, [term])
+    else:
+        # Title matches weigh most, then course codes, then descriptions.
+        query_string = "WITH ranked AS (SELECT coursesearch.courseid, coursesearch.coursecode, coursesearch.coursetitle, s.groupid, bm25(coursesearch, 0.0, 0.0, 5.0, 10.0, 1.0) AS score FROM coursesearch JOIN courses s ON coursesearch.term = s.term AND coursesearch.courseid = s.courseid WHERE coursesearch MATCH ? AND coursesearch.term = ? ORDER BY score, coursesearch.coursecode LIMIT ?), matches AS (SELECT courseid, coursecode, coursetitle, groupid, ROW_NUMBER() OVER (ORDER BY score, coursecode) AS position FROM ranked) " + GROUP_MATCHES
+        courses = query_all(query_string, [match_query, term, MAX_MATCHES])
+
+    return [([int(courseid) for courseid in ids.split(',')], codes, coursetitle) for ids, codes, coursetitle in courses]
 
-    with connect(DB_PATH, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
-            query_string = "SELECT cleansentence from nlpformat"
-            cursor.execute(query_string)
+def get_course_descriptions(term):
+    '''
+    Returns a list of course descriptions for all courses of a term in the database.
 
-            row = cursor.fetchone()
-            while row is not None:
-                all_descriptions.append(row[0])
-                row = cursor.fetchone()
+        Parameters:
+            term: The term code.
+
+        Returns:
+            all_descriptions: List of strings, each of which is a course description.
+    '''
+
+    query_string = "SELECT cleansentence from nlpformat WHERE term = ? ORDER BY courseid"
+    all_descriptions = [row[0] for row in query_all(query_string, [term])]
 
     return all_descriptions
 
-def get_courseid(coursetitle):
+def get_courseid(coursetitle, term):
     '''
     Returns the course id for a given course title by querying the database.
 
         Parameters:
             coursetitle: The full title of the course to search.
+            term: The term code of the course.
 
         Returns:
             row[0]: The courseid corresponding to the title. 
     '''
 
-    with connect(DB_PATH, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
-            query_string = "SELECT courseid from springcourses WHERE title=?"
-            cursor.execute(query_string, [coursetitle])
+    query_string = "SELECT courseid from courses WHERE term=? AND title=?"
+    row = query_one(query_string, [term, coursetitle])
 
-            row = cursor.fetchone()
-            return row[0]
+    return row[0]
 
-def get_coursetitle(courseid):
+def get_coursetitle(courseid, term):
     '''
     Returns the course title for a given course id by querying the database.
     
         Parameters:
             courseid: The course id of the course to search.
+            term: The term code of the course.
         
         Returns:
             row[0]: The coursetitle corresponding to the id.
     
     '''
 
-    with connect(DB_PATH, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
-            query_string = "SELECT title from springcourses WHERE courseid=?"
-            cursor.execute(query_string, [courseid])
+    query_string = "SELECT title from courses WHERE term=? AND courseid=?"
+    row = query_one(query_string, [term, courseid])
 
-            row = cursor.fetchone()
+    return row[0]
 
-            return row[0]
+def fit_tfidf(course_descriptions):
+    '''
+    Fits a vectorizer for the term frequency-inverse document frequency of all course descriptions.
+
+        Parameters:
+            course_descriptions: A list of strings that contains all course descriptions.
+
+        Returns:
+            tfidf: The fitted TfidfVectorizer, which holds the vocabulary and idf weights.
+            tfidf_matrix: A transformed matrix for tfidf suitable for processing.
+    '''
+
+    # Imported here so web workers that only load a prebuilt index never import scikit-learn.
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    tfidf = TfidfVectorizer(stop_words='english')
+    tfidf_matrix = tfidf.fit_transform(course_descriptions)
+
+    return tfidf, tfidf_matrix
 
 def create_tfidf(course_descriptions):
     '''
@@ -113,8 +133,7 @@ def create_tfidf(course_descriptions):
             tfidf_matrix: A transformed matrix for tfidf suitable for processing.
     '''
 
-    tfidf = TfidfVectorizer(stop_words='english')
-    tfidf_matrix = tfidf.fit_transform(course_descriptions)
+    _, tfidf_matrix = fit_tfidf(course_descriptions)
 
     return tfidf_matrix
 
@@ -128,162 +147,307 @@ def create_cosine_matrix(tfidf_matrix):
         Returns:
             cosine_sim: A square similarity matrix for all courses with course descriptions.
     '''
+    from sklearn.metrics.pairwise import linear_kernel
+
     cosine_sim = linear_kernel(tfidf_matrix, tfidf_matrix)
     return cosine_sim
 
-def get_recommendations(coursetitle, cosine_sim):
+def get_recommendations(coursetitle, similarity_index, catalog):
     '''
     Gets a list of the top ten most similar courses to a given input course.
 
         Parameters:
             coursetitle: The title of the course to get recommendations for.
-            cosine_sim: The cosine similarity matrix.
+            similarity_index: The SimilarityIndex built from the tfidf matrix of the course's term, or the ANNIndex
+                              built from its reduced vectors; only get_row(), top_k() and courseids are used.
+            catalog: The CourseCatalog of the same term, used to look up the course's cross-listing group.
 
         Returns:
             course_names: List of dictionaries that represent the most similar courses to the one provided. 
     '''
-    idx = get_courseid(coursetitle)
-    sim_scores = list(enumerate(cosine_sim[idx]))
+    return get_group_recommendations(catalog.groupids[catalog.get_courseid(coursetitle)], similarity_index, catalog)
 
-    sim_scores.sort(key=lambda x: x[1], reverse=True)
+def get_group_recommendations(groupid, similarity_index, catalog):
+    '''
+    Gets the top ten cross-listing groups most similar to a given group, with ten different titles.
 
-    # Top 20 matching courses. 
-    top_scores = sim_scores[1:50]
+    The index holds one row per group, so every result is a different group and none of them is a
+    cross-listing of the course itself; each is identified by its group id, the lowest courseid in it.
+    Groups that are not cross-listed can still share a title, such as the "Senior Essay" of many
+    departments, so only the first group with each title is kept and the titles of the group itself are dropped.
 
-    course_names = []
-    seen_names = set()
-    seen_names.add(coursetitle)
-    for course in top_scores:
-        title = get_coursetitle(course[0])
-        if title not in seen_names:
-            c_dict = {}
-            c_dict["courseid"], c_dict["similarity_score"] = course[0], round(course[1], 5)
-            course_names.append(c_dict)
-            seen_names.add(title)
+        Parameters:
+            groupid: The group id of the course to get recommendations for.
+            similarity_index: The SimilarityIndex or ANNIndex of the course's term.
+            catalog: The CourseCatalog of the same term.
+
+        Returns:
+            course_names: List of dictionaries that represent the most similar courses, as returned by get_recommendations().
+    '''
+    row = similarity_index.get_row(groupid)
+    excluded_titles = catalog.get_group_title_ids(groupid)
 
-    return course_names[0:10]
+    # Many groups can share a title, so widen the candidates until ten titles are found or none are left.
+    k = 50
+    while True:
+        top_rows, top_scores = similarity_index.top_k(row, k)
+        kept = top_rows != row
+        course_names = first_per_title(similarity_index.courseids[top_rows[kept]], top_scores[kept], catalog, excluded_titles)
+        if len(course_names) == 10 or len(top_rows) < k:
+            return course_names
+        k *= 4
 
-def build_rec_table(course_names):
+def first_per_title(top_ids, top_scores, catalog, excluded_titles, count=10):
     '''
-        Builds the table of recommended courses by performing insert queries.
+    Keeps the first course with each title among ranked courses, dropping the courses with an excluded title.
 
         Parameters:
-            course_names: The names of the courses to add to the table.
-            
+            top_ids: Array of course ids, most similar first.
+            top_scores: Array of the matching similarity scores.
+            catalog: The CourseCatalog of the courses' term.
+            excluded_titles: List of the title numbers, from CourseCatalog.title_ids, to drop.
+            count: The number of courses to keep.
+
         Returns:
-            None
+            course_names: List of dictionaries with the courseid and similarity_score of each kept course.
     '''
-    
-    with connect(DB_PATH, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
+    title_ids = catalog.title_ids[top_ids]
+    _, first_positions = np.unique(title_ids, return_index=True)
+    first_positions.sort()
+    first_positions = first_positions[~np.isin(title_ids[first_positions], excluded_titles)][:count]
 
-            clean_up_query = "DROP TABLE IF EXISTS courserecs"
-            cursor.execute(clean_up_query)
+    course_names = []
+    for courseid, score in zip(top_ids[first_positions].tolist(), top_scores[first_positions].tolist()):
+        course_names.append({"courseid": courseid, "similarity_score": round(score, 5)})
+
+    return course_names
 
-            create_base_query = "CREATE TABLE courserecs (courseid INTEGER PRIMARY KEY, similarity NUMERIC(3, 5))"
-            cursor.execute(create_base_query)
+def get_multi_recommendations(courseids, similarity_index, catalog):
+    '''
+    Gets a list of the top ten courses most similar to a set of courses taken together, such as a student's schedule.
 
-            for c in course_names:
-                insert_query = f"INSERT INTO courserecs VALUES ({c['courseid']}, {c['similarity_score']})"
-                cursor.execute(insert_query)
+    The tf-idf rows of the groups of the seed courses are averaged into a centroid and every group is scored against
+    it at once. The groups of the seed courses, and so their cross-listings, are never recommended, nor is any
+    group with the title of a seed; of the groups that share a title, only the first is kept.
+
+        Parameters:
+            courseids: List of the course ids of the seed courses. Ids that are not in the term are ignored.
+            similarity_index: The SimilarityIndex or ANNIndex of the courses' term.
+            catalog: The CourseCatalog of the same term.
 
-def query_fetch_all_helper(query):
+        Returns:
+            course_names: List of dictionaries that represent the most similar courses, as returned by get_recommendations().
     '''
-        Executes a query and returns all the data that is fetched upon execution.
-    
+    groupids = {catalog.get_groupid(courseid) for courseid in courseids}
+    rows = sorted(row for row in (similarity_index.get_row(groupid) for groupid in groupids) if row is not None)
+    if not rows:
+        return []
+
+    seed_titles = sorted({title for groupid in groupids for title in catalog.get_group_title_ids(groupid)})
+    excluded = np.isin(catalog.title_ids[similarity_index.courseids], seed_titles)
+    excluded[rows] = True
+
+    # Many groups can share a title, so widen the candidates until ten titles are found or none are left.
+    k = 50
+    while True:
+        top_rows, top_scores = similarity_index.centroid_top_k(np.array(rows), k, excluded)
+        course_names = first_per_title(similarity_index.courseids[top_rows], top_scores, catalog, seed_titles)
+        if len(course_names) == 10 or len(top_rows) < k:
+            return course_names
+        k *= 4
+
+def get_batch_recommendations(courseids, similarity_index, catalog):
+    '''
+    Gets the recommendations of many courses of one term, as get_recommendations() does for the title of each.
+
+    Courses of the same cross-listing group share their recommendations, which are computed once.
+
         Parameters:
-            query: The query to execute.
-        
+            courseids: List of course ids.
+            similarity_index: The SimilarityIndex or ANNIndex of the courses' term.
+            catalog: The CourseCatalog of the same term.
+
         Returns:
-            results: list of tuples corresponding to the information fetched from executing the query.
+            recommendations: Dictionary from each course id to the list returned by get_recommendations(),
+                             or to None if the term has no course with that id.
     '''
-    with connect(DB_PATH, uri=True) as connection:
-        with(closing(connection.cursor())) as cursor:
-            cursor.execute(query)
-            results = cursor.fetchall()
-            return results
+    by_group = {}
+    recommendations = {}
+    for courseid in courseids:
+        groupid = catalog.get_groupid(courseid)
+        if groupid is None:
+            recommendations[courseid] = None
+            continue
+        if groupid not in by_group:
+            by_group[groupid] = get_group_recommendations(groupid, similarity_index, catalog)
+        recommendations[courseid] = by_group[groupid]
 
-def get_overall_demand():
+    return recommendations
+
+def get_stored_recommendations(courseids, term, catalog):
     '''
-        Executes a query that fetches the overall average demand of the related courses.
-        
+    Reads the recommendations of many courses of one term from the neighbors table written by indexbuilder.py --neighbors.
+
+    databasebuilder.py deletes the neighbors rows of a term whenever its courses change, so the rows that are
+    there were computed from the current similarity index of the term. Rows that repeat a title or hold a title
+    of the course's own group, as written before recommendations were deduplicated by title, are left out.
+
+        Parameters:
+            courseids: List of course ids.
+            term: The term code of the courses.
+            catalog: The CourseCatalog of the same term.
+
         Returns:
-            overall_age_demand: number.
+            recommendations: Dictionary from each course id that has neighbors rows to the list returned by
+                             get_recommendations(). Other course ids are left out.
     '''
-    with connect(DB_PATH, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
-            overall_avg_query = "SELECT AVG(d.coursedemand) FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid"
+    if query_one("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'neighbors'") is None:
+        return {}
 
-            cursor.execute(overall_avg_query)
+    query_string = (
+        "SELECT courseid, neighborid, similarity FROM neighbors "
+        "WHERE term = ? AND courseid IN (SELECT value FROM json_each(?)) ORDER BY courseid, rank")
+    recommendations = {}
+    for courseid, neighborid, similarity in query_all(query_string, [term, json.dumps(courseids)]):
+        recommendations.setdefault(courseid, []).append({"courseid": neighborid, "similarity_score": similarity})
 
-            row = cursor.fetchone()
-            overall_avg_demand = row[0]
-            overall_avg_demand = round(overall_avg_demand, 3)
+    for courseid, course_names in list(recommendations.items()):
+        top_ids = np.array([course["courseid"] for course in course_names])
+        top_scores = np.array([course["similarity_score"] for course in course_names])
+        if first_per_title(top_ids, top_scores, catalog, catalog.get_group_title_ids(catalog.get_groupid(courseid))) != course_names:
+            del recommendations[courseid]
 
-            return overall_avg_demand
+    return recommendations
 
-def sort_by_sim():
+def rec_table_clause(course_names):
     '''
-        Executes a query that fetches courses related to the selected source sorted by similarity in a descending order.
-        
+        Builds a WITH clause that exposes the recommended courses as a courserecs table for the length of one query.
+
+        The course ids and similarity scores are bound as parameters, so nothing is written to the database
+        and concurrent requests cannot see each other's recommendations.
+
+        Parameters:
+            course_names: List of dictionaries returned by get_recommendations().
+
         Returns:
-            results: list of courses and useful information, including courseid, title, demand, and similarity score.
+            clause: The WITH clause to put in front of a query that reads courserecs.
+            params: The values to bind to the placeholders in the clause.
     '''
-    sort_similarity_query = "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid ORDER BY similarity DESC"
-    sorted_by_similarity = query_fetch_all_helper(sort_similarity_query)
-    return sorted_by_similarity
+    if not course_names:
+        return "WITH courserecs(courseid, similarity) AS (SELECT NULL, NULL WHERE 0) ", []
 
-def sort_by_demand():
+    # Rows are listed in courseid order and whole-number scores are stored as integers, matching how the
+    # NUMERIC column of the old courserecs table returned them.
+    values = ', '.join(['(?, ?)'] * len(course_names))
+    clause = f"WITH courserecs(courseid, similarity) AS (VALUES {values}) "
+    params = []
+    for c in sorted(course_names, key=lambda c: c['courseid']):
+        score = c['similarity_score']
+        params += [c['courseid'], score if score % 1 else int(score)]
+
+    return clause, params
+
+def query_fetch_all_helper(query, course_names, params=()):
     '''
-        Executes a query that fetches courses related to the selected source sorted by demand in a descending order.
+        Executes a query over the recommended courses and returns all the data that is fetched upon execution.
+    
+        Parameters:
+            query: The query to execute. It may read the courserecs table.
+            course_names: List of dictionaries returned by get_recommendations().
+            params: The values to bind to the placeholders in the query, after those of the courserecs table.
         
         Returns:
-            results: list of courses and useful information, including courseid, title, demand, and similarity score.
+            results: list of tuples corresponding to the information fetched from executing the query.
     '''
-    sort_demand_query = "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid ORDER BY coursedemand DESC"
-    sorted_by_demand = query_fetch_all_helper(sort_demand_query)
-    return sorted_by_demand
+    clause, clause_params = rec_table_clause(course_names)
+
+    results = query_all(clause + query, clause_params + list(params))
+    return results
 
-def get_dept_demand():
+def get_rec_rows(course_names, term, catalog):
     '''
-        Executes a query that fetches information pertaining to the department's demand based on the demand of the courses that belong to the departments.
-        
+        Executes a single query that fetches the course and demand information for every recommended course.
+
+        Parameters:
+            course_names: List of dictionaries returned by get_recommendations().
+            term: The term code of the recommended courses.
+            catalog: The CourseCatalog of the same term, which holds the codes of every cross-listing group.
+
         Returns:
-            results: list of departments.
+            results: list of tuples of courseid, fullcode, title, description, demand, similarity score, department
+            name, peak demand and demand growth, in courseid order. The fullcode lists the codes of every course in the
+            recommended course's cross-listing group. The demand values are the rollups in the demand
+            table, not the daily samples.
     '''
-    avg_by_dept_query = "SELECT s.deptname, AVG(d.coursedemand) FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid GROUP BY s.deptname"
-    avg_demand_by_dept = query_fetch_all_helper(avg_by_dept_query)
-    return avg_demand_by_dept
+    rec_rows_query = "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity, s.deptname, d.peakdemand, d.demandgrowth FROM courserecs c LEFT JOIN courses s ON s.term = ? AND c.courseid = s.courseid LEFT JOIN demand d ON s.term = d.term AND s.courseid = d.courseid"
+    rec_rows = query_fetch_all_helper(rec_rows_query, course_names, [term])
+    return [row[:1] + (catalog.group_codes[row[0]] or row[1],) + row[2:] for row in rec_rows]
 
-def get_dept_count():
+def get_demand_series(courseid, term):
     '''
-        Executes a query that fetches information pertaining to the number of departments that the targeted courses belong to.
-        
+        Returns the daily demand samples of a course over the shopping period.
+
+        Parameters:
+            courseid: The course id.
+            term: The term code of the course.
+
         Returns:
-            results: list of departments.
+            series: list of (ISO date, count) tuples in date order, read with one range scan of the demandseries key.
     '''
-    count_query = "SELECT s.deptname, COUNT(*) FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid GROUP BY s.deptname"
-    course_count_by_dept = query_fetch_all_helper(count_query)
-    return course_count_by_dept
+    query_string = "SELECT date, count FROM demandseries WHERE term = ? AND courseid = ? ORDER BY date"
+    return query_all(query_string, [term, courseid])
 
-def get_popular_recs():
+def average(values):
     '''
-        Executes a query that fetches courses with highest demand.
-        
-        Returns:
-            results: list of courses.
+        Returns the average of the values that are not None, or None if there are none, like SQL AVG().
     '''
-    high_demand_query = "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid WHERE d.coursedemand > (SELECT AVG(d.coursedemand) FROM courserecs c LEFT JOIN springdemand d)"
-    high_demand_courses = query_fetch_all_helper(high_demand_query)
-    return high_demand_courses
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return sum(values) / len(values)
 
-def get_unpopular_recs():
+def summarize_recs(rec_rows):
     '''
-        Executes a query that fetches courses with lowest demand.
-        
+        Computes every table of the results page from the rows returned by get_rec_rows() in one pass.
+
+        Course rows are tuples of courseid, fullcode, title, description, demand, similarity score, peak demand and
+        demand growth, and
+        departments are listed in the order of SQL GROUP BY, as the results.html template expects. The most
+        and least demanded courses are those above and below the average demand of the recommended courses.
+
+        Parameters:
+            rec_rows: list of tuples returned by get_rec_rows().
+
         Returns:
-            results: list of courses.
+            summary: dictionary with the similarity_sorted, demand_sorted, avg_demand, dept_demand, dept_count,
+            most_demanded and least_demanded template values.
     '''
-    low_demand_query = "SELECT c.courseid, s.fullcode, s.title, s.description, d.coursedemand, c.similarity FROM courserecs c LEFT JOIN springcourses s ON c.courseid = s.courseid LEFT JOIN springdemand d ON s.courseid = d.courseid WHERE d.coursedemand < (SELECT AVG(d.coursedemand) FROM courserecs c LEFT JOIN springdemand d)"
-    low_demand_courses = query_fetch_all_helper(low_demand_query)
-    return low_demand_courses
+    courses = []
+    dept_demands = {}
+
+    for row in rec_rows:
+        course, deptname = row[:6] + row[7:9], row[6]
+        courses.append(course)
+        dept_demands.setdefault(deptname, []).append(course[4])
+
+    overall_avg_demand = average(course[4] for course in courses)
+
+    high_demand_courses = []
+    low_demand_courses = []
+    if overall_avg_demand is not None:
+        high_demand_courses = [course for course in courses if course[4] is not None and course[4] > overall_avg_demand]
+        low_demand_courses = [course for course in courses if course[4] is not None and course[4] < overall_avg_demand]
+        overall_avg_demand = round(overall_avg_demand, 3)
+
+    # SQL GROUP BY lists the NULL department first, then the rest in ascending order.
+    depts = sorted(dept_demands, key=lambda name: (name is not None, name or ''))
+
+    return {
+        'similarity_sorted': sorted(courses, key=lambda course: -course[5]),
+        'demand_sorted': sorted(courses, key=lambda course: (course[4] is None, -(course[4] or 0))),
+        'avg_demand': overall_avg_demand,
+        'dept_demand': [(dept, average(dept_demands[dept])) for dept in depts],
+        'dept_count': [(dept, len(dept_demands[dept])) for dept in depts],
+        'most_demanded': high_demand_courses,
+        'least_demanded': low_demand_courses,
+    }
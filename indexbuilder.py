@@ -0,0 +1,451 @@
+import argparse, hashlib, json, os, shutil, tempfile
+from sqlite3 import connect
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import connections
+from ann import ANNIndex, DIMENSIONS, NPROBE, RERANK, create_ann_index
+from catalog import load_catalog
+from connections import query_all
+from get_recommendations import fit_tfidf, get_batch_recommendations
+from similarity import NEIGHBORS, SimilarityIndex, UpdatableIndex, create_neighbor_table
+
+INDEX_DIR = 'similarity_index'
+FORMAT_VERSION = 2
+ANN_FORMAT_VERSION = 1
+
+ARRAY_FILES = ['data', 'indices', 'indptr', 'count_data', 'count_indices', 'count_indptr', 'courseids', 'neighbor_ids', 'neighbor_scores', 'idf']
+ANN_ARRAY_FILES = ['vectors', 'centroids', 'list_rows', 'list_offsets', 'courseids']
+
+def get_terms():
+    '''
+    Returns the term codes in the nlpformat table, oldest first.
+    '''
+
+    query_string = "SELECT DISTINCT term FROM nlpformat ORDER BY term"
+    return [row[0] for row in query_all(query_string)]
+
+# One row per cross-listing group of a term: the group id and the cleaned description of the member with the
+# longest one, the lowest courseid first among equals. Shared with databasebuilder.py, which diffs these rows.
+GROUP_ROWS_QUERY = "SELECT groupid, cleansentence FROM (SELECT c.groupid, n.cleansentence, ROW_NUMBER() OVER (PARTITION BY c.groupid ORDER BY length(n.cleansentence) DESC, n.courseid) AS member FROM nlpformat n JOIN courses c ON c.term = n.term AND c.courseid = n.courseid WHERE n.term = :term) WHERE member = 1 ORDER BY groupid"
+
+def get_nlp_rows(term):
+    '''
+    Returns the group ids and cleaned descriptions of the cross-listing groups of one term, which the
+    similarity index holds one row each for.
+
+        Parameters:
+            term: The term code.
+
+        Returns:
+            rows: List of (groupid, cleansentence) tuples ordered by groupid, see GROUP_ROWS_QUERY.
+    '''
+
+    return query_all(GROUP_ROWS_QUERY, {'term': term})
+
+def get_content_hash(rows):
+    '''
+    Returns a hash of the nlpformat rows that the similarity index is built from.
+
+        Parameters:
+            rows: List of (groupid, cleansentence) tuples returned by get_nlp_rows().
+
+        Returns:
+            content_hash: Hex digest of a sha256 hash over every row.
+    '''
+
+    digest = hashlib.sha256()
+    for courseid, sentence in rows:
+        digest.update(f"{courseid}\x1f{sentence or ''}\x1e".encode('utf-8'))
+
+    return digest.hexdigest()
+
+def get_artifact_path(term, content_hash, index_dir=INDEX_DIR):
+    '''
+    Returns the directory of the artifact built from the nlpformat rows of a term with the given hash.
+
+    Every term has its own artifact. The format version, the term and the content hash are part of
+    the directory name, so an artifact that does not match the database is never picked up.
+    '''
+
+    return os.path.join(index_dir, f"v{FORMAT_VERSION}-{term}-{content_hash[:16]}")
+
+def get_ann_path(term, content_hash, index_dir=INDEX_DIR):
+    '''
+    Returns the directory of the approximate nearest neighbor artifact built from the nlpformat rows of a term with the given hash.
+    '''
+
+    return os.path.join(index_dir, f"ann{ANN_FORMAT_VERSION}-{term}-{content_hash[:16]}")
+
+def write_artifact(artifact_path, arrays, documents, index_dir=INDEX_DIR):
+    '''
+    Writes the arrays and JSON documents of an artifact to a temporary directory and renames it into place,
+    so concurrent workers never see a partial artifact. If another process finished first, its artifact is kept.
+
+        Parameters:
+            artifact_path: The directory of the finished artifact.
+            arrays: Dictionary from file name, without the .npy extension, to numpy array.
+            documents: Dictionary from file name to a JSON-serializable value.
+            index_dir: The directory that holds all artifacts.
+
+        Returns:
+            artifact_path: The directory of the finished artifact.
+    '''
+
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.build-', dir=index_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    for name, document in documents.items():
+        with open(os.path.join(tmp_path, name), 'w') as fp:
+            json.dump(document, fp)
+
+    try:
+        os.rename(tmp_path, artifact_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(artifact_path):
+            raise
+
+    return artifact_path
+
+def save_index(similarity_index, term, content_hash, index_dir=INDEX_DIR, updates=0):
+    '''
+    Writes an UpdatableIndex to disk as the artifact for the nlpformat rows of a term with the given hash.
+
+        Parameters:
+            similarity_index: The UpdatableIndex to write. Removed courses are compacted away first.
+            term: The term code of the rows.
+            content_hash: The content hash of the nlpformat rows the index matches.
+            index_dir: The directory that holds all artifacts.
+            updates: The number of incremental updates applied since the last full build.
+
+        Returns:
+            artifact_path: The directory of the finished artifact.
+    '''
+
+    artifact_path = get_artifact_path(term, content_hash, index_dir)
+
+    similarity_index.refresh()
+    similarity_index.compact()
+    tfidf_matrix, counts = similarity_index.tfidf_matrix, similarity_index.counts
+
+    arrays = {
+        'data': tfidf_matrix.data,
+        'indices': tfidf_matrix.indices,
+        'indptr': tfidf_matrix.indptr,
+        'count_data': counts.data,
+        'count_indices': counts.indices,
+        'count_indptr': counts.indptr,
+        'courseids': similarity_index.courseids,
+        'neighbor_ids': similarity_index.neighbor_ids,
+        'neighbor_scores': similarity_index.neighbor_scores,
+        'idf': similarity_index.idf,
+    }
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'term': term,
+        'content_hash': content_hash,
+        'shape': list(tfidf_matrix.shape),
+        'neighbors': int(similarity_index.neighbor_ids.shape[1]),
+        'updates': updates,
+        'idf_drift': similarity_index.get_drift(),
+    }
+
+    vocabulary = {word: int(col) for word, col in similarity_index.vocabulary.items()}
+    return write_artifact(artifact_path, arrays, {'vocabulary.json': vocabulary, 'meta.json': meta}, index_dir)
+
+def build_index(rows, term, index_dir=INDEX_DIR, workers=1):
+    '''
+    Fits the tf-idf matrix and neighbor lists for the given rows of a term and writes them to disk.
+
+        Parameters:
+            rows: List of (groupid, cleansentence) tuples returned by get_nlp_rows().
+            term: The term code of the rows.
+            index_dir: The directory that holds all artifacts.
+            workers: The number of worker processes that score the neighbor lists.
+
+        Returns:
+            artifact_path: The directory of the finished artifact.
+    '''
+
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    sentences = [sentence for _, sentence in rows]
+    tfidf, tfidf_matrix = fit_tfidf(sentences)
+    tfidf_matrix = tfidf_matrix.tocsr()
+    neighbor_ids, neighbor_scores = create_neighbor_table(tfidf_matrix, NEIGHBORS, workers=workers)
+
+    # The raw counts behind the tf-idf matrix, so the index can be updated without refitting.
+    counts = CountVectorizer(stop_words='english', vocabulary=tfidf.vocabulary_).transform(sentences)
+
+    similarity_index = UpdatableIndex(tfidf_matrix, counts, tfidf.vocabulary_, tfidf.idf_, [courseid for courseid, _ in rows], neighbor_ids, neighbor_scores)
+    return save_index(similarity_index, term, get_content_hash(rows), index_dir)
+
+def read_meta(artifact_path):
+    '''
+    Returns the meta.json of an artifact as a dictionary.
+    '''
+
+    with open(os.path.join(artifact_path, 'meta.json')) as fp:
+        return json.load(fp)
+
+def open_index(artifact_path):
+    '''
+    Memory-maps an artifact read-only and wraps it in a SimilarityIndex.
+
+    The arrays are not copied, so every worker process shares the same pages of the page cache.
+
+        Parameters:
+            artifact_path: The directory of an artifact written by save_index().
+
+        Returns:
+            similarity_index: A SimilarityIndex backed by the memory-mapped arrays.
+    '''
+
+    meta = read_meta(artifact_path)
+    arrays = {name: np.load(os.path.join(artifact_path, name + '.npy'), mmap_mode='r') for name in ARRAY_FILES}
+    tfidf_matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']), copy=False)
+
+    return SimilarityIndex(tfidf_matrix, arrays['neighbor_ids'], arrays['neighbor_scores'], arrays['courseids'])
+
+def open_updatable_index(artifact_path):
+    '''
+    Loads an artifact into memory as an UpdatableIndex.
+
+        Parameters:
+            artifact_path: The directory of an artifact written by save_index().
+
+        Returns:
+            similarity_index: An UpdatableIndex with its own copy of the arrays.
+    '''
+
+    meta = read_meta(artifact_path)
+    arrays = {name: np.load(os.path.join(artifact_path, name + '.npy')) for name in ARRAY_FILES}
+    with open(os.path.join(artifact_path, 'vocabulary.json')) as fp:
+        vocabulary = json.load(fp)
+
+    shape = tuple(meta['shape'])
+    tfidf_matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape)
+    counts = csr_matrix((arrays['count_data'], arrays['count_indices'], arrays['count_indptr']), shape=shape)
+
+    return UpdatableIndex(tfidf_matrix, counts, vocabulary, arrays['idf'], arrays['courseids'], arrays['neighbor_ids'], arrays['neighbor_scores'])
+
+def update_index(term_changes, term, index_dir=INDEX_DIR, workers=1):
+    '''
+    Applies the changes to one term from a change set written by databasebuilder.update_database()
+    to the artifact they start from.
+
+    Only the changed courses are re-weighted and only the neighbor lists they can affect are
+    recomputed, see UpdatableIndex. If there is no artifact for the nlpformat rows before the
+    update, or the database has changed again since, the index is built from scratch.
+
+        Parameters:
+            term_changes: The entry of the term under "terms" in the change set.
+            term: The term code.
+            index_dir: The directory that holds all artifacts.
+            workers: The number of worker processes that score the neighbor lists if the index is built from scratch.
+
+        Returns:
+            artifact_path: The directory of the artifact for the current nlpformat rows of the term.
+    '''
+
+    rows = get_nlp_rows(term)
+    content_hash = get_content_hash(rows)
+    artifact_path = get_artifact_path(term, content_hash, index_dir)
+    if os.path.isdir(artifact_path):
+        return artifact_path
+
+    source_path = get_artifact_path(term, term_changes['from_hash'], index_dir)
+    if term_changes['to_hash'] != content_hash or not os.path.isdir(source_path):
+        return build_index(rows, term, index_dir, workers)
+
+    similarity_index = open_updatable_index(source_path)
+    sentences = dict(rows)
+    changes = {courseid: sentences[courseid] for courseid in term_changes['added'] + term_changes['updated']}
+    changes.update({courseid: None for courseid in term_changes['removed']})
+    affected = similarity_index.apply_changes(changes)
+
+    print(f"{term}: {len(changes)} changed courses, {len(affected)} neighbor lists recomputed, idf drift {similarity_index.get_drift():.4f}" + (" (re-weighting all courses)" if similarity_index.stale else ""))
+    return save_index(similarity_index, term, content_hash, index_dir, read_meta(source_path)['updates'] + 1)
+
+def load_index(term, index_dir=INDEX_DIR):
+    '''
+    Returns the SimilarityIndex of a term in the current database, building the artifact first if
+    the stored one was built from different nlpformat rows.
+
+        Parameters:
+            term: The term code.
+            index_dir: The directory that holds all artifacts.
+
+        Returns:
+            similarity_index: A SimilarityIndex backed by the memory-mapped artifact.
+    '''
+
+    rows = get_nlp_rows(term)
+    artifact_path = get_artifact_path(term, get_content_hash(rows), index_dir)
+
+    if not os.path.isdir(artifact_path):
+        artifact_path = build_index(rows, term, index_dir)
+
+    return open_index(artifact_path)
+
+def build_ann_index(similarity_index, term, content_hash, index_dir=INDEX_DIR, dimensions=DIMENSIONS, lists=None):
+    '''
+    Reduces the tf-idf matrix of a SimilarityIndex to dense vectors, clusters them and writes the
+    ANNIndex to disk as the approximate nearest neighbor artifact for the nlpformat rows of a term.
+
+        Parameters:
+            similarity_index: The SimilarityIndex of the term, as returned by load_index().
+            term: The term code of the rows.
+            content_hash: The content hash of the nlpformat rows the index matches.
+            index_dir: The directory that holds all artifacts.
+            dimensions: The number of dimensions to reduce the tf-idf rows to.
+            lists: The number of inverted lists, see create_ann_index().
+
+        Returns:
+            artifact_path: The directory of the finished artifact.
+    '''
+
+    ann_index = create_ann_index(similarity_index.tfidf_matrix, similarity_index.courseids, dimensions, lists)
+
+    arrays = {name: getattr(ann_index, name) for name in ANN_ARRAY_FILES}
+    meta = {
+        'format_version': ANN_FORMAT_VERSION,
+        'term': term,
+        'content_hash': content_hash,
+        'dimensions': int(ann_index.vectors.shape[1]),
+        'lists': len(ann_index.centroids),
+    }
+    return write_artifact(get_ann_path(term, content_hash, index_dir), arrays, {'meta.json': meta}, index_dir)
+
+def open_ann_index(artifact_path, similarity_index, nprobe=NPROBE, rerank=RERANK):
+    '''
+    Memory-maps an approximate nearest neighbor artifact read-only and wraps it in an ANNIndex that
+    re-scores its candidates with the tf-idf matrix of the given SimilarityIndex.
+    '''
+
+    arrays = {name: np.load(os.path.join(artifact_path, name + '.npy'), mmap_mode='r') for name in ANN_ARRAY_FILES}
+    return ANNIndex(arrays['vectors'], arrays['centroids'], arrays['list_rows'], arrays['list_offsets'], arrays['courseids'], nprobe, similarity_index.tfidf_matrix, rerank)
+
+def load_ann_index(term, index_dir=INDEX_DIR, nprobe=NPROBE, rerank=RERANK):
+    '''
+    Returns the ANNIndex of a term in the current database, building the artifacts first if the stored
+    ones were built from different nlpformat rows.
+
+        Parameters:
+            term: The term code.
+            index_dir: The directory that holds all artifacts.
+            nprobe: The number of inverted lists each query scans.
+            rerank: The number of candidates re-scored with the exact tf-idf rows, or 0 to rank in the reduced space only.
+
+        Returns:
+            ann_index: An ANNIndex backed by the memory-mapped artifacts.
+    '''
+
+    rows = get_nlp_rows(term)
+    content_hash = get_content_hash(rows)
+
+    artifact_path = get_artifact_path(term, content_hash, index_dir)
+    if not os.path.isdir(artifact_path):
+        artifact_path = build_index(rows, term, index_dir)
+    similarity_index = open_index(artifact_path)
+
+    ann_path = get_ann_path(term, content_hash, index_dir)
+    if not os.path.isdir(ann_path):
+        ann_path = build_ann_index(similarity_index, term, content_hash, index_dir)
+
+    return open_ann_index(ann_path, similarity_index, nprobe, rerank)
+
+def get_neighbor_rows(term, similarity_index, catalog):
+    '''
+    Returns the neighbors rows of a term as dictionaries: the recommendations of every course of the term, ranked from 1.
+    The courses of a cross-listing group have the same rows.
+
+        Parameters:
+            term: The term code.
+            similarity_index: The SimilarityIndex of the term.
+            catalog: The CourseCatalog of the term.
+
+        Returns:
+            rows: List of dictionaries.
+    '''
+
+    rows = []
+    recommendations = get_batch_recommendations(np.flatnonzero(catalog.groupids >= 0).tolist(), similarity_index, catalog)
+    for courseid, course_names in recommendations.items():
+        for rank, course in enumerate(course_names or [], 1):
+            rows.append(dict(term=term, courseid=courseid, rank=rank, neighborid=course["courseid"], similarity=course["similarity_score"]))
+
+    return rows
+
+def write_neighbors(term, rows):
+    '''
+    Replaces the neighbors rows of a term in the database that connections.py reads, in one transaction.
+    '''
+
+    # Imported here so web workers that only load an index never import SQLAlchemy.
+    from sqlalchemy import create_engine
+    from table import Neighbors
+
+    engine = create_engine('sqlite://', creator=lambda: connect(connections.DB_PATH, uri=True))
+    Neighbors.__table__.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(Neighbors.__table__.delete().where(Neighbors.term == term))
+        if rows:
+            connection.execute(Neighbors.__table__.insert(), rows)
+    engine.dispose()
+
+def remove_stale_artifacts(keep_paths, index_dir=INDEX_DIR):
+    '''
+    Deletes every artifact in index_dir except those in keep_paths.
+    '''
+
+    keep = {os.path.abspath(path) for path in keep_paths}
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if os.path.isdir(path) and os.path.abspath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+def get_arguments():
+    '''
+    Sets up the command line flags of the index build.
+    '''
+    parser = argparse.ArgumentParser(description="Builds the similarity index of every term in the current database")
+    parser.add_argument("--changeset", help="update the index with a change set written by databasebuilder.py --incremental instead of building it from scratch")
+    parser.add_argument("--keep", action="store_true", help="keep the artifacts of older databases")
+    parser.add_argument("--ann", action="store_true", help="also build the approximate nearest neighbor index of every term")
+    parser.add_argument("--dimensions", type=int, default=DIMENSIONS, help="dimensions of the approximate nearest neighbor vectors")
+    parser.add_argument("--lists", type=int, help="inverted lists of the approximate nearest neighbor index (default: square root of the number of courses)")
+    parser.add_argument("--neighbors", action="store_true", help="write the recommendations of every course to the neighbors table")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes for scoring the neighbor lists")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = get_arguments()
+    changeset = {'terms': {}}
+    if args.changeset:
+        with open(args.changeset) as fp:
+            changeset = json.load(fp)
+
+    paths = []
+    for term in get_terms():
+        if term in changeset['terms']:
+            artifact_path = update_index(changeset['terms'][term], term, workers=args.workers)
+        else:
+            artifact_path = build_index(get_nlp_rows(term), term, workers=args.workers)
+        paths.append(artifact_path)
+        print("Wrote", artifact_path)
+
+        if args.ann:
+            paths.append(build_ann_index(open_index(artifact_path), term, read_meta(artifact_path)['content_hash'], dimensions=args.dimensions, lists=args.lists))
+            print("Wrote", paths[-1])
+
+        if args.neighbors:
+            rows = get_neighbor_rows(term, open_index(artifact_path), load_catalog(term))
+            write_neighbors(term, rows)
+            print(f"Wrote {len(rows)} neighbors rows of {term}")
+
+    if not args.keep:
+        remove_stale_artifacts(paths)
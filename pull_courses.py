@@ -1,50 +1,159 @@
-import json, os, pickle, requests
+import argparse, hashlib, json, os, pickle, random, threading, time, requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
-from codes import SCHOOLS
+from codes import SCHOOLS, SEASONS
 from dotenv import load_dotenv
 from progressbar import progressbar
 
 load_dotenv()
 
-def get_courses(subj_code, term_code, school):
-    """Given subject code and term_code, get relevant courses"""
+# Set API_BASE to point the scraper at another server, e.g. a local stub.
+API_BASE = os.environ.get("API_BASE", "https://gw.its.yale.edu/soa-gateway")
+COURSES_PATH = "/courses/webservice/v3/index"
+SUBJECTS_PATH = "/course/webservice/v2/subjects"
+
+WORKERS = 8
+RATE_LIMIT = 20  # requests per second across all workers
+MAX_RETRIES = 5
+BACKOFF = 0.5  # seconds before the first retry, doubled after every attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The last response for every (term, school, subject) is cached here. An entry younger than CACHE_TTL
+# seconds is used without asking the API; an older one is revalidated with its ETag/Last-Modified.
+CACHE_DIR = "pull_cache"
+CACHE_TTL = 24 * 60 * 60
+
+# Courses are staged as JSON Lines, one course per line, and written STAGING_BATCH lines at a time.
+STAGING_PATH = "spring_courses.jsonl"
+STAGING_BATCH = 1000
+
+_local = threading.local()
+
+
+class RateLimiter:
     '''
-    Returns a list of courses formatted as dictionaries that meet the specified parameters of subject, term, and school.
+    Spaces out requests from all threads so that at most rate requests start per second.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Blocks until the calling thread may start its next request.
+        '''
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_limiter = RateLimiter(RATE_LIMIT)
+
+
+def configure(base_url=None, rate=None):
+    '''
+    Changes the server and the rate limit used by every later request.
 
         Parameters:
-            subj_code: The subject area that the course belongs to.
-            term_code: The term in which the course is offered in. 
-            school: The school in which the course is offered in. 
+            base_url: The base URL of the Yale Courses API, or None to keep the current one.
+            rate: The maximum requests per second, 0 for no limit, or None to keep the current one.
 
         Returns:
-            response_list: List of all courses in a specified subject, term, and school. 
+            none
+    '''
+    global API_BASE, _limiter
+    if base_url is not None:
+        API_BASE = base_url.rstrip('/')
+    if rate is not None:
+        _limiter = RateLimiter(rate)
+
+def get_session():
+    '''
+    Returns the requests.Session of the current thread, so each worker keeps its connection alive between requests.
     '''
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
 
+def fetch(path, parameters, headers=None):
+    '''
+    Sends a GET request to the API and returns the response.
+
+    Connection errors, timeouts and 429/5xx responses are retried up to MAX_RETRIES times with
+    exponential backoff and jitter, or after the delay in a Retry-After header.
+
+        Parameters:
+            path: The path of the endpoint below API_BASE.
+            parameters: The query string parameters.
+            headers: Extra request headers, e.g. If-None-Match.
+
+        Returns:
+            response: The requests.Response, with status 2xx or 304 Not Modified.
+    '''
+
+    for attempt in range(MAX_RETRIES + 1):
+        _limiter.wait()
+        try:
+            response = get_session().get(API_BASE + path, params=parameters, headers=headers, timeout=30)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            delay = BACKOFF * 2 ** attempt
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else BACKOFF * 2 ** attempt
+
+        time.sleep(delay * random.uniform(1, 1.5))
+
+def fetch_json(path, parameters):
+    '''
+    Sends a GET request to the API, retrying as fetch() does, and returns the decoded JSON body.
+    '''
+    return json.loads(fetch(path, parameters).text)
+
+def get_course_parameters(subj_code, term_code, school):
+    '''
+    Returns the query string parameters of the courses endpoint for one subject, term and school.
+    '''
+    parameters = {
+        "apikey": os.environ.get("API_KEY"),
+        "subjectCode": subj_code,
+        "mode": "json",
+        "school": school,
+    }
     if term_code is not None:
+        parameters["termCode"] = term_code
 
-        parameters = {
-            "apikey": os.environ.get("API_KEY"),
-            "subjectCode": subj_code,
-            "termCode": term_code,
-            "mode": "json", 
-            "school": school,
-        }
-    else:
-        parameters = {
-            "apikey": os.environ.get("API_KEY"),
-            "subjectCode": subj_code,
-            "mode": "json", 
-            "school": school,
-        }
+    return parameters
 
-    response = requests.get(
-        "https://gw.its.yale.edu/soa-gateway/courses/webservice/v3/index",
-        params=parameters,
-        timeout=30,
-    )
+def get_courses(subj_code, term_code, school):
+    """Given subject code and term_code, get relevant courses"""
+    '''
+    Returns a list of courses formatted as dictionaries that meet the specified parameters of subject, term, and school.
+
+        Parameters:
+            subj_code: The subject area that the course belongs to.
+            term_code: The term in which the course is offered in.
+            school: The school in which the course is offered in.
+
+        Returns:
+            response_list: List of all courses in a specified subject, term, and school.
+    '''
 
-    response_list = json.loads(response.text)
-    return response_list
+    return fetch_json(COURSES_PATH, get_course_parameters(subj_code, term_code, school))
 
 def get_subj_codes():
     '''
@@ -54,7 +163,7 @@ def get_subj_codes():
             none
 
         Returns:
-            subj_codes: List of all subject codes. 
+            subj_codes: List of all subject codes.
     '''
 
     parameters = {
@@ -62,71 +171,345 @@ def get_subj_codes():
         "mode": "json"
     }
 
-    response = requests.get(
-        "https://gw.its.yale.edu/soa-gateway/course/webservice/v2/subjects",
-        params=parameters,
-        timeout=30,
-    )
-
-    response_list = json.loads(response.text)
+    response_list = fetch_json(SUBJECTS_PATH, parameters)
 
     subj_codes = [subj["code"] for subj in response_list]
 
     return subj_codes
 
-def get_all_courses(term_code, school):
+def get_cache_path(cache_dir, term_code, school, subj_code):
     '''
-    Returns a list of courses for a given term code and school.
+    Returns the cache file of one subject of one school, e.g. pull_cache/202301/YC/S%26DS.json.
+    '''
+    return os.path.join(cache_dir, str(term_code), school, quote(subj_code, safe='') + '.json')
+
+def get_payload_hash(response_list):
+    '''
+    Returns a hash of a decoded response, independent of the key order and whitespace the API used.
+    '''
+    return hashlib.sha256(json.dumps(response_list, sort_keys=True).encode('utf-8')).hexdigest()
+
+def pull_subject(term_code, school, subj_code, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    '''
+    Returns the courses of one subject of one school, asking the API only when the cached response is too old.
+
+    A cached response younger than ttl seconds is used as it is. An older one is revalidated with
+    If-None-Match and If-Modified-Since when the API sent an ETag or Last-Modified header, so an
+    unchanged subject costs a 304 instead of its whole payload.
 
         Parameters:
-            term_code: A six-digit string that represents the term for the desired courses. 
-            school: A two-letter string abbreviation of the school for the desired courses. 
+            term_code: A six-digit string that represents the term for the desired courses.
+            school: A two-letter string abbreviation of the school.
+            subj_code: The subject code.
+            cache_dir: The directory of the cache files, or None to always fetch.
+            ttl: The age in seconds below which a cached response is used without revalidating it.
 
         Returns:
-            all_courses: A list of dictionaries for all courses in the school and term specified. 
+            response_list: List of all courses in the subject, term, and school.
+            payload_hash: The hash of the courses returned by get_payload_hash().
+    '''
+
+    path = get_cache_path(cache_dir, term_code, school, subj_code) if cache_dir else None
+    entry = None
+    if path and os.path.exists(path):
+        with open(path) as fp:
+            entry = json.load(fp)
+        if time.time() - entry["fetched"] < ttl:
+            return entry["body"], entry["hash"]
+
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = fetch(COURSES_PATH, get_course_parameters(subj_code, term_code, school), headers)
+    if response.status_code == 304:
+        response_list = entry["body"]
+    else:
+        response_list = json.loads(response.text)
+    payload_hash = get_payload_hash(response_list)
+
+    if path:
+        entry = {
+            "fetched": time.time(),
+            "etag": response.headers.get("ETag", entry and entry.get("etag")),
+            "last_modified": response.headers.get("Last-Modified", entry and entry.get("last_modified")),
+            "hash": payload_hash,
+            "body": response_list,
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(path + '.tmp', path)
 
+    return response_list, payload_hash
+
+def get_manifest_path(cache_dir, term_code):
+    '''
+    Returns the file that records the payload hash of every subject as of the last completed pull of a term.
     '''
+    return os.path.join(cache_dir, str(term_code), 'manifest.json')
 
-    print("Accessing all courses...")
-    subj_codes = get_subj_codes()
-    all_courses = []
+def read_manifest(cache_dir, term_code):
+    '''
+    Returns the payload hashes of the last completed pull of a term, keyed by "school/subject", or an empty dictionary.
+    '''
+    if not cache_dir or not os.path.exists(get_manifest_path(cache_dir, term_code)):
+        return {}
+    with open(get_manifest_path(cache_dir, term_code)) as fp:
+        return json.load(fp)
 
-    for subj_code in progressbar(subj_codes):
-        response_list = get_courses(subj_code, term_code, school)
-        for class_info in response_list:
-            all_courses.append(class_info)
+def write_manifest(cache_dir, term_code, hashes):
+    '''
+    Records the payload hashes of a completed pull, once its courses have been saved.
 
-    return all_courses
+        Parameters:
+            cache_dir: The directory of the response cache.
+            term_code: A six-digit string that represents the term.
+            hashes: Dictionary from (school, subject) pairs to payload hashes, as returned by pull_term().
 
-def get_all_courses_all_schools(term_code):
+        Returns:
+            none
     '''
-    Returns a list of lists. Each sublist contains multiple dictionaries, and each dictionary represents a course. 
+    path = get_manifest_path(cache_dir, term_code)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump({f"{school}/{subj_code}": payload_hash for (school, subj_code), payload_hash in hashes.items()}, fp)
+    os.replace(path + '.tmp', path)
+
+def get_all_courses(term_code, school, subj_codes=None, workers=WORKERS, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    '''
+    Returns a list of courses for a given term code and school.
 
         Parameters:
-            term_code: A six-digit string that represents the term for the desired courses. 
+            term_code: A six-digit string that represents the term for the desired courses.
+            school: A two-letter string abbreviation of the school for the desired courses.
+            subj_codes: List of subject codes to pull, or None to pull all of them.
+            workers: The number of requests in flight at once.
+            cache_dir: The directory of the response cache, or None to disable it.
+            ttl: The age in seconds below which a cached response is used without revalidating it.
 
         Returns:
-            dict_list: A list of lists that contains dictionaries for all courses in all schools at Yale University.
+            all_courses: A list of dictionaries for all courses in the school and term specified.
+
     '''
 
-    dict_list = []
-    
-    for school in SCHOOLS:
-        c = get_all_courses(term_code, school)
-        dict_list.append(c)
+    dict_list, _, _ = pull_term(term_code, [school], subj_codes, workers, cache_dir, ttl)
+    return dict_list[0]
+
+def get_all_courses_all_schools(term_code, schools=SCHOOLS, subj_codes=None, workers=WORKERS, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    '''
+    Returns a list of lists. Each sublist contains multiple dictionaries, and each dictionary represents a course.
+
+        Parameters:
+            term_code: A six-digit string that represents the term for the desired courses.
+            schools: The school codes to pull.
+            subj_codes: List of subject codes to pull, or None to pull all of them.
+            workers: The number of requests in flight at once.
+            cache_dir: The directory of the response cache, or None to disable it.
+            ttl: The age in seconds below which a cached response is used without revalidating it.
+
+        Returns:
+            dict_list: A list of lists that contains dictionaries for all courses in all schools at Yale University.
+    '''
 
+    dict_list, _, _ = pull_term(term_code, schools, subj_codes, workers, cache_dir, ttl)
     return dict_list
 
+def stream_term(term_code, schools=SCHOOLS, subj_codes=None, workers=WORKERS, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    '''
+    Pulls every subject of every school and yields the courses of each one as soon as it is its turn.
+
+    The subject codes are pulled once, then every (school, subject) pair is handled by a pool of
+    worker threads with pull_subject(). Each response is cached as soon as it arrives, so an
+    interrupted run resumes where it stopped. Subjects are yielded in the same order as a
+    sequential pull, by school, then by subject, and at most twice as many responses as there
+    are workers are held at once, so memory does not grow with the number of subjects.
+
+        Parameters:
+            term_code: A six-digit string that represents the term for the desired courses.
+            schools: The school codes to pull.
+            subj_codes: List of subject codes to pull, or None to pull all of them.
+            workers: The number of requests in flight at once.
+            cache_dir: The directory of the response cache, or None to disable it.
+            ttl: The age in seconds below which a cached response is used without revalidating it.
+
+        Returns:
+            subjects: Generator of (school, subject code, list of course dictionaries, payload hash) tuples.
+    '''
+
+    if subj_codes is None:
+        print("Accessing all courses...")
+        subj_codes = get_subj_codes()
+
+    pairs = [(school, subj_code) for school in schools for subj_code in subj_codes]
+    remaining = iter(pairs)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit():
+            for school, subj_code in remaining:
+                pending.append((school, subj_code, pool.submit(pull_subject, term_code, school, subj_code, cache_dir, ttl)))
+                return
+
+        for _ in range(2 * workers):
+            submit()
+
+        for _ in progressbar(range(len(pairs))):
+            school, subj_code, future = pending.popleft()
+            response_list, payload_hash = future.result()
+            submit()
+            yield school, subj_code, response_list, payload_hash
+
+def get_changed(cache_dir, term_code, hashes):
+    '''
+    Returns the (school, subject) pairs whose payload hash differs from the manifest of the last completed pull.
+
+    Subjects that are in the manifest but were not pulled have changed too: their courses are gone.
+    '''
+
+    manifest = read_manifest(cache_dir, term_code)
+    changed = [pair for pair, payload_hash in hashes.items() if manifest.get("/".join(pair)) != payload_hash]
+    current = {"/".join(pair) for pair in hashes}
+    changed += [tuple(key.split("/", 1)) for key in manifest if key not in current]
+
+    return changed
+
+def pull_term(term_code, schools=SCHOOLS, subj_codes=None, workers=WORKERS, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    '''
+    Pulls every subject of every school with stream_term() and reports which ones changed since the last completed pull.
+
+    All courses are held in memory; stage_term() writes them to a file as they arrive instead.
+    Call write_manifest() with the returned hashes once the courses have been saved.
+
+        Parameters:
+            term_code: A six-digit string that represents the term for the desired courses.
+            schools: The school codes to pull.
+            subj_codes: List of subject codes to pull, or None to pull all of them.
+            workers: The number of requests in flight at once.
+            cache_dir: The directory of the response cache, or None to disable it.
+            ttl: The age in seconds below which a cached response is used without revalidating it.
+
+        Returns:
+            dict_list: A list with one list of course dictionaries per school.
+            changed: List of the (school, subject) pairs whose courses changed, in the same order.
+            hashes: Dictionary from (school, subject) pairs to the payload hash of their courses.
+    '''
+
+    courses_by_school = {school: [] for school in schools}
+    hashes = {}
+    for school, subj_code, response_list, payload_hash in stream_term(term_code, schools, subj_codes, workers, cache_dir, ttl):
+        courses_by_school[school].extend(response_list)
+        hashes[(school, subj_code)] = payload_hash
+
+    dict_list = [courses_by_school[school] for school in schools]
+    return dict_list, get_changed(cache_dir, term_code, hashes), hashes
+
+def normalize_course(course):
+    '''
+    Returns a course as one line of JSON, with its keys sorted so that the same course is always written the same way.
+    '''
+    return json.dumps(course, sort_keys=True, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+def stage_term(term_code, output=STAGING_PATH, schools=SCHOOLS, subj_codes=None, workers=WORKERS, cache_dir=CACHE_DIR, ttl=CACHE_TTL, batch_size=STAGING_BATCH):
+    '''
+    Pulls every subject of every school with stream_term() and appends the courses to a JSON Lines staging file as they arrive.
+
+    Only the courses of the subjects in flight and one batch of lines are held in memory, however
+    many schools and subjects are pulled. The file is written next to output and renamed into
+    place when the pull is complete; if no subject changed and output exists, it is left untouched
+    so that the cached stages of databasebuilder.py stay valid.
+
+        Parameters:
+            term_code: A six-digit string that represents the term for the desired courses.
+            output: The staging file, read by databasebuilder.load_courses().
+            schools: The school codes to pull.
+            subj_codes: List of subject codes to pull, or None to pull all of them.
+            workers: The number of requests in flight at once.
+            cache_dir: The directory of the response cache, or None to disable it.
+            ttl: The age in seconds below which a cached response is used without revalidating it.
+            batch_size: The number of lines written at once.
+
+        Returns:
+            changed: List of the (school, subject) pairs whose courses changed.
+            hashes: Dictionary from (school, subject) pairs to the payload hash of their courses.
+            count: The number of courses pulled.
+    '''
+
+    tmp_path = output + '.tmp'
+    hashes = {}
+    count = 0
+    batch = []
+
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        for school, subj_code, response_list, payload_hash in stream_term(term_code, schools, subj_codes, workers, cache_dir, ttl):
+            hashes[(school, subj_code)] = payload_hash
+            batch.extend(normalize_course(course) for course in response_list)
+            if len(batch) >= batch_size:
+                fp.write(''.join(batch))
+                count += len(batch)
+                batch = []
+        fp.write(''.join(batch))
+        count += len(batch)
+
+    changed = get_changed(cache_dir, term_code, hashes)
+    if changed or not os.path.exists(output):
+        os.replace(tmp_path, output)
+    else:
+        os.remove(tmp_path)
+
+    return changed, hashes, count
+
+def get_output_path(term_code, pickled=False):
+    '''
+    Returns the default file for the courses of a term, named after its season: spring_courses.jsonl for 202301,
+    or spring_courses for a pickle, like the pickles that ship with the repository. databasebuilder.py reads
+    every .jsonl file as JSON Lines, so a pickle never gets that extension.
+    '''
+    name = SEASONS.get(term_code[4:], term_code).lower() + "_courses"
+    return name if pickled else name + ".jsonl"
+
+def get_arguments():
+    '''
+    Sets up the command line flags of the scraper.
+    '''
+    parser = argparse.ArgumentParser(description="Pulls all courses of a term from the Yale Courses API")
+    parser.add_argument("--term", default="202301", help="six-digit term code, e.g. 202203 for Fall 2022")
+    parser.add_argument("--output", help="JSON Lines file to stage the courses in (default: named after the season of --term, e.g. spring_courses.jsonl)")
+    parser.add_argument("--pickle", action="store_true", help="pickle all courses to --output at the end instead of streaming them")
+    parser.add_argument("--changes", default="pull_changes.json", help="file to list the (school, subject) pairs that changed in")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="requests in flight at once")
+    parser.add_argument("--rate", type=float, default=RATE_LIMIT, help="maximum requests per second, 0 for no limit")
+    parser.add_argument("--base-url", default=API_BASE, help="base URL of the API")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="directory of the response cache")
+    parser.add_argument("--ttl", type=float, default=CACHE_TTL, help="seconds a cached response is used without revalidating it")
+    parser.add_argument("--fresh", action="store_true", help="revalidate every cached response, as if the ttl were 0")
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = get_output_path(args.term, args.pickle)
+    elif args.pickle and args.output.endswith('.jsonl'):
+        parser.error("--pickle cannot write to a .jsonl file, which databasebuilder.py reads as JSON Lines")
+    return args
+
 if __name__ == "__main__":
 
-    # term = '202203'
-    # fall_results = get_all_courses_all_schools(term)
+    args = get_arguments()
+    configure(args.base_url, args.rate)
+    ttl = 0 if args.fresh else args.ttl
 
-    # with open('fall_courses', 'wb') as fp:
-    #     pickle.dump(fall_results, fp)
+    if args.pickle:
+        results, changed, hashes = pull_term(args.term, workers=args.workers, cache_dir=args.cache_dir, ttl=ttl)
+        # Leaving the pickle untouched when nothing changed keeps every cached stage of databasebuilder.py valid.
+        if changed or not os.path.exists(args.output):
+            with open(args.output, 'wb') as fp:
+                pickle.dump(results, fp)
+    else:
+        changed, hashes, count = stage_term(args.term, args.output, workers=args.workers, cache_dir=args.cache_dir, ttl=ttl)
+        print(f"{count} courses staged in {args.output}")
+    print(f"{len(changed)} subjects changed")
 
-    term = '202301'
-    spring_results = get_all_courses_all_schools(term)
-    
-    with open('spring_courses', 'wb') as fp:
-        pickle.dump(spring_results, fp)
\ No newline at end of file
+    with open(args.changes, 'w') as fp:
+        json.dump(changed, fp)
+    write_manifest(args.cache_dir, args.term, hashes)
@@ -1,14 +1,133 @@
-from flask import Flask, request, make_response
+import hashlib, os, threading
+
+from flask import Flask, request, make_response, jsonify, abort, g
 from flask import render_template
-from get_recommendations import get_course_descriptions, create_tfidf, create_cosine_matrix, get_matching, get_coursetitle, get_recommendations, build_rec_table
-from get_recommendations import sort_by_sim, sort_by_demand, get_overall_demand, get_dept_demand, get_dept_count, get_popular_recs, get_unpopular_recs
+from ann import NPROBE, RERANK
+from catalog import load_catalog, load_terms
+from codes import get_term_name
+from connections import get_data_version, get_stats, reset_stats
+from get_recommendations import get_batch_recommendations, get_demand_series, get_group_recommendations, get_matching, get_multi_recommendations, get_rec_rows, get_stored_recommendations, summarize_recs
+from indexbuilder import load_ann_index, load_index
+from response_cache import ResponseCache
+from suggest import PrefixIndex
 
 app = Flask(__name__, template_folder='templates')
 
 # GLOBAL VARIABLES
-all_desciptions = get_course_descriptions()
-tfidf_matrix = create_tfidf(all_desciptions)
-cosine_sim_matrix = create_cosine_matrix(tfidf_matrix)
+TERMS = load_terms()
+DEFAULT_TERM = TERMS[-1]
+
+# Set REC_ENGINE=ann to serve recommendations from the approximate nearest neighbor index instead of
+# the exact tf-idf index; ANN_NPROBE and ANN_RERANK trade its recall for latency.
+ENGINE = os.environ.get('REC_ENGINE', 'exact')
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', NPROBE))
+ANN_RERANK = int(os.environ.get('ANN_RERANK', RERANK))
+
+def load_engine(term):
+    """Returns the similarity index of a term for the configured engine
+    """
+    if ENGINE == 'ann':
+        return load_ann_index(term, nprobe=ANN_NPROBE, rerank=ANN_RERANK)
+
+    return load_index(term)
+
+# The most courses one request to /api/recommendations may ask for.
+MAX_BATCH = 5000
+
+# Rendered pages and the JSON recommendations of each course are cached by every process, keyed on
+# their inputs and the data version of the database. RESPONSE_CACHE_SIZE=0 turns the caches off.
+CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+page_cache = ResponseCache(CACHE_SIZE, CACHE_TTL)
+json_cache = ResponseCache(CACHE_SIZE * 8, CACHE_TTL)
+
+# The similarity index, catalog and typeahead index of each term are loaded on the first request
+# for that term, so memory only grows with the terms that are actually queried.
+term_data = {}
+term_lock = threading.Lock()
+data_version = get_data_version()
+
+def get_term_data(term):
+    """Returns the similarity index, catalog and typeahead index of a term, loading them on first use
+    """
+    data = term_data.get(term)
+    if data is None:
+        with term_lock:
+            data = term_data.get(term)
+            if data is None:
+                catalog = load_catalog(term)
+                data = term_data[term] = (load_engine(term), catalog, PrefixIndex.from_catalog(catalog))
+
+    return data
+
+def get_term():
+    """Returns the term selected by the term parameter of the request, the latest term by default
+    """
+    term = request.args.get('term') or DEFAULT_TERM
+    if term not in TERMS:
+        abort(404)
+
+    return term
+
+def get_term_options():
+    """Returns the (code, name) of every term for the term selector
+    """
+    return [(term, get_term_name(term)) for term in reversed(TERMS)]
+
+@app.before_request
+def start_query_stats():
+    """Starts counting database work for this request
+    """
+    reset_stats()
+
+@app.before_request
+def check_data_version():
+    """Reloads the terms and drops the loaded term data and every cached response once the database has been
+    rebuilt or updated
+    """
+    global data_version, TERMS, DEFAULT_TERM
+    version = get_data_version()
+    if version != data_version:
+        with term_lock:
+            if version != data_version:
+                TERMS = load_terms()
+                DEFAULT_TERM = TERMS[-1]
+                term_data.clear()
+                page_cache.clear()
+                json_cache.clear()
+                data_version = version
+
+    g.data_version = version
+
+def cached_page(key, render):
+    """Returns the page for key from the page cache, calling render() for its HTML on a miss
+
+    The response carries an ETag of the page and must be revalidated, so a browser that already
+    has the current page gets an empty 304 response instead.
+    """
+    key += (g.data_version,)
+    page = page_cache.get(key)
+    hit = page is not None
+    if not hit:
+        html = render()
+        page = (html, hashlib.sha256(html.encode('utf-8')).hexdigest()[:32])
+        page_cache.put(key, page)
+
+    response = make_response(page[0])
+    response.set_etag(page[1])
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Cache'] = 'hit' if hit else 'miss'
+    return response.make_conditional(request)
+
+@app.after_request
+def report_query_stats(response):
+    """Reports connection opens and query time of this request in a Server-Timing header and the debug log
+    """
+    stats = get_stats()
+    response.headers['Server-Timing'] = stats.server_timing()
+    app.logger.debug("%s %s: %d queries in %.3f ms, %d connections opened", request.method, request.path, stats.queries, stats.seconds * 1000, stats.opens)
+
+    return response
 
 @app.route('/', methods=['GET'])
 def root():
@@ -16,6 +135,8 @@ def root():
     """
     html = render_template(
         'index.html',
+        term=DEFAULT_TERM,
+        terms=get_term_options(),
     )
     response = make_response(html)
 
@@ -27,52 +148,133 @@ def search():
     has_been_submitted = 1
 
     coursename_input = request.args.get('coursename_input')
+    term = get_term()
 
-    if has_been_submitted:
-        matching_courses = get_matching(coursename_input)
-        print(matching_courses)
+    def render():
+        if has_been_submitted:
+            matching_courses = get_matching(coursename_input, term)
 
-    html = render_template(
-        'index.html',
-        col_names=['Course ID', 'Course Code', 'Course Title'],
-        all_results=matching_courses
-    )
+        return render_template(
+            'index.html',
+            coursename_input=coursename_input,
+            term=term,
+            terms=get_term_options(),
+            col_names=['Course ID', 'Course Code', 'Course Title'],
+            all_results=matching_courses
+        )
+
+    return cached_page(('search', term, coursename_input), render)
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest():
+    """Typeahead suggestions for course codes and title words, as JSON
+    """
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', default=10, type=int)
+    _, _, suggest_index = get_term_data(get_term())
+
+    return jsonify(suggest_index.suggest(query, limit))
+
+@app.route('/api/demand', methods=['GET'])
+def demand_series():
+    """Daily demand samples of one course over the shopping period, as JSON
+    """
+    courseid = request.args.get('courseid', type=int)
+    term = get_term()
+
+    return jsonify([{'date': date, 'count': count} for date, count in get_demand_series(courseid, term)])
 
-    response = make_response(html) 
+@app.route('/api/recommendations', methods=['POST'])
+def batch_recommendations():
+    """Recommendations for many courses of one term in one request, as JSON
+
+    The request body is {"courseids": [...]}. Each course id maps to its recommendations,
+    or to null if the term has no course with that id.
+
+    The response carries an ETag of the term, the course ids and the data version, and must be revalidated.
+    make_conditional() only answers GET and HEAD requests, so a matching If-None-Match is answered here with
+    an empty 304 response before anything is looked up; the request only reads.
+    """
+    term = get_term()
+    courseids = (request.get_json(silent=True) or {}).get('courseids')
+    if not isinstance(courseids, list) or len(courseids) > MAX_BATCH or not all(type(courseid) is int for courseid in courseids):
+        abort(400)
+
+    etag = hashlib.sha256(repr((term, courseids, g.data_version)).encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    recommendations = {}
+    missing = []
+    for courseid in courseids:
+        course_names = json_cache.get(('recommendations', term, courseid, g.data_version))
+        if course_names is None:
+            missing.append(courseid)
+        else:
+            recommendations[courseid] = course_names
+
+    if missing:
+        similarity_index, catalog, _ = get_term_data(term)
+        # The neighbors table holds the recommendations of the exact engine, when indexbuilder.py --neighbors has written them.
+        found = get_stored_recommendations(missing, term, catalog) if ENGINE == 'exact' else {}
+        found.update(get_batch_recommendations([courseid for courseid in missing if courseid not in found], similarity_index, catalog))
+        for courseid, course_names in found.items():
+            if course_names is not None:
+                course_names = [dict(course, fullcode=catalog.group_codes[course['courseid']], title=catalog.titles[course['courseid']]) for course in course_names]
+                json_cache.put(('recommendations', term, courseid, g.data_version), course_names)
+            recommendations[courseid] = course_names
+
+    response = jsonify({'term': term, 'recommendations': {str(courseid): recommendations[courseid] for courseid in courseids}})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
     return response
 
 @app.route('/recommendations', methods=['GET'])
 def recommendations():
+    """Recommendations for one course, or for several courses taken together when courseid is repeated
+    """
 
-    courseid = request.args.get('courseid')
-    coursetitle = get_coursetitle(courseid)
-
-    recs = get_recommendations(coursetitle, cosine_sim_matrix)
-    build_rec_table(recs)
+    courseids = request.args.getlist('courseid', type=int)
+    if not courseids:
+        abort(400)
+    term = get_term()
 
-    results_by_sim = sort_by_sim()
-    results_by_dem = sort_by_demand()
+    # Ids that are not courses of the term are dropped, and the page is not found if none are left
+    similarity_index, catalog, _ = get_term_data(term)
+    courseids = [courseid for courseid in courseids if catalog.get_coursetitle(courseid) is not None]
+    if not courseids:
+        abort(404)
 
-    overall_avg = get_overall_demand()
-    demand_by_dept = get_dept_demand()
+    def render():
+        coursetitles = [catalog.get_coursetitle(courseid) for courseid in courseids]
 
-    count_by_dept = get_dept_count()
+        if len(courseids) == 1:
+            recs = get_group_recommendations(catalog.get_groupid(courseids[0]), similarity_index, catalog)
+        else:
+            recs = get_multi_recommendations(courseids, similarity_index, catalog)
+        summary = summarize_recs(get_rec_rows(recs, term, catalog))
 
-    pop_courses = get_popular_recs()
-    unpop_courses = get_unpopular_recs()
+        return render_template(
+            'results.html',
+            selected_courseids=courseids,
+            selected_term=get_term_name(term),
+            selected_coursetitle=', '.join(dict.fromkeys(coursetitles)),
+            similarity_sorted=summary['similarity_sorted'],
+            demand_sorted=summary['demand_sorted'],
+            avg_demand=summary['avg_demand'],
+            dept_demand=summary['dept_demand'],
+            dept_count=summary['dept_count'],
+            most_demanded=summary['most_demanded'], 
+            least_demanded=summary['least_demanded']
+        )
 
-    html = render_template(
-        'results.html',
-        selected_courseid=courseid,
-        selected_coursetitle=coursetitle,
-        similarity_sorted=results_by_sim,
-        demand_sorted=results_by_dem,
-        avg_demand=overall_avg,
-        dept_demand=demand_by_dept,
-        dept_count=count_by_dept,
-        most_demanded=pop_courses, 
-        least_demanded=unpop_courses
-    )
+    return cached_page(('recommendations', term, tuple(courseids)), render)
 
-    response = make_response(html)
-    return response
\ No newline at end of file
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    """Hits, misses and sizes of the response caches of this process, as JSON
+    """
+    return jsonify({'pages': page_cache.get_stats(), 'recommendations': json_cache.get_stats()})
\ No newline at end of file
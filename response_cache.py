@@ -0,0 +1,81 @@
+import threading, time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    '''
+    A bounded least recently used cache whose entries also expire after ttl seconds, shared by the
+    threads of one web app process.
+
+    The web app keys its entries on the inputs of a response and the data version of the database,
+    see connections.get_data_version(), so an entry is never served once the database has changed.
+    A capacity of 0 turns the cache off.
+    '''
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        Returns the value stored under key and marks it as recently used, or None if there is none or it has expired.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        '''
+        Stores a value under key, evicting the least recently used entries beyond the capacity.
+        '''
+        if self.capacity <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        '''
+        Drops every entry. The counters keep counting.
+        '''
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        '''
+        Returns the size, settings and hit, miss, eviction and expiration counts of the cache as a dictionary.
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
@@ -0,0 +1,473 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags, vstack
+
+NEIGHBORS = 50
+
+# The drift of the idf weights, see UpdatableIndex.get_drift(), that an UpdatableIndex tolerates before it re-weights every course.
+IDF_DRIFT = 0.01
+
+
+class CourseIndex:
+    '''
+    The mapping between the courseids of an index and its rows, shared by every engine that
+    get_recommendations() can query.
+    '''
+
+    def set_courseids(self, courseids):
+        '''
+        Sets the courseid of every row, in increasing order, and the lookup from courseid back to row.
+        '''
+        self.courseids = np.asarray(courseids)
+        self.rows = np.full(int(self.courseids.max()) + 1 if len(self.courseids) else 0, -1, dtype=np.int64)
+        self.rows[self.courseids] = np.arange(len(self.courseids))
+
+    def get_row(self, courseid):
+        '''
+        Returns the row of a course in the index, or None if the course is not in the index.
+        '''
+        if courseid is None or not 0 <= courseid < len(self.rows) or self.rows[courseid] < 0:
+            return None
+        return int(self.rows[courseid])
+
+
+class SimilarityIndex(CourseIndex):
+    '''
+    Computes cosine similarity scores one course at a time from the sparse tf-idf matrix.
+
+    TfidfVectorizer returns L2-normalized rows, so the dot product of two rows is their cosine
+    similarity. Only the sparse matrix is kept in memory; a query costs one sparse matrix-vector
+    product instead of a lookup into a dense N x N matrix.
+    '''
+
+    def __init__(self, tfidf_matrix, neighbor_ids=None, neighbor_scores=None, courseids=None):
+        self.tfidf_matrix = tfidf_matrix.tocsr()
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_scores = neighbor_scores
+        self.set_courseids(np.arange(self.tfidf_matrix.shape[0]) if courseids is None else courseids)
+
+    def __len__(self):
+        return self.tfidf_matrix.shape[0]
+
+    def similarity_row(self, row):
+        '''
+        Returns the similarity scores between one course and every course.
+
+            Parameters:
+                row: The row of the course in the tf-idf matrix.
+
+            Returns:
+                scores: Dense float64 array with one score per course.
+        '''
+        query = self.tfidf_matrix[row].toarray().ravel()
+        return self.tfidf_matrix.dot(query)
+
+    def top_k(self, row, k):
+        '''
+        Returns the k highest scoring courses for one course, including the course itself.
+
+        The order matches a stable descending sort of the full similarity row, so ties are
+        broken by the lower row number. Precomputed neighbor lists are used when they are
+        long enough; their float32 scores are only used for ordering, and the returned scores
+        are recomputed exactly for the k neighbors. Otherwise the row is scored on the fly.
+
+            Parameters:
+                row: The row of the course in the tf-idf matrix.
+                k: The number of courses to return.
+
+            Returns:
+                top_rows: Array of row numbers, most similar first.
+                top_scores: Array of the matching similarity scores.
+        '''
+        if self.neighbor_ids is not None and k <= self.neighbor_ids.shape[1]:
+            top_rows = self.neighbor_ids[row, :k]
+            query = self.tfidf_matrix[row].toarray().ravel()
+            return top_rows, self.tfidf_matrix[top_rows].dot(query)
+
+        scores = self.similarity_row(row)
+        return top_k_from_scores(scores, k)
+
+    def centroid_top_k(self, rows, k, excluded=None):
+        '''
+        Returns the k highest scoring courses for the centroid of several courses.
+
+        Every course is scored against the centroid with one sparse matrix-vector product. Ties are
+        broken by the lower row number.
+
+            Parameters:
+                rows: Array of the rows of the seed courses in the tf-idf matrix.
+                k: The number of courses to return.
+                excluded: Boolean array marking the rows that must never be returned, or None.
+
+            Returns:
+                top_rows: Array of at most k row numbers, most similar first.
+                top_scores: Array of the matching similarity scores.
+        '''
+        scores = self.tfidf_matrix.dot(get_centroid(self.tfidf_matrix, rows))
+        if excluded is not None:
+            scores[excluded] = -np.inf
+
+        top_rows, top_scores = top_k_from_scores(scores, k)
+        kept = top_scores > -np.inf
+        return top_rows[kept], top_scores[kept]
+
+
+def get_centroid(tfidf_matrix, rows):
+    '''
+    Returns the mean of the given rows of a tf-idf matrix scaled to unit length, so that its dot
+    product with a row is their cosine similarity.
+
+        Parameters:
+            tfidf_matrix: A CSR matrix with L2-normalized rows.
+            rows: Array of the rows to average.
+
+        Returns:
+            centroid: Dense float64 array with one weight per term.
+    '''
+    centroid = np.asarray(tfidf_matrix[rows].mean(axis=0)).ravel()
+    norm = np.linalg.norm(centroid)
+    return centroid / norm if norm else centroid
+
+
+def top_k_from_scores(scores, k):
+    '''
+    Selects the k highest scores of a row with argpartition instead of sorting the whole row.
+
+        Parameters:
+            scores: Dense array of similarity scores.
+            k: The number of entries to return.
+
+        Returns:
+            top_rows: Array of positions, highest score first, ties broken by position.
+            top_scores: Array of the matching scores.
+    '''
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+
+    if k < n:
+        threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[:k - above.shape[0]]
+        candidates = np.concatenate((above, ties))
+    else:
+        candidates = np.arange(n)
+
+    order = np.lexsort((candidates, -scores[candidates]))
+    top_rows = candidates[order]
+    return top_rows, scores[top_rows]
+
+
+def score_neighbors(tfidf_matrix, rows, k, excluded=None, block_size=512):
+    '''
+    Returns the k most similar courses for each of the given rows.
+
+    Rows are scored in blocks so only a block_size x N slice of the similarity matrix
+    exists at any time.
+
+        Parameters:
+            tfidf_matrix: A CSR matrix with L2-normalized rows.
+            rows: Array of the rows to score.
+            k: The number of neighbors to keep per course, including the course itself.
+            excluded: Boolean array marking the rows that must never be returned, or None.
+            block_size: The number of rows to score per sparse matrix product.
+
+        Returns:
+            neighbor_ids: int32 array of shape (len(rows), k) with the row numbers of the neighbors.
+            neighbor_scores: float32 array of shape (len(rows), k) with the matching similarity scores.
+    '''
+    transposed = tfidf_matrix.T
+    neighbor_ids = np.empty((len(rows), k), dtype=np.int32)
+    neighbor_scores = np.empty((len(rows), k), dtype=np.float32)
+
+    for start in range(0, len(rows), block_size):
+        block = (tfidf_matrix[rows[start:start + block_size]] @ transposed).toarray()
+        if excluded is not None:
+            block[:, excluded] = -np.inf
+        for offset, scores in enumerate(block):
+            top_rows, top_scores = top_k_from_scores(scores, k)
+            neighbor_ids[start + offset] = top_rows
+            neighbor_scores[start + offset] = top_scores
+
+    return neighbor_ids, neighbor_scores
+
+
+# The tf-idf matrix of a worker process of create_neighbor_table(), sent once when the worker starts.
+_worker_matrix = None
+
+
+def set_worker_matrix(tfidf_matrix):
+    '''
+    Keeps the tf-idf matrix in a worker process of create_neighbor_table().
+    '''
+    global _worker_matrix
+    _worker_matrix = tfidf_matrix
+
+
+def score_block(start, k, block_size):
+    '''
+    Scores the block of rows starting at start. Runs in the worker processes of create_neighbor_table().
+    '''
+    rows = np.arange(start, min(start + block_size, _worker_matrix.shape[0]))
+    return score_neighbors(_worker_matrix, rows, k, block_size=block_size)
+
+
+def create_neighbor_table(tfidf_matrix, k=NEIGHBORS, block_size=512, workers=1):
+    '''
+    Precomputes the k most similar courses for every course.
+
+    Rows are scored in blocks so only a block_size x N slice of the similarity matrix
+    exists at any time in each process. With several workers, the blocks are spread over a
+    pool of processes that each receive the matrix once.
+
+        Parameters:
+            tfidf_matrix: The formatted matrix returned by create_tfidf(course_descriptions)
+            k: The number of neighbors to keep per course, including the course itself.
+            block_size: The number of rows to score per sparse matrix product.
+            workers: The number of worker processes; 1 scores every block in this process.
+
+        Returns:
+            neighbor_ids: int32 array of shape (N, k) with the row numbers of the neighbors.
+            neighbor_scores: float32 array of shape (N, k) with the matching similarity scores.
+    '''
+    tfidf_matrix = tfidf_matrix.tocsr()
+    n = tfidf_matrix.shape[0]
+    k = min(k, n)
+    if workers <= 1 or n <= block_size:
+        return score_neighbors(tfidf_matrix, np.arange(n), k, block_size=block_size)
+
+    neighbor_ids = np.empty((n, k), dtype=np.int32)
+    neighbor_scores = np.empty((n, k), dtype=np.float32)
+    starts = range(0, n, block_size)
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_worker_matrix, initargs=(tfidf_matrix,)) as pool:
+        for start, (block_ids, block_scores) in zip(starts, pool.map(score_block, starts, repeat(k), repeat(block_size))):
+            neighbor_ids[start:start + block_size] = block_ids
+            neighbor_scores[start:start + block_size] = block_scores
+
+    return neighbor_ids, neighbor_scores
+
+
+def get_idf(df, n):
+    '''
+    Returns the smoothed idf weights that TfidfVectorizer uses: ln((1 + n) / (1 + df)) + 1.
+
+        Parameters:
+            df: Array with the number of courses that contain each term.
+            n: The number of courses.
+
+        Returns:
+            idf: float64 array with one weight per term.
+    '''
+    return np.log((1 + n) / (1 + np.asarray(df, dtype=np.float64))) + 1
+
+
+def weight_rows(counts, idf):
+    '''
+    Turns raw term counts into L2-normalized tf-idf rows, as TfidfVectorizer does.
+
+        Parameters:
+            counts: Sparse matrix of term counts, one row per course.
+            idf: Array with the idf weight of each term.
+
+        Returns:
+            tfidf_matrix: float64 CSR matrix with the same sparsity as counts.
+    '''
+    weighted = (counts.tocsr().astype(np.float64) @ diags(idf)).tocsr()
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (diags(1 / norms) @ weighted).tocsr()
+
+
+class UpdatableIndex(SimilarityIndex):
+    '''
+    A SimilarityIndex whose courses can be added, changed and removed without refitting.
+
+    The raw term counts are kept next to the weighted matrix, and document frequencies are kept
+    as counts per term. A change weights the changed courses with the idf weights already in use
+    and recomputes only the neighbor lists it can affect: those that contain a changed course and
+    those that a changed course now scores into. Removed courses stay as empty rows, marked in
+    removed, until the index is compacted.
+
+    Every change also moves the idf weights a course would get from a full rebuild. Once the
+    drift returned by get_drift() exceeds idf_drift the index is marked stale, and the next query
+    or refresh() re-weights every course from the counts and rebuilds the neighbor table.
+    '''
+
+    def __init__(self, tfidf_matrix, counts, vocabulary, idf, courseids, neighbor_ids, neighbor_scores, idf_drift=IDF_DRIFT):
+        super().__init__(tfidf_matrix, np.array(neighbor_ids), np.array(neighbor_scores), courseids)
+        self.counts = counts.tocsr()
+        self.vocabulary = dict(vocabulary)
+        self.idf = np.array(idf, dtype=np.float64)
+        self.df = np.bincount(self.counts.indices, minlength=len(self.vocabulary))
+        self.removed = np.zeros(self.counts.shape[0], dtype=bool)
+        self.idf_drift = idf_drift
+        self.stale = False
+        self.analyzer = None
+
+    def analyze(self, text):
+        '''
+        Splits a cleaned description into terms the way TfidfVectorizer(stop_words='english') does.
+        '''
+        if self.analyzer is None:
+            # Imported here so web workers that only load a prebuilt index never import scikit-learn.
+            from sklearn.feature_extraction.text import CountVectorizer
+            self.analyzer = CountVectorizer(stop_words='english').build_analyzer()
+        return self.analyzer(text or '')
+
+    def live_courses(self):
+        '''
+        Returns the number of courses that have not been removed.
+        '''
+        return int(len(self.removed) - self.removed.sum())
+
+    def get_drift(self):
+        '''
+        Returns how far the idf weights in use are from those of a full rebuild: the mean relative
+        change of the weight of a term occurrence, i.e. the relative changes weighted by document frequency.
+        '''
+        total = self.df.sum()
+        if not total:
+            return 0.0
+        used = self.df > 0
+        current = get_idf(self.df[used], self.live_courses())
+        return float(np.sum(self.df[used] * np.abs(current - self.idf[used]) / self.idf[used]) / total)
+
+    def count_terms(self, texts):
+        '''
+        Returns a CSR matrix with the term counts of each text, adding unseen terms to the vocabulary.
+        '''
+        rows, columns = [], []
+        for position, text in enumerate(texts):
+            for term in self.analyze(text):
+                column = self.vocabulary.get(term)
+                if column is None:
+                    column = self.vocabulary[term] = len(self.vocabulary)
+                rows.append(position)
+                columns.append(column)
+
+        counts = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(texts), len(self.vocabulary)))
+        counts.sum_duplicates()
+        return counts
+
+    def apply_changes(self, changes):
+        '''
+        Adds, changes and removes courses, and refreshes the neighbor lists they can affect.
+
+        New courses are appended as new rows, so they should have higher courseids than every
+        course in the index to keep ties ordered by courseid.
+
+            Parameters:
+                changes: Dictionary from courseid to the new cleaned description, or None to remove the course.
+
+            Returns:
+                affected: Array of the rows whose neighbor lists were recomputed.
+        '''
+        old_rows = self.counts.shape[0]
+        changed_rows, texts, removed, added_ids = [], [], [], []
+        for courseid in sorted(changes):
+            row = self.get_row(courseid)
+            if row is None:
+                if changes[courseid] is None:
+                    continue
+                row = old_rows + len(added_ids)
+                added_ids.append(courseid)
+            changed_rows.append(row)
+            texts.append(changes[courseid] or '')
+            removed.append(changes[courseid] is None)
+        if not changed_rows:
+            return np.empty(0, dtype=np.int64)
+
+        changed_rows = np.array(changed_rows, dtype=np.int64)
+        removed = np.array(removed)
+        new_counts = self.count_terms(texts)
+
+        # Update the document frequencies and give new terms the idf of a full rebuild.
+        terms = len(self.vocabulary)
+        existing = changed_rows[changed_rows < old_rows]
+        self.df = np.concatenate((self.df, np.zeros(terms - len(self.df), dtype=self.df.dtype)))
+        self.df -= np.bincount(self.counts[existing].indices, minlength=terms)
+        self.df += np.bincount(new_counts.indices, minlength=terms)
+
+        total_rows = old_rows + len(added_ids)
+        self.removed = np.concatenate((self.removed, np.zeros(len(added_ids), dtype=bool)))
+        self.removed[changed_rows] = removed
+        new_terms = np.arange(len(self.idf), terms)
+        self.idf = np.concatenate((self.idf, get_idf(self.df[new_terms], self.live_courses())))
+
+        # Replace the changed rows of the counts and the weighted matrix.
+        order = np.arange(total_rows)
+        order[changed_rows] = old_rows + np.arange(len(changed_rows))
+        new_weighted = weight_rows(new_counts, self.idf)
+        self.counts = vstack((resize_columns(self.counts, terms), new_counts)).tocsr()[order]
+        self.tfidf_matrix = vstack((resize_columns(self.tfidf_matrix, terms), new_weighted)).tocsr()[order]
+        self.set_courseids(np.concatenate((self.courseids, np.array(added_ids, dtype=self.courseids.dtype))))
+
+        # Courses whose list held a changed course, or that a changed course now scores into. A
+        # score of 0 cannot enter a list it was not already in, since ties go to the lower row.
+        k = self.neighbor_ids.shape[1]
+        affected = np.isin(self.neighbor_ids, changed_rows).any(axis=1)
+        live_changed = changed_rows[~removed]
+        if len(live_changed):
+            best = np.asarray((self.tfidf_matrix[:old_rows] @ new_weighted[~removed].T).max(axis=1).todense()).ravel()
+            affected |= (best > 0) & (best >= self.neighbor_scores[:, -1] - 1e-6)
+        affected = np.union1d(np.flatnonzero(affected), live_changed)
+        affected = affected[~self.removed[affected]]
+
+        self.neighbor_ids = np.concatenate((self.neighbor_ids, np.zeros((len(added_ids), k), dtype=np.int32)))
+        self.neighbor_scores = np.concatenate((self.neighbor_scores, np.full((len(added_ids), k), -np.inf, dtype=np.float32)))
+        self.neighbor_ids[affected], self.neighbor_scores[affected] = score_neighbors(self.tfidf_matrix, affected, k, self.removed)
+
+        if self.get_drift() > self.idf_drift:
+            self.stale = True
+        return affected
+
+    def refresh(self):
+        '''
+        Re-weights every course with the current idf weights and rebuilds the neighbor table, if the index is stale.
+        '''
+        if not self.stale:
+            return
+        self.idf = get_idf(self.df, self.live_courses())
+        self.tfidf_matrix = weight_rows(self.counts, self.idf)
+        live = np.flatnonzero(~self.removed)
+        self.neighbor_ids[live], self.neighbor_scores[live] = score_neighbors(self.tfidf_matrix, live, self.neighbor_ids.shape[1], self.removed)
+        self.stale = False
+
+    def similarity_row(self, row):
+        scores = super().similarity_row(row)
+        scores[self.removed] = -np.inf
+        return scores
+
+    def top_k(self, row, k):
+        self.refresh()
+        return super().top_k(row, k)
+
+    def centroid_top_k(self, rows, k, excluded=None):
+        self.refresh()
+        return super().centroid_top_k(rows, k, self.removed if excluded is None else excluded | self.removed)
+
+    def compact(self):
+        '''
+        Drops the rows of removed courses and renumbers the neighbor lists to match.
+        '''
+        if not self.removed.any():
+            return
+        keep = np.flatnonzero(~self.removed)
+        new_rows = np.cumsum(~self.removed) - 1
+        self.counts = self.counts[keep]
+        self.tfidf_matrix = self.tfidf_matrix[keep]
+        self.neighbor_ids = new_rows[self.neighbor_ids[keep]].astype(np.int32)
+        self.neighbor_scores = self.neighbor_scores[keep]
+        self.set_courseids(self.courseids[keep])
+        self.removed = np.zeros(len(keep), dtype=bool)
+
+
+def resize_columns(matrix, columns):
+    '''
+    Returns a CSR matrix with more columns, for terms added to the vocabulary after it was built.
+    '''
+    matrix = matrix.tocsr()
+    return csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], columns))
@@ -0,0 +1,114 @@
+import re
+from bisect import bisect_left
+
+MAX_SUGGESTIONS = 25
+MAX_SCAN = 1000
+
+
+def normalize(text):
+    '''
+    Lowercases text and collapses runs of whitespace, so "CPSC  437" and "cpsc 437" compare equal.
+    '''
+    return ' '.join((text or '').lower().split())
+
+
+class PrefixIndex:
+    '''
+    Answers typeahead queries on course codes and title words from sorted arrays held in memory.
+
+    Every key (a normalized course code or a title word) is stored in one sorted list, with the
+    matching courseid at the same position of a second list. All keys that start with a prefix
+    are adjacent, so a lookup is one binary search followed by a scan that stops as soon as
+    enough courses are found, or after MAX_SCAN entries for very short prefixes.
+    '''
+
+    def __init__(self, courseids, codes, titles):
+        self.codes = dict(zip(courseids, codes))
+        self.titles = dict(zip(courseids, titles))
+        self.title_words = {courseid: frozenset(re.findall(r"\w+", normalize(title))) for courseid, title in self.titles.items()}
+
+        # Within one word, courses are listed in alphabetical order of title.
+        title_order = sorted(courseids, key=lambda courseid: (normalize(self.titles[courseid]), courseid))
+        title_rank = {courseid: rank for rank, courseid in enumerate(title_order)}
+
+        code_entries = sorted((normalize(code), courseid) for courseid, code in zip(courseids, codes) if code)
+        word_entries = sorted({(word, title_rank[courseid], courseid) for courseid, words in self.title_words.items() for word in words})
+
+        self.code_keys = [key for key, _ in code_entries]
+        self.code_ids = [courseid for _, courseid in code_entries]
+        self.word_keys = [key for key, _, _ in word_entries]
+        self.word_ids = [courseid for _, _, courseid in word_entries]
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        '''
+        Builds the index from the codes and titles of a CourseCatalog.
+        '''
+        courseids = [courseid for courseid, title in enumerate(catalog.titles) if title is not None]
+        return cls(courseids, [catalog.codes[i] for i in courseids], [catalog.titles[i] for i in courseids])
+
+    def prefix_range(self, keys, prefix):
+        '''
+        Returns the start and end positions of the keys that start with prefix.
+        '''
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\uffff', start)
+        return start, end
+
+    def match_codes(self, query, limit):
+        '''
+        Returns up to limit courseids whose code starts with the query, in code order.
+        '''
+        start, end = self.prefix_range(self.code_keys, query)
+        return self.code_ids[start:min(end, start + limit)]
+
+    def match_titles(self, words, prefix, limit, seen):
+        '''
+        Returns up to limit courseids not in seen whose title contains every complete word and a word
+        starting with prefix.
+
+        Only the range of the query word with the fewest entries is scanned; the other words are
+        checked against the title words of each candidate.
+        '''
+        ranges = [self.prefix_range(self.word_keys, prefix)]
+        for word in words:
+            start, end = self.prefix_range(self.word_keys, word)
+            ranges.append((start, bisect_left(self.word_keys, word + ' ', start, end)))
+        start, end = min(ranges, key=lambda r: r[1] - r[0])
+
+        courseids = []
+        for position in range(start, min(end, start + MAX_SCAN)):
+            courseid = self.word_ids[position]
+            if courseid in seen:
+                continue
+            title_words = self.title_words[courseid]
+            if all(word in title_words for word in words) and (not prefix or any(title_word.startswith(prefix) for title_word in title_words)):
+                courseids.append(courseid)
+                seen.add(courseid)
+                if len(courseids) == limit:
+                    break
+        return courseids
+
+    def suggest(self, query, limit=10):
+        '''
+        Returns courses for a typeahead query, with course code matches before title matches.
+
+            Parameters:
+                query: The text typed so far, e.g. "CPSC 4" or "introduction to comp".
+                limit: The maximum number of suggestions, capped at MAX_SUGGESTIONS.
+
+            Returns:
+                suggestions: List of dictionaries with the courseid, code and title of each course.
+        '''
+        limit = max(0, min(limit, MAX_SUGGESTIONS))
+        words = re.findall(r"\w+", (query or '').lower())
+        if not words or not limit:
+            return []
+
+        courseids = self.match_codes(normalize(query), limit)
+        if len(courseids) < limit:
+            # Words followed by more input are complete; only the word being typed is a prefix.
+            prefix = '' if re.search(r"\W$", query) else words.pop()
+            courseids += self.match_titles(words, prefix, limit - len(courseids), set(courseids))
+
+        return [{"courseid": courseid, "code": self.codes[courseid], "title": self.titles[courseid]} for courseid in courseids]
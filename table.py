@@ -1,12 +1,12 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, Text
+from sqlalchemy import Column, Float, ForeignKey, Integer, Text
 
 Base = declarative_base()
 
-class SpringCourses(Base):
-    """courses table for spring 2023"""
-    __tablename__ = 'springcourses'
-    term = Column(Text)
+class Courses(Base):
+    """courses table, one row per course and term"""
+    __tablename__ = 'courses'
+    term = Column(Text, primary_key=True)
     courseid = Column(Integer, primary_key=True)
     fullcode = Column(Text)
     deptcode = Column(Text)
@@ -16,17 +16,43 @@ class SpringCourses(Base):
     title = Column(Text)
     description = Column(Text)
     school = Column(Text)
+    # The lowest courseid of the course's cross-listing group, see databasebuilder.get_group_ids().
+    groupid = Column(Integer)
 
-class SpringDemand(Base):
-    """demand statistics table for spring 2023"""
-    __tablename__ = 'springdemand'
+class Demand(Base):
+    """demand statistics table, one row per course and term"""
+    __tablename__ = 'demand'
+    term = Column(Text, primary_key=True)
     courseid = Column(Integer, primary_key=True)
     coursecode = Column(Text)
     coursetitle = Column(Text)
     coursedemand = Column(Integer)
+    peakdemand = Column(Integer)
+    demandgrowth = Column(Integer)
+
+class DemandSeries(Base):
+    """daily demand samples of each course over the shopping period of its term"""
+    __tablename__ = 'demandseries'
+    # The primary key is the table itself, so samples are stored in (term, courseid, date) order without a rowid.
+    __table_args__ = {'sqlite_with_rowid': False}
+    term = Column(Text, primary_key=True)
+    courseid = Column(Integer, primary_key=True)
+    date = Column(Text, primary_key=True)
+    count = Column(Integer)
 
 class NLPFormat(Base):
     __tablename__ = 'nlpformat'
+    term = Column(Text, primary_key=True)
     courseid = Column(Integer, primary_key=True)
     cleansentence = Column(Text)
-    tokenlemmasentence = Column(Text)
\ No newline at end of file
+    tokenlemmasentence = Column(Text)
+
+class Neighbors(Base):
+    """recommendations of every course, written by indexbuilder.py --neighbors"""
+    __tablename__ = 'neighbors'
+    __table_args__ = {'sqlite_with_rowid': False}
+    term = Column(Text, primary_key=True)
+    courseid = Column(Integer, primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    neighborid = Column(Integer)
+    similarity = Column(Float)